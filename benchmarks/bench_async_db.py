@@ -0,0 +1,123 @@
+"""Задержка обработчиков: синхронный Database против AsyncDatabase.
+
+Пользователи приходят в течение --window секунд, у каждого два обновления:
+шаг поиска (счетчики по фильтру, страница результатов, текстовый поиск
+по городу, добавление в избранное) и обновление без обращения к базе. Задержка считается от момента
+прихода обновления до ответа, поэтому в нее входит и ожидание, пока цикл
+событий занят чужим запросом. С синхронным Database каждый запрос
+останавливает цикл целиком, и ждут все обновления, даже не трогающие
+базу; с AsyncDatabase запросы стоят в очереди к потоку базы, а остальные
+обновления обрабатываются сразу.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_async_db --users 500 --profiles 50000 --window 10
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from database import Database, DEPARTMENTS, EXPERIENCE_LEVELS
+from main import AsyncDatabase
+
+CITIES = ['Москва', 'Санкт-Петербург', 'Екатеринбург', 'Новосибирск', 'Казань', 'Сочи']
+# Имитация сетевого ответа Telegram (message.answer)
+API_DELAY = 0.005
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def random_filters(rng):
+    department = rng.choice(list(DEPARTMENTS))
+    return {'department': department, 'profession': rng.choice(DEPARTMENTS[department])}
+
+
+def fill(path, profiles, rng):
+    database = Database(path, synchronous='OFF')
+    with database.bulk_load():
+        database.add_profiles(
+            {'user_id': user_id, 'full_name': f'User {user_id}', **random_filters(rng),
+             'experience': rng.choice(EXPERIENCE_LEVELS), 'location': rng.choice(CITIES)}
+            for user_id in range(1, profiles + 1)
+        )
+    database.close()
+
+
+async def call(database, is_async, name, *args, **kwargs):
+    result = getattr(database, name)(*args, **kwargs)
+    return await result if is_async else result
+
+
+async def db_handler(database, is_async, user_id, filters, city, profiles, arrived):
+    """Упрощенный шаг поиска: счетчики, первая страница, текстовый поиск и кнопка «в избранное»"""
+    await call(database, is_async, 'count_users', **filters)
+    await call(database, is_async, 'facet_counts', 'experience', **filters)
+    await call(database, is_async, 'search_users_page', limit=5, viewer_id=user_id, **filters)
+    await call(database, is_async, 'search_text', city, limit=5, viewer_id=user_id)
+    await call(database, is_async, 'add_favorite', user_id, user_id % profiles + 1)
+    await asyncio.sleep(API_DELAY)
+    return time.perf_counter() - arrived
+
+
+async def text_handler(arrived):
+    """Упрощенный handle_text: без обращения к базе"""
+    await asyncio.sleep(API_DELAY)
+    return time.perf_counter() - arrived
+
+
+async def run(database, args, is_async):
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    tasks = []
+    for user_id, delay in sorted(((user_id, rng.uniform(0, args.window)) for user_id in range(1, args.users + 1)),
+                                 key=lambda item: item[1]):
+        # Обновление приходит в свое время, даже если цикл событий был занят
+        arrived = started + delay
+        await asyncio.sleep(max(0, arrived - time.perf_counter()))
+        filters, city = random_filters(rng), rng.choice(CITIES)
+        tasks.append(asyncio.create_task(db_handler(database, is_async, user_id, filters, city, args.profiles, arrived)))
+        tasks.append(asyncio.create_task(text_handler(arrived)))
+    latencies = [latency * 1000 for latency in await asyncio.gather(*tasks)]
+    return latencies[::2], latencies[1::2]
+
+
+def report(name, latencies):
+    db_latencies, text_latencies = latencies
+    print(f"{name:<15} с базой: p50={statistics.median(db_latencies):8.2f} мс p99={percentile(db_latencies, 99):8.2f} мс"
+          f"   без базы: p50={statistics.median(text_latencies):8.2f} мс p99={percentile(text_latencies, 99):8.2f} мс")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--profiles', type=int, default=50000)
+    parser.add_argument('--window', type=float, default=10.0, help='за сколько секунд приходят все пользователи')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'async.db')
+        fill(path, args.profiles, random.Random(args.seed))
+
+        sync_db = Database(path)
+        report('sync Database', asyncio.run(run(sync_db, args, False)))
+        sync_db.close()
+
+        async def run_async():
+            async_db = AsyncDatabase(Database(path))
+            try:
+                return await run(async_db, args, True)
+            finally:
+                await async_db.close()
+
+        report('AsyncDatabase', asyncio.run(run_async()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Цена выбора обработчика нажатия кнопки в зависимости от числа действий.
+
+Сравниваются два диспетчера aiogram с одинаковым набором действий:
+по обработчику с фильтром c.data.startswith(...) на каждое действие, как
+было раньше, и один обработчик с CallbackRouter из бота, который находит
+действие в словаре. Нажатия распределены по действиям равномерно, поэтому
+перебор фильтров в среднем проходит половину списка. Отдельно замеряются
+кодирование и разбор подписанных данных кнопки.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_callbacks --routes 10 50 200 1000
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from aiogram import Dispatcher, types
+
+from main import CallbackCodec, CallbackRouter, CALLBACK_SECRET
+from benchmarks.bench_load import FakeBot
+
+
+async def noop(callback, *args):
+    pass
+
+
+def linear_dispatcher(bot, actions):
+    dp = Dispatcher(bot)
+    for action in actions:
+        dp.register_callback_query_handler(noop, lambda c, prefix=f'{action}_': c.data.startswith(prefix), state='*')
+    return dp, [f'{action}_12345' for action in actions]
+
+
+def routed_dispatcher(bot, actions):
+    dp = Dispatcher(bot)
+    router = CallbackRouter(CallbackCodec(CALLBACK_SECRET))
+    for action in actions:
+        router.route(action, int)(noop)
+
+    async def route_callback(callback: types.CallbackQuery, callback_route):
+        handler, args, _ = callback_route
+        await handler(callback, *args)
+
+    dp.register_callback_query_handler(route_callback, router.resolve, state='*')
+    return dp, [router.data(action, 12345) for action in actions]
+
+
+async def measure(dp, payloads, presses, rng):
+    updates = [
+        types.Update(update_id=i, callback_query={
+            'id': str(i),
+            'from': {'id': 1, 'is_bot': False, 'first_name': 'User'},
+            'chat_instance': '1',
+            'data': rng.choice(payloads),
+        })
+        for i in range(presses)
+    ]
+    timings = []
+    for update in updates:
+        started = time.perf_counter()
+        # Отдельная задача на обновление, как при поллинге
+        await asyncio.create_task(dp.process_update(update))
+        timings.append((time.perf_counter() - started) * 1e6)
+    return statistics.median(timings)
+
+
+def codec_cost(presses):
+    codec = CallbackCodec(CALLBACK_SECRET)
+    started = time.perf_counter()
+    for user_id in range(presses):
+        data = codec.encode('add_favorite', user_id)
+    encode = (time.perf_counter() - started) * 1e6 / presses
+    started = time.perf_counter()
+    for _ in range(presses):
+        codec.decode(data)
+    decode = (time.perf_counter() - started) * 1e6 / presses
+    return encode, decode
+
+
+async def run(args):
+    bot = FakeBot()
+    print(f"{'действий':>9} {'фильтры, мкс':>13} {'словарь, мкс':>13}")
+    for routes in args.routes:
+        actions = [f'action{i}' for i in range(routes)]
+        results = []
+        for build in (linear_dispatcher, routed_dispatcher):
+            dp, payloads = build(bot, actions)
+            results.append(await measure(dp, payloads, args.presses, random.Random(args.seed)))
+        print(f"{routes:>9} {results[0]:>13.1f} {results[1]:>13.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--routes', type=int, nargs='+', default=[10, 50, 200, 1000])
+    parser.add_argument('--presses', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+    encode, decode = codec_cost(args.presses * 10)
+    print(f"данные кнопки: кодирование {encode:.2f} мкс, разбор с проверкой подписи {decode:.2f} мкс")
+
+
+if __name__ == '__main__':
+    main()
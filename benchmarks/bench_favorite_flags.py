@@ -0,0 +1,65 @@
+"""Флаг is_favorite: запрос на каждую строку против одного пакетного запроса.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_favorite_flags
+"""
+import asyncio
+import random
+import time
+
+from database import Database
+from main import AsyncDatabase
+
+VIEWER_ID = 0
+
+
+def fill(database, results):
+    database.add_profiles(
+        {'user_id': user_id, 'full_name': f'User {user_id}', 'department': 'Звуковой цех', 'profession': 'Звукорежиссеры'}
+        for user_id in range(1, results + 1)
+    )
+    favorites = random.Random(results).sample(range(1, results + 1), results // 10)
+    database.cursor.executemany(
+        'INSERT INTO favorites (user_id, favorite_user_id) VALUES (?, ?)',
+        ((VIEWER_ID, user_id) for user_id in favorites)
+    )
+    database.conn.commit()
+
+
+def timed(func):
+    started = time.perf_counter()
+    func()
+    return (time.perf_counter() - started) * 1000
+
+
+def main():
+    for results in (100, 1000, 10000):
+        database = Database(':memory:')
+        fill(database, results)
+        rows = database.search_users(department='Звуковой цех', profession='Звукорежиссеры')
+        ids = [row[0] for row in rows]
+
+        per_row = timed(lambda: [database.is_favorite(VIEWER_ID, user_id) for user_id in ids])
+        batched = timed(lambda: database.get_favorite_ids(VIEWER_ID, ids))
+        joined = timed(lambda: database.search_users_page(
+            limit=results, viewer_id=VIEWER_ID, department='Звуковой цех', profession='Звукорежиссеры'
+        ))
+        print(f"{results:>6} строк: по строке {per_row:8.2f} мс, IN (...) {batched:8.2f} мс, "
+              f"LEFT JOIN вместе с поиском {joined:8.2f} мс")
+
+        # В боте каждый запрос - еще и переход в поток базы через AsyncDatabase
+        async def per_row_async():
+            async_db = AsyncDatabase(database)
+            for user_id in ids:
+                await async_db.is_favorite(VIEWER_ID, user_id)
+
+        async def batched_async():
+            await AsyncDatabase(database).get_favorite_ids(VIEWER_ID, ids)
+
+        print(f"{'':>6}        через AsyncDatabase: по строке {timed(lambda: asyncio.run(per_row_async())):8.2f} мс, "
+              f"IN (...) {timed(lambda: asyncio.run(batched_async())):8.2f} мс")
+        database.conn.close()
+
+
+if __name__ == '__main__':
+    main()
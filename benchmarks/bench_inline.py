@@ -0,0 +1,121 @@
+"""Задержка inline-поиска на каждое нажатие клавиши, с кэшем запросов и без него.
+
+Виртуальные пользователи набирают запросы посимвольно (@bot г, @bot га, ...),
+как это делает клиент Telegram, и листают последний запрос по next_offset.
+С --typing 0 нажатия идут без пауз, и задержка показывает очередь к базе.
+Обновления идут через dp.process_update с FakeBot из bench_load. Запросы
+у разных пользователей повторяются, как популярные запросы в жизни.
+SQL считается вместе с внутренними запросами FTS5 к своим таблицам.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_inline --profiles 200000 --users 50
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+from collections import Counter
+
+from aiogram import types
+
+import main as app
+from database import Database
+from benchmarks.bench_load import FakeBot, count_queries, install
+from benchmarks.bench_text_search import QUERIES, fill
+
+PHRASES = QUERIES + ['оператор москва', 'художник по гриму', 'монтажер', 'художник казань', 'звукорежиссер']
+
+
+class InlineBot(FakeBot):
+    """FakeBot, который запоминает next_offset последнего ответа на inline-запрос"""
+
+    def __init__(self):
+        super().__init__()
+        self.next_offsets = {}
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        if method == 'answerInlineQuery':
+            self.next_offsets[data['inline_query_id']] = data.get('next_offset', '')
+        return await super().request(method, data, files, **kwargs)
+
+
+async def keystroke(bot, user_id, query, offset, ids):
+    query_id = str(next(ids))
+    update = types.Update(update_id=next(ids), inline_query={
+        'id': query_id,
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'},
+        'query': query,
+        'offset': offset,
+    })
+    started = time.perf_counter()
+    await asyncio.create_task(app.dp.process_update(update))
+    return (time.perf_counter() - started) * 1000, bot.next_offsets.pop(query_id, '')
+
+
+async def play(bot, user_id, phrase, args, ids, timings, rng):
+    for end in range(1, len(phrase) + 1):
+        await asyncio.sleep(rng.expovariate(1000 / args.typing) if args.typing else 0)
+        elapsed, _ = await keystroke(bot, user_id, phrase[:end], '', ids)
+        timings['набор'].append(elapsed)
+    offset = ''
+    for _ in range(args.pages):
+        await asyncio.sleep(rng.expovariate(1000 / args.typing) if args.typing else 0)
+        elapsed, offset = await keystroke(bot, user_id, phrase, offset, ids)
+        timings['листание'].append(elapsed)
+        if not offset:
+            break
+
+
+async def run(args, path, cache_size):
+    bot = InlineBot()
+    install(path, path + '.fsm', bot)
+    app.inline_results = app.LRUCache(cache_size, app.INLINE_CACHE_TTL)
+    queries = Counter()
+    count_queries(app.db._db.conn, queries, 'db')
+
+    rng = random.Random(args.seed)
+    ids = iter(range(1, 1 << 62))
+    timings = {'набор': [], 'листание': []}
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        play(bot, user_id, rng.choice(PHRASES), args, ids, timings, random.Random(rng.random()))
+        for user_id in range(1, args.users + 1)
+    ))
+    elapsed = time.perf_counter() - started
+    await app.sender.stop()
+    await app.db.close()
+    keystrokes = sum(len(values) for values in timings.values())
+    return timings, keystrokes, elapsed, queries['db']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profiles', type=int, default=200000)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--pages', type=int, default=3, help="сколько страниц листается после набора")
+    parser.add_argument('--typing', type=float, default=300, help="средняя пауза между нажатиями, мс; 0 - без пауз")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'inline.db')
+        database = Database(path, synchronous='OFF')
+        fill(database, args.profiles)
+        database.conn.close()
+
+        print(f"{args.profiles} профилей, {args.users} пользователей")
+        print(f"{'':<10} {'':<9} {'нажатий':>8} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9} {'SQL на нажатие':>15}")
+        for name, cache_size in (('без кэша', 0), ('с кэшем', app.INLINE_CACHE_SIZE)):
+            timings, keystrokes, elapsed, queries = asyncio.run(run(args, path, cache_size))
+            for kind, values in timings.items():
+                p50, p95, p99 = (statistics.quantiles(values, n=100)[i] for i in (49, 94, 98))
+                print(f"{name:<10} {kind:<9} {len(values):>8} {p50:>9.2f} {p95:>9.2f} {p99:>9.2f} "
+                      f"{queries / keystrokes:>15.2f}")
+            print(f"{name:<10} всего {keystrokes / elapsed:.0f} нажатий/с")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+"""Нагрузочный прогон диспетчера на синтетических обновлениях Telegram.
+
+Обновления подаются прямо в dp.process_update, Bot API подменяется FakeBot,
+который ничего не отправляет в сеть, а отвечает сам и запоминает последнюю
+inline-клавиатуру в каждом чате - по ней виртуальные пользователи листают
+результаты и жмут кнопки избранного. Каждый пользователь действует по своему
+сценарию последовательно, как живой человек, а все пользователи - параллельно:
+
+    start    - всплеск /start в начале прогона
+    profile  - заполнение профиля от «Мой профиль» до города, с несколькими фото
+    search   - поиск по цеху/профессии/опыту/городу и листание на глубину --pages,
+               с просмотром фото и видео портфолио
+    favorite - поиск, несколько нажатий «в избранное»/«удалить», просмотр избранного,
+               «Кто добавил меня», «Взаимные» и рекомендаций
+
+Печатает пропускную способность, перцентили задержки по обработчикам,
+число SQL-запросов и рост памяти (tracemalloc замедляет прогон, его можно
+отключить через --no-memory). Один и тот же --seed дает один и тот же поток
+обновлений, поэтому результаты можно сравнивать между коммитами.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_load --users 500 --seed 1
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+import main as app
+from database import DEPARTMENTS, EXPERIENCE_LEVELS, open_database
+
+CITIES = ['Москва', 'Санкт-Петербург', 'Екатеринбург', 'Новосибирск', 'Казань', 'Сочи']
+SCENARIOS = {'start': 0.2, 'profile': 0.3, 'search': 0.3, 'favorite': 0.2}
+
+
+class FakeBot(Bot):
+    """Bot без сети: считает вызовы API и отвечает правдоподобными объектами"""
+
+    def __init__(self):
+        super().__init__(token='123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
+        self.calls = Counter()
+        self.keyboards = {}
+        self._message_id = 0
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        self.calls[method] += 1
+        if method == 'sendMediaGroup':
+            return [self._message(int(data['chat_id']), '') for _ in json.loads(data['media'])]
+        if method not in ('sendMessage', 'editMessageText'):
+            return True
+        chat_id = int(data['chat_id'])
+        markup = json.loads(data.get('reply_markup') or '{}')
+        if 'inline_keyboard' in markup:
+            self.keyboards[chat_id] = markup
+        return self._message(chat_id, data.get('text', ''))
+
+    def _message(self, chat_id, text):
+        self._message_id += 1
+        return {
+            'message_id': self._message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': text,
+        }
+
+
+class HandlerTimer(BaseMiddleware):
+    """Время работы каждого обработчика от прохождения фильтров до конца"""
+
+    def __init__(self):
+        super().__init__()
+        self.timings = defaultdict(list)
+
+    async def _start(self, data):
+        route = data.get('callback_route')
+        data['_handler'] = route[0].__name__ if route else current_handler.get().__name__
+        data['_started'] = time.perf_counter()
+
+    async def _stop(self, data):
+        if '_handler' in data:
+            self.timings[data['_handler']].append((time.perf_counter() - data['_started']) * 1000)
+
+    async def on_process_message(self, message, data):
+        await self._start(data)
+
+    async def on_process_callback_query(self, callback, data):
+        await self._start(data)
+
+    async def on_post_process_message(self, message, results, data):
+        await self._stop(data)
+
+    async def on_post_process_callback_query(self, callback, results, data):
+        await self._stop(data)
+
+
+class VirtualUser:
+    def __init__(self, user_id, bot, dispatcher, rng, ids):
+        self.user_id = user_id
+        self.bot = bot
+        self.dp = dispatcher
+        self.rng = rng
+        self.ids = ids
+
+    def _user(self):
+        return {'id': self.user_id, 'is_bot': False, 'first_name': f'User {self.user_id}',
+                'username': f'user{self.user_id}'}
+
+    async def _process(self, update):
+        # Как при polling: каждое обновление в своей задаче, со своим контекстом
+        await asyncio.create_task(self.dp.process_update(update))
+
+    def _message(self, **content):
+        return dict(message_id=next(self.ids), date=int(time.time()), chat={'id': self.user_id, 'type': 'private'},
+                    **{'from': self._user()}, **content)
+
+    async def send(self, text):
+        message = self._message(text=text)
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        await self._process(types.Update(update_id=next(self.ids), message=message))
+
+    async def send_photo(self, file_unique_id):
+        """Фото, уже лежащее на серверах Telegram: приходят только его идентификаторы"""
+        photo = {'file_id': f'file-{file_unique_id}', 'file_unique_id': file_unique_id, 'width': 1280, 'height': 720}
+        await self._process(types.Update(update_id=next(self.ids), message=self._message(photo=[photo])))
+
+    async def press(self, callback_data):
+        """Нажатие кнопки на последней inline-клавиатуре бота в этом чате"""
+        message = {
+            'message_id': next(self.ids),
+            'date': int(time.time()),
+            'chat': {'id': self.user_id, 'type': 'private'},
+            'text': '',
+            'reply_markup': self.bot.keyboards.get(self.user_id),
+        }
+        callback = {'id': str(next(self.ids)), 'from': self._user(), 'chat_instance': str(self.user_id),
+                    'data': callback_data, 'message': message}
+        await self._process(types.Update(update_id=next(self.ids), callback_query=callback))
+
+    def buttons(self, action, *args):
+        """Кнопки последней клавиатуры с этим действием и первыми аргументами"""
+        keyboard = self.bot.keyboards.get(self.user_id, {}).get('inline_keyboard', [])
+        found = []
+        for row in keyboard:
+            for button in row:
+                decoded = app.callbacks.codec.decode(button.get('callback_data'))
+                if decoded and decoded[0] == action and decoded[1][:len(args)] == list(args):
+                    found.append(button['callback_data'])
+        return found
+
+    async def start(self):
+        await self.send('/start')
+
+    async def profile(self):
+        department = self.rng.choice(list(DEPARTMENTS))
+        await self.send('/start')
+        await self.send('👤 Мой профиль')
+        await self.press(app.callbacks.data('edit_profile'))
+        for text in (department, self.rng.choice(DEPARTMENTS[department]), self.rng.choice(EXPERIENCE_LEVELS),
+                     'Пропустить'):
+            await self.send(text)
+        # Часть файлов общая у разных пользователей, как пересланные кадры
+        for _ in range(self.rng.randint(0, 3)):
+            await self.send_photo(f'photo{self.rng.randrange(100)}')
+        await self.send('✅ Готово')
+        await self.send(self.rng.choice(CITIES))
+
+    async def search(self, pages):
+        department = self.rng.choice(list(DEPARTMENTS))
+        for text in ('🔍 Поиск коллег', department, self.rng.choice(DEPARTMENTS[department]),
+                     'Любой опыт', 'Любой город'):
+            await self.send(text)
+        for _ in range(pages):
+            media = self.buttons('profile_media')
+            if media:
+                await self.press(media[0])
+            next_page = self.buttons('search_page', 'next')
+            if not next_page:
+                break
+            await self.press(next_page[0])
+
+    async def favorite(self, pages):
+        await self.search(pages=1)
+        for _ in range(self.rng.randint(1, 5)):
+            buttons = self.buttons('add_favorite') + self.buttons('remove_favorite')
+            if not buttons:
+                break
+            await self.press(self.rng.choice(buttons))
+        await self.send('⭐ Избранное')
+        await self.press(app.callbacks.data('favorites_admirers'))
+        await self.press(app.callbacks.data('favorites_mutual'))
+        await self.send('✨ Рекомендации')
+
+
+def fill(path, profiles, rng, shards=1):
+    database = open_database(shards, path, synchronous='OFF')
+    departments = list(DEPARTMENTS)
+
+    def rows():
+        for user_id in range(1, profiles + 1):
+            department = rng.choice(departments)
+            yield {
+                'user_id': user_id,
+                'full_name': f'User {user_id}',
+                'department': department,
+                'profession': rng.choice(DEPARTMENTS[department]),
+                'experience': rng.choice(EXPERIENCE_LEVELS),
+                'location': rng.choice(CITIES),
+            }
+
+    database.add_profiles(rows())
+    database.close()
+
+
+def install(path, fsm_path, bot=None, shards=1):
+    """Подменяем бота, базу и хранилище FSM в main на тестовые"""
+    bot = bot or FakeBot()
+    app.bot = app.dp.bot = bot
+    # Лимиты Telegram здесь не при чем: меряем сам бот, а не ожидание токенов
+    app.sender = app.SendQueue(bot, global_rate=1e9, chat_rate=1e9, chat_burst=1e9)
+    app.db = app.CachedDatabase(open_database(shards, path))
+    app.storage = app.dp.storage = app.SQLiteStorage(fsm_path)
+    Bot.set_current(bot)
+    Dispatcher.set_current(app.dp)
+    timer = HandlerTimer()
+    app.dp.middleware.setup(timer)
+    return bot, timer
+
+
+def count_queries(conn, counter, key):
+    def trace(statement):
+        counter[key] += 1
+
+    conn.set_trace_callback(trace)
+
+
+async def run(args, path):
+    bot, timer = install(path, path + '.fsm', shards=args.shards)
+    queries = Counter()
+    for shard in getattr(app.db._db, 'shards', [app.db._db]):
+        count_queries(shard.conn, queries, 'db')
+    count_queries(app.storage.conn, queries, 'fsm')
+    app.db.start_flusher()
+
+    rng = random.Random(args.seed)
+    ids = iter(range(1, 1 << 62))
+    names = list(SCENARIOS)
+    users = []
+    # Пользователи прогона идут после заполненных профилей, чтобы не пересекаться с ними
+    for user_id in range(args.profiles + 1, args.profiles + args.users + 1):
+        user = VirtualUser(user_id, bot, app.dp, random.Random(rng.random()), ids)
+        users.append((user, rng.choices(names, weights=list(SCENARIOS.values()))[0]))
+
+    async def play(user, scenario):
+        if scenario in ('search', 'favorite'):
+            await getattr(user, scenario)(args.pages)
+        else:
+            await getattr(user, scenario)()
+
+    if args.memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    # Сначала всплеск /start от всех сразу, потом сценарии
+    await asyncio.gather(*(user.start() for user, _ in users))
+    memory_after_burst = tracemalloc.get_traced_memory()[0] if args.memory else 0
+    await asyncio.gather(*(play(user, scenario) for user, scenario in users))
+    if app.cleanup_tasks:
+        await asyncio.wait(app.cleanup_tasks)
+    elapsed = time.perf_counter() - started
+    if args.memory:
+        memory_end, memory_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    await app.sender.stop()
+    await app.db.close()
+
+    handled = sum(len(timings) for timings in timer.timings.values())
+    print(f"{args.users} пользователей, {Counter(scenario for _, scenario in users)}")
+    print(f"{handled} обновлений за {elapsed:.2f} с: {handled / elapsed:.0f} обновлений/с")
+    print(f"{'обработчик':<24} {'вызовов':>8} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9}")
+    for handler, timings in sorted(timer.timings.items(), key=lambda item: -len(item[1])):
+        if len(timings) > 1:
+            p50, p95, p99 = (statistics.quantiles(timings, n=100)[i] for i in (49, 94, 98))
+        else:
+            p50 = p95 = p99 = timings[0]
+        print(f"{handler:<24} {len(timings):>8} {p50:>9.2f} {p95:>9.2f} {p99:>9.2f}")
+    print(f"SQL: база {queries['db']} ({queries['db'] / handled:.1f} на обновление), "
+          f"FSM {queries['fsm']} ({queries['fsm'] / handled:.1f} на обновление)")
+    print(f"Bot API: {dict(bot.calls)}")
+    if args.memory:
+        print(f"Память: после всплеска {memory_after_burst / 1024 / 1024:.1f} МБ, "
+              f"в конце {memory_end / 1024 / 1024:.1f} МБ, пик {memory_peak / 1024 / 1024:.1f} МБ")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--profiles', type=int, default=20000, help="профилей в базе до прогона")
+    parser.add_argument('--pages', type=int, default=5, help="глубина листания результатов поиска")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--shards', type=int, default=1, help="файлов базы, см. ShardedDatabase")
+    parser.add_argument('--no-memory', dest='memory', action='store_false')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'load.db')
+        fill(path, args.profiles, random.Random(args.seed), args.shards)
+        asyncio.run(run(args, path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Повтор нажатий кнопок с кэшем чтений и без него.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_read_cache --presses 50000
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from database import Database
+from main import AsyncDatabase, CachedDatabase
+
+USERS = 2000
+
+
+def fill(path):
+    database = Database(path)
+    rng = random.Random(0)
+    database.add_profiles(
+        {'user_id': user_id, 'full_name': f'User {user_id}', 'department': 'Звуковой цех',
+         'profession': 'Звукорежиссеры', 'location': 'Москва'}
+        for user_id in range(USERS)
+    )
+    database.cursor.executemany(
+        'INSERT OR IGNORE INTO favorites VALUES (?, ?)',
+        ((rng.randrange(USERS), rng.randrange(USERS)) for _ in range(USERS * 10))
+    )
+    database.conn.commit()
+    database.conn.close()
+
+
+async def replay(database, presses):
+    # Активных пользователей немного, и они в основном смотрят, а не меняют
+    rng = random.Random(1)
+    active = rng.sample(range(USERS), 200)
+    started = time.perf_counter()
+    for _ in range(presses):
+        user_id = rng.choice(active)
+        action = rng.random()
+        if action < 0.4:
+            await database.get_user(user_id)  # my_profile, cancel_delete
+        elif action < 0.9:
+            await database.get_favorites(user_id)  # show_favorites
+        elif action < 0.97:
+            await database.add_favorite(user_id, rng.randrange(USERS))
+        else:
+            await database.update_profile(user_id, location='Санкт-Петербург')
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--presses', type=int, default=50000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, wrapper in (('без кэша', AsyncDatabase), ('с кэшем', CachedDatabase)):
+            path = os.path.join(tmp, f'{wrapper.__name__}.db')
+            fill(path)
+
+            async def run():
+                database = wrapper(Database(path))
+                elapsed = await replay(database, args.presses)
+                stats = database.cache_stats() if isinstance(database, CachedDatabase) else ''
+                await database.close()
+                return elapsed, stats
+
+            elapsed, stats = asyncio.run(run())
+            print(f"{name:<9} {args.presses / elapsed:10.0f} нажатий/с {stats}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Время перестроения соседей для рекомендаций в зависимости от размера графа избранного.
+
+Для каждого числа связей из --edges заполняет новую базу, перестраивает
+соседей порциями, как это делает бот, и замеряет задержку
+get_recommendations и add_favorite с инкрементальной правкой соседей.
+Популярность профилей неравномерная: номер сохраняемого профиля распределен
+логарифмически, поэтому первые профили сохраняют гораздо чаще остальных.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_recommendations --profiles 100000 --edges 100000 500000 1000000
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from database import Database, DEPARTMENTS, RECOMMENDATION_REBUILD_BATCH
+
+CITIES = ['Москва', 'Санкт-Петербург', 'Екатеринбург', 'Новосибирск', 'Казань', 'Сочи']
+
+
+def fill(database, profiles, edges, rng):
+    departments = list(DEPARTMENTS)
+
+    def rows():
+        for user_id in range(1, profiles + 1):
+            department = rng.choice(departments)
+            yield {
+                'user_id': user_id,
+                'full_name': f'User {user_id}',
+                'department': department,
+                'profession': rng.choice(DEPARTMENTS[department]),
+                'location': rng.choice(CITIES),
+            }
+
+    def pairs():
+        for _ in range(edges):
+            yield rng.randint(1, profiles), int(profiles ** rng.random())
+
+    with database.bulk_load():
+        database.add_profiles(rows())
+    database.add_favorites(pairs())
+    database.flush()
+
+
+def timings(func, args_list):
+    result = []
+    for args in args_list:
+        started = time.perf_counter()
+        func(*args)
+        result.append((time.perf_counter() - started) * 1000)
+    return statistics.median(result), max(result)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profiles', type=int, default=100000)
+    parser.add_argument('--edges', type=int, nargs='+', default=[100000, 500000, 1000000])
+    parser.add_argument('--batch', type=int, default=RECOMMENDATION_REBUILD_BATCH, help="профилей за один запрос")
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{args.profiles} профилей")
+    print(f"{'связей':>9} {'перестроение, с':>16} {'макс. порция, мс':>17} {'соседей':>9} "
+          f"{'рекомендации, мс':>17} {'add_favorite, мс':>17}")
+    for edges in args.edges:
+        rng = random.Random(edges)
+        with tempfile.TemporaryDirectory() as tmp:
+            database = Database(os.path.join(tmp, 'recommendations.db'), synchronous='OFF')
+            fill(database, args.profiles, edges, rng)
+
+            started = time.perf_counter()
+            slowest = 0
+            after = 0
+            while after is not None:
+                batch_started = time.perf_counter()
+                after = database.rebuild_neighbors(after, limit=args.batch)
+                slowest = max(slowest, time.perf_counter() - batch_started)
+            database.flush()
+            rebuild = time.perf_counter() - started
+            neighbors = database.conn.execute('SELECT COUNT(*) FROM favorite_neighbors').fetchone()[0]
+
+            viewers = [(rng.randint(1, args.profiles),) for _ in range(args.queries)]
+            recommend, _ = timings(lambda user_id: database.get_recommendations(user_id, limit=5), viewers)
+            additions = [(rng.randint(1, args.profiles), rng.randint(1, args.profiles)) for _ in range(args.queries)]
+            add, _ = timings(database.add_favorite, additions)
+            database.flush()
+            database.conn.close()
+
+        print(f"{edges:>9} {rebuild:>16.2f} {slowest * 1000:>17.1f} {neighbors:>9} {recommend:>17.3f} {add:>17.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Процессорное время на отрисовку клавиатур и карточек за одно обновление.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_rendering --updates 20000
+"""
+import argparse
+import random
+import sqlite3
+import time
+
+from aiogram import types
+
+from database import DEPARTMENTS, EXPERIENCE_LEVELS
+from main import get_main_menu, get_professions_keyboard, render_profile_card, EXPERIENCE_KEYBOARD
+
+
+# Прежняя реализация: клавиатуры и карточки собираются заново на каждый вызов
+def legacy_main_menu():
+    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    keyboard.add("🔍 Поиск коллег", "👤 Мой профиль")
+    keyboard.add("⭐ Избранное")
+    return keyboard
+
+
+def legacy_professions_keyboard(department):
+    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    for profession in DEPARTMENTS.get(department, []):
+        keyboard.add(profession)
+    keyboard.add("🔙 Назад")
+    return keyboard
+
+
+def legacy_experience_keyboard():
+    return types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2).add(*EXPERIENCE_LEVELS).add("🔙 Назад")
+
+
+def legacy_card(user):
+    return (
+        f"👤 <b>Найден специалист:</b>\n\n"
+        f"<b>Имя:</b> {user[2]}\n"
+        f"<b>Цех:</b> {user[3]}\n"
+        f"<b>Профессия:</b> {user[4]}\n"
+        f"<b>Опыт:</b> {user[5]}\n"
+        f"<b>Локация:</b> {user[7]}\n\n"
+        f"<a href='tg://user?id={user[0]}'>Написать</a>"
+    )
+
+
+def make_users(count):
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.execute('CREATE TABLE users (user_id, username, full_name, department, profession, experience, portfolio, location, favorited)')
+    rng = random.Random(0)
+    departments = list(DEPARTMENTS)
+    for user_id in range(count):
+        department = rng.choice(departments)
+        conn.execute('INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+            user_id, f'user{user_id}', f'User {user_id}', department, rng.choice(DEPARTMENTS[department]),
+            rng.choice(EXPERIENCE_LEVELS), '', 'Москва', rng.randrange(3)
+        ))
+    return conn.execute('SELECT * FROM users').fetchall()
+
+
+def run(updates, users, main_menu, professions, experience, card):
+    rng = random.Random(1)
+    departments = list(DEPARTMENTS)
+    started = time.process_time()
+    for _ in range(updates):
+        # Типичное обновление: меню, клавиатура шага и страница из 5 карточек
+        main_menu()
+        professions(rng.choice(departments))
+        experience()
+        for user in rng.sample(users, 5):
+            card(user)
+    return (time.process_time() - started) / updates * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--updates', type=int, default=20000)
+    args = parser.parse_args()
+    users = make_users(1000)
+
+    before = run(args.updates, users, legacy_main_menu, legacy_professions_keyboard,
+                 legacy_experience_keyboard, legacy_card)
+    after = run(args.updates, users, get_main_menu, get_professions_keyboard,
+                lambda: EXPERIENCE_KEYBOARD, lambda user: render_profile_card(user, "Найден специалист"))
+    print(f"до:    {before:8.1f} мкс CPU на обновление")
+    print(f"после: {after:8.1f} мкс CPU на обновление")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Обратные запросы к избранному с индексом idx_favorites_reverse и без него.
+
+«Кто добавил меня», число взаимных добавлений и удаление пользователя
+на графе из миллионов ребер. «Без индекса» - та же база со снятым индексом
+и прежним DELETE ... WHERE user_id = ? OR favorite_user_id = ?.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_reverse_favorites --users 200000 --edges 2000000
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from database import Database, DEPARTMENTS
+
+
+def fill(database, users, edges):
+    rng = random.Random(0)
+    departments = list(DEPARTMENTS)
+
+    def profiles():
+        for user_id in range(1, users + 1):
+            department = rng.choice(departments)
+            yield {'user_id': user_id, 'full_name': f'User {user_id}', 'department': department,
+                   'profession': rng.choice(DEPARTMENTS[department]), 'location': 'Москва'}
+
+    with database.bulk_load():
+        database.add_profiles(profiles())
+    # Популярность неравномерная: каждое пятое добавление достается одному из первых 1000 профилей
+    database.add_favorites(
+        (rng.randint(1, users), rng.randint(1, 1000) if rng.random() < 0.2 else rng.randint(1, users))
+        for _ in range(edges)
+    )
+    database.flush()
+
+
+def measure(call, user_ids):
+    timings = []
+    for user_id in user_ids:
+        started = time.perf_counter()
+        call(user_id)
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), max(timings)
+
+
+def run(database, user_ids, legacy):
+    conn = database.conn
+
+    def delete_user(user_id):
+        if legacy:
+            conn.execute('DELETE FROM favorites WHERE user_id = ? OR favorite_user_id = ?', (user_id, user_id))
+        else:
+            conn.execute('DELETE FROM favorites WHERE user_id = ?', (user_id,))
+            conn.execute('DELETE FROM favorites WHERE favorite_user_id = ?', (user_id,))
+
+    results = {
+        'кто добавил меня': measure(lambda user_id: database.get_admirers(user_id, limit=50), user_ids),
+        'взаимные': measure(database.count_mutual_favorites, user_ids),
+        'удаление': measure(delete_user, user_ids),
+    }
+    # Удаления не сохраняем, чтобы второй прогон шел по тем же данным
+    conn.rollback()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200000)
+    parser.add_argument('--edges', type=int, default=2000000)
+    parser.add_argument('--queries', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = Database(os.path.join(tmp, 'favorites.db'), synchronous='OFF', batch_size=10 ** 9)
+        started = time.perf_counter()
+        fill(database, args.users, args.edges)
+        edges = database.conn.execute('SELECT COUNT(*) FROM favorites').fetchone()[0]
+        print(f"{args.users} профилей, {edges} ребер избранного, загрузка {time.perf_counter() - started:.1f} с")
+
+        rng = random.Random(1)
+        # Вперемешку популярные и обычные профили
+        user_ids = [rng.randint(1, 1000) for _ in range(args.queries // 2)]
+        user_ids += [rng.randint(1, args.users) for _ in range(args.queries - len(user_ids))]
+
+        after = run(database, user_ids, legacy=False)
+        database.conn.execute('DROP INDEX idx_favorites_reverse')
+        before = run(database, user_ids, legacy=True)
+        for name in after:
+            print(f"{name:<17} без индекса: медиана {before[name][0]:8.2f} мс, макс {before[name][1]:8.2f} мс | "
+                  f"с индексом: медиана {after[name][0]:7.3f} мс, макс {after[name][1]:7.3f} мс")
+        database.conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Цена update_profile в зависимости от числа сохраненных поисков.
+
+Подписчики для обновленного профиля ищутся по уникальному ключу
+saved_searches (цех, профессия, город, опыт), поэтому время обновления
+растет с числом совпадений, а не с числом поисков: время на одно
+совпадение должно оставаться постоянным. Для сравнения замеряется
+перебор всех поисков, которым это пришлось бы делать без индекса.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_saved_searches --searches 1000 100000 1000000
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from database import Database, DEPARTMENTS, EXPERIENCE_LEVELS
+
+CITIES = ['Москва', 'Санкт-Петербург', 'Екатеринбург', 'Новосибирск', 'Казань', 'Сочи']
+PROFILES = 10000
+
+
+def fill(database, searches, rng):
+    departments = list(DEPARTMENTS)
+    database.add_profiles({'user_id': user_id, 'full_name': f'User {user_id}'} for user_id in range(1, PROFILES + 1))
+    rows = set()
+    while len(rows) < searches:
+        department = rng.choice(departments)
+        rows.add((
+            rng.randint(PROFILES + 1, PROFILES + searches),
+            database.department_ids[department],
+            database.profession_ids[(database.department_ids[department], rng.choice(DEPARTMENTS[department]))],
+            rng.choice([0] + [database.experience_ids[level] for level in EXPERIENCE_LEVELS]),
+            rng.choice([''] + CITIES),
+        ))
+    database.cursor.executemany('''
+    INSERT OR IGNORE INTO saved_searches (user_id, department_id, profession_id, experience_id, location)
+    VALUES (?, ?, ?, ?, ?)''', rows)
+    database.flush()
+
+
+def updates(rng, count):
+    departments = list(DEPARTMENTS)
+    for _ in range(count):
+        department = rng.choice(departments)
+        yield rng.randint(1, PROFILES), {
+            'department': department,
+            'profession': rng.choice(DEPARTMENTS[department]),
+            'experience': rng.choice(EXPERIENCE_LEVELS),
+            'location': rng.choice(CITIES),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--searches', type=int, nargs='+', default=[1000, 100000, 1000000])
+    parser.add_argument('--updates', type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'поисков':>9} {'update_profile, мс':>19} {'совпадений на обновление':>25} "
+          f"{'мкс на совпадение':>18} {'перебор, мс':>12}")
+    for searches in args.searches:
+        rng = random.Random(searches)
+        with tempfile.TemporaryDirectory() as tmp:
+            database = Database(os.path.join(tmp, 'saved_searches.db'), synchronous='OFF')
+            fill(database, searches, rng)
+
+            timings = []
+            for user_id, profile in updates(rng, args.updates):
+                started = time.perf_counter()
+                database.update_profile(user_id, **profile)
+                timings.append((time.perf_counter() - started) * 1000)
+            database.flush()
+            matches = database.conn.execute('SELECT COUNT(*) FROM search_matches').fetchone()[0]
+
+            # Так выглядел бы подбор подписчиков без обратного индекса
+            started = time.perf_counter()
+            database.conn.execute('''
+            SELECT COUNT(*) FROM saved_searches
+            WHERE department_id + 0 = 1 AND profession_id + 0 = 1''').fetchone()
+            scan = (time.perf_counter() - started) * 1000
+            database.conn.close()
+
+        print(f"{searches:>9} {statistics.median(timings):>19.3f} {matches / args.updates:>25.1f} "
+              f"{sum(timings) * 1000 / max(matches, 1):>18.2f} {scan:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
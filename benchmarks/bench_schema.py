@@ -0,0 +1,105 @@
+"""Размер файла и скорость поиска до и после перехода на коды справочников.
+
+Создает базу в прежнем формате (строки в users), замеряет ее, затем
+открывает через Database, что запускает миграцию, и замеряет снова.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_schema --profiles 200000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from database import Database, DEPARTMENTS, EXPERIENCE_LEVELS
+
+CITIES = ['Москва', 'Санкт-Петербург', 'Екатеринбург', 'Новосибирск', 'Казань', 'Сочи']
+
+
+def create_legacy(path, profiles):
+    conn = sqlite3.connect(path)
+    conn.execute('''
+    CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY, username TEXT, full_name TEXT, department TEXT,
+        profession TEXT, experience TEXT, portfolio TEXT, location TEXT
+    )''')
+    conn.execute('CREATE TABLE favorites (user_id INTEGER, favorite_user_id INTEGER, '
+                 'PRIMARY KEY (user_id, favorite_user_id))')
+    conn.execute('CREATE INDEX idx_users_search ON users (department, profession, experience, location)')
+    rng = random.Random(0)
+    departments = list(DEPARTMENTS)
+
+    def rows():
+        for user_id in range(1, profiles + 1):
+            department = rng.choice(departments)
+            yield (user_id, f'user{user_id}', f'User {user_id}', department, rng.choice(DEPARTMENTS[department]),
+                   rng.choice(EXPERIENCE_LEVELS), '', rng.choice(CITIES))
+
+    conn.executemany('INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows())
+    conn.commit()
+    conn.execute('VACUUM')
+    return conn
+
+
+def queries():
+    rng = random.Random(1)
+    departments = list(DEPARTMENTS)
+    for _ in range(200):
+        department = rng.choice(departments)
+        yield department, rng.choice(DEPARTMENTS[department]), rng.choice(EXPERIENCE_LEVELS)
+
+
+def measure(search):
+    timings = []
+    for department, profession, experience in queries():
+        started = time.perf_counter()
+        search(department, profession, experience)
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), max(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profiles', type=int, default=200000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'cinema_collab.db')
+        conn = create_legacy(path, args.profiles)
+
+        def legacy_search(department, profession, experience):
+            conn.execute('''
+            SELECT * FROM users WHERE department = ? AND profession = ? AND experience = ?
+            ORDER BY user_id LIMIT 6''', (department, profession, experience)).fetchall()
+
+        size_before = os.path.getsize(path)
+        median_before, max_before = measure(legacy_search)
+        conn.close()
+
+        database = Database(path)
+
+        def coded_search(department, profession, experience):
+            database.search_users_page(limit=5, department=department, profession=profession, experience=experience)
+
+        size_after = os.path.getsize(path)
+        median_after, max_after = measure(coded_search)
+        database.conn.close()
+
+        # После миграции в базе еще и индекс FTS5 (users_fts), его размер считаем отдельно
+        print(f"{args.profiles} профилей")
+        print(f"  строки:     {size_before / 1024 / 1024:7.1f} МБ, поиск медиана {median_before:.3f} мс, макс {max_before:.3f} мс")
+        print(f"  коды:       {size_after / 1024 / 1024:7.1f} МБ, поиск медиана {median_after:.3f} мс, макс {max_after:.3f} мс")
+        conn = sqlite3.connect(path)
+        try:
+            fts_pages = conn.execute("SELECT SUM(pgsize) FROM dbstat WHERE name LIKE 'users_fts%'").fetchone()[0]
+            print(f"  из них FTS: {fts_pages / 1024 / 1024:7.1f} МБ")
+        except sqlite3.OperationalError:
+            pass
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
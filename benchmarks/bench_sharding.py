@@ -0,0 +1,150 @@
+"""Пропускная способность записи и задержка чтения в зависимости от числа шардов.
+
+Для каждого числа шардов из --shards база заполняется через ShardedDatabase,
+затем один и тот же поток операций (правка профиля, добавление и удаление
+избранного) выполняется так, как при одном процессе на шард: каждый процесс
+открывает только свой файл и выполняет свою часть потока - правки своих
+профилей и свои копии связей избранного (связь между шардами пишется в оба).
+Пропускная способность - все операции потока, деленные на время самого
+медленного процесса. Чтения со сбором со всех шардов (search_users_page,
+get_favorites) замеряются в основном процессе. Ускорение записи ограничено
+числом ядер: при --synchronous FULL каждый commit ждет диска, и процессы
+пересекаются ожиданием даже на одном ядре.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_sharding --shards 1 2 4 8 --profiles 100000
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from database import Database, ShardedDatabase, DB_BATCH_SIZE, DEPARTMENTS, EXPERIENCE_LEVELS, shard_paths
+
+CITIES = ['Москва', 'Санкт-Петербург', 'Екатеринбург', 'Новосибирск', 'Казань', 'Сочи']
+
+
+def random_profile(rng):
+    department = rng.choice(list(DEPARTMENTS))
+    return {
+        'department': department,
+        'profession': rng.choice(DEPARTMENTS[department]),
+        'experience': rng.choice(EXPERIENCE_LEVELS),
+        'location': rng.choice(CITIES),
+    }
+
+
+def fill(database, profiles, favorites, rng):
+    with database.bulk_load():
+        database.add_profiles(
+            {'user_id': user_id, 'full_name': f'User {user_id}', **random_profile(rng)}
+            for user_id in range(1, profiles + 1)
+        )
+    database.add_favorites({(rng.randint(1, profiles), rng.randint(1, profiles)) for _ in range(favorites)})
+    database.flush()
+
+
+def operations(profiles, count, rng):
+    ops = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.6:
+            ops.append(('update_profile', rng.randint(1, profiles), random_profile(rng)))
+        else:
+            name = 'add_favorite' if kind < 0.9 else 'remove_favorite'
+            ops.append((name, rng.randint(1, profiles), rng.randint(1, profiles)))
+    return ops
+
+
+def worker(index, count, path, args, ops, barrier, results):
+    """Один процесс - один шард: только операции, которые пишут в этот файл"""
+    database = Database(shard_paths(count, path)[index], synchronous=args.synchronous, batch_size=args.batch_size)
+    own = []
+    for op in ops:
+        if op[0] == 'update_profile':
+            if op[1] % count == index:
+                own.append(op)
+        elif op[1] % count == index or op[2] % count == index:
+            own.append(op)
+    barrier.wait()
+    started = time.perf_counter()
+    for name, user_id, arg in own:
+        if name == 'update_profile':
+            database.update_profile(user_id, **arg)
+        else:
+            getattr(database, name)(user_id, arg)
+    database.flush()
+    results.put((len(own), time.perf_counter() - started))
+    database.close()
+
+
+def write_throughput(count, path, args, ops):
+    barrier = multiprocessing.Barrier(count)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker, args=(index, count, path, args, ops, barrier, results))
+                 for index in range(count)]
+    for process in processes:
+        process.start()
+    done = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return len(ops) / max(elapsed for _, elapsed in done), sum(writes for writes, _ in done)
+
+
+def read_latency(database, args, rng):
+    def median(func):
+        timings = []
+        for _ in range(args.reads):
+            started = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - started) * 1000)
+        return statistics.median(timings)
+
+    def page():
+        profile = random_profile(rng)
+        database.search_users_page(limit=10, viewer_id=rng.randint(1, args.profiles),
+                                   department=profile['department'], profession=profile['profession'])
+
+    return median(page), median(lambda: database.get_favorites(rng.randint(1, args.profiles)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--profiles', type=int, default=100000)
+    parser.add_argument('--favorites', type=int, default=500000)
+    parser.add_argument('--operations', type=int, default=20000)
+    parser.add_argument('--reads', type=int, default=500)
+    parser.add_argument('--synchronous', default='NORMAL')
+    parser.add_argument('--batch-size', type=int, default=DB_BATCH_SIZE)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    ops = operations(args.profiles, args.operations, random.Random(args.seed))
+    print(f"{args.profiles} профилей, {args.favorites} связей, {args.operations} операций, "
+          f"ядер: {os.cpu_count()}, synchronous={args.synchronous}")
+    print(f"{'шардов':>7} {'операций/с':>11} {'ускорение':>10} {'записей в шарды':>16} "
+          f"{'search_users_page, мс':>22} {'get_favorites, мс':>18}")
+    baseline = None
+    for count in args.shards:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'sharding.db')
+            database = ShardedDatabase([Database(shard, synchronous='OFF') for shard in shard_paths(count, path)])
+            fill(database, args.profiles, args.favorites, random.Random(args.seed))
+            database.close()
+
+            throughput, writes = write_throughput(count, path, args, ops)
+            baseline = baseline or throughput
+            database = ShardedDatabase([Database(shard) for shard in shard_paths(count, path)])
+            page, favorites = read_latency(database, args, random.Random(args.seed))
+            database.close()
+
+        print(f"{count:>7} {throughput:>11.0f} {throughput / baseline:>10.2f} {writes:>16} "
+              f"{page:>22.2f} {favorites:>18.2f}")
+
+
+if __name__ == '__main__':
+    main()
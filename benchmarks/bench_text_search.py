@@ -0,0 +1,63 @@
+"""Задержка текстового поиска (FTS5, триграммы) на большом числе профилей.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_text_search --profiles 1000000
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from database import Database, DEPARTMENTS
+
+CITIES = ['Москва', 'Санкт-Петербург', 'Екатеринбург', 'Новосибирск', 'Казань', 'Мытищи', 'Сочи', 'Калининград']
+NAMES = ['Иван', 'Пётр', 'Анна', 'Мария', 'Семён', 'Ольга', 'Алексей', 'Наталья']
+SURNAMES = ['Иванов', 'Смирнов', 'Кузнецов', 'Попов', 'Соколов', 'Лебедев', 'Козлов', 'Новиков']
+QUERIES = ['мск', 'москва гаффер', 'семен', 'иванов спб', 'звукорежиссер казань', 'соколова', 'калининград']
+
+
+def fill(database, profiles):
+    rng = random.Random(0)
+    departments = list(DEPARTMENTS)
+
+    def rows():
+        for user_id in range(1, profiles + 1):
+            department = rng.choice(departments)
+            yield {
+                'user_id': user_id,
+                'full_name': f'{rng.choice(NAMES)} {rng.choice(SURNAMES)}',
+                'department': department,
+                'profession': rng.choice(DEPARTMENTS[department]),
+                'location': rng.choice(CITIES),
+            }
+
+    database.add_profiles(rows())
+    database.conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profiles', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = Database(os.path.join(tmp, 'fts.db'), synchronous='OFF')
+        started = time.perf_counter()
+        fill(database, args.profiles)
+        print(f"{args.profiles} профилей загружено за {time.perf_counter() - started:.1f} с")
+
+        for query in QUERIES:
+            timings = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                database.search_text(query, limit=10)
+                timings.append((time.perf_counter() - started) * 1000)
+            print(f"{query!r:<26} медиана {statistics.median(timings):7.2f} мс, макс {max(timings):7.2f} мс")
+        database.conn.close()
+
+
+if __name__ == '__main__':
+    main()
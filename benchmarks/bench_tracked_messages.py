@@ -0,0 +1,49 @@
+"""Память под отслеживаемые сообщения: dict списков против TrackedMessages.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_tracked_messages --chats 100000 --messages 10
+"""
+import argparse
+import time
+import tracemalloc
+
+from main import TrackedMessages
+
+
+def measure(build):
+    tracemalloc.start()
+    store = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del store
+    return size / 1024 / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chats', type=int, default=100000)
+    parser.add_argument('--messages', type=int, default=10)
+    args = parser.parse_args()
+    now = int(time.time())
+
+    def build_dict():
+        # Прежний формат: chat_id -> список (message_id, sent_at)
+        store = {}
+        for chat_id in range(args.chats):
+            store[chat_id] = [(100000 + i, now + i) for i in range(args.messages)]
+        return store
+
+    def build_tracked():
+        store = TrackedMessages()
+        for chat_id in range(args.chats):
+            for i in range(args.messages):
+                store.add(chat_id, 100000 + i, now + i)
+        return store
+
+    print(f"{args.chats} чатов по {args.messages} сообщений:")
+    print(f"  dict списков    {measure(build_dict):8.1f} МБ")
+    print(f"  TrackedMessages {measure(build_tracked):8.1f} МБ")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+"""Пропускная способность записи в зависимости от размера пакета commit.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_write_batching --writes 5000 --synchronous FULL
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from database import Database
+
+
+def burst(database, writes):
+    started = time.perf_counter()
+    for i in range(writes):
+        database.add_favorite(i % 500, i)
+    database.flush()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--writes', type=int, default=5000)
+    parser.add_argument('--synchronous', default='FULL')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for batch_size in (1, 10, 100, 1000):
+            database = Database(os.path.join(tmp, f'batch{batch_size}.db'),
+                                synchronous=args.synchronous, batch_size=batch_size)
+            elapsed = burst(database, args.writes)
+            database.conn.close()
+            print(f"batch_size={batch_size:<5} {args.writes / elapsed:10.0f} записей/с")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1768 @@
+"""Профили, избранное, поиск и рекомендации в SQLite.
+
+Модуль не создает бота и не открывает базы при импорте: его используют
+и бот (main.py), и manage.py, и бенчмарки.
+"""
+import heapq
+import itertools
+import logging
+import os
+import sqlite3
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Полная структура цехов и профессий
+DEPARTMENTS = {
+    "Режиссерский цех": [
+        "Режиссеры-постановщики",
+        "Режиссеры анимации",
+        "Вторые режиссеры",
+        "Ассистенты второго режиссера",
+        "Ассистенты режиссера по актерам",
+        "Помощники режиссера",
+        "Бригадиры АМС",
+        "Кастинг-директора"
+    ],
+    "Звуковой цех": [
+        "Звукорежиссеры",
+        "Ассистенты звукорежиссера"
+    ],
+    "Операторский цех": [
+        "Вторые операторы",
+        "Камермены",
+        "Фокус-пуллеры",
+        "Операторы и пилоты коптеров",
+        "Осветители",
+        "Грип",
+        "Gaffer"
+    ],
+    "Художественно-постановочный цех": [
+        "Художники-постановщики",
+        "Ассистенты художника-постановщика",
+        "Декораторы",
+        "Постановщики кадра"
+    ],
+    "Художники по реквизиту": [
+        "Художники по реквизиту(ассистент режиссера по реквизиту)",
+        "Ассистенты художника по реквизиту",
+        "Реквизиторы"
+    ],
+    "Художники по гриму": [
+        "Художники по гриму",
+        "Ассистенты художника по гриму",
+        "Гримеры",
+        "Постижеры"
+    ],
+    "Художники по костюмам": [
+        "Художники по костюмам",
+        "Ассистенты художника по костюмам",
+        "Художники-фактуровщики",
+        "Костюмеры"
+    ],
+    "Актерский цех": [
+        "Исполнители ролей первого плана",
+        "Исполнители линейных ролей",
+        "Эпизодники",
+        "Дублеры",
+        "Статисты",
+        "Групповка",
+        "Актеры массовых сцен"
+    ],
+    "Продюсерский департамент": [
+        "Продюсеры кино и телевидения",
+        "Продюсеры анимации",
+        "Исполнительные продюсеры",
+        "Линейные продюсеры",
+        "Ассистенты продюсеров",
+        "Менеджеры подготовки кинообъектов (Локейшен-менеджеры)"
+    ],
+    "Административный цех": [
+        "Директора фильма",
+        "Заместители директора фильма (по подготовке, транспорту, объектам)",
+        "Инженер по охране труда",
+        "Администраторы съемочных групп и площадки",
+        "Координаторы",
+        "Рабочие",
+        "Буфет"
+    ],
+    "Транспортный цех": [
+        "Водители"
+    ],
+    "Каскадерско-пиротехнический департамент": [
+        "Постановщики трюков",
+        "Каскадеры",
+        "Пиротехники"
+    ],
+    "Цех скрипт-супервайзеров": [
+        "Скрипт-супервайзеры"
+    ],
+    "Монтажный цех": [
+        "Режиссеры монтажа",
+        "Ассистенты режиссера монтажа",
+        "Монтажеры",
+        "Логгеры"
+    ],
+    "Анимация": [
+        "Художники-постановщики анимационных фильмов",
+        "Концепт-художники",
+        "Художники персонажей",
+        "Художники по фонам",
+        "Режиссеры аниматика",
+        "Аниматикеры",
+        "Лейаут-художники",
+        "Художники-аниматоры",
+        "Прорисовщики",
+        "Заливщики",
+        "2D аниматоры (перекладка/гибридная анимация/костная)",
+        "2D риггинг",
+        "3D аниматоры",
+        "Stop-motion аниматоры",
+        "3D риггинг",
+        "Моделлеры",
+        "3D Лейаут",
+        "Компоузеры",
+        "Специалисты по свету",
+        "Рендер"
+    ]
+}
+
+EXPERIENCE_LEVELS = ["Без опыта", "До 1 года", "1-3 года", "3-5 лет", "5+ лет"]
+
+# База данных
+DB_NAME = 'cinema_collab.db'
+# Профили и избранное делятся по user_id на столько файлов, см. ShardedDatabase
+DB_SHARDS = int(os.getenv('DB_SHARDS', 1))
+
+# Сокращения городов для текстового поиска
+CITY_ALIASES = {
+    'мск': 'москва',
+    'спб': 'санкт-петербург',
+    'питер': 'санкт-петербург',
+    'екб': 'екатеринбург',
+    'нск': 'новосибирск',
+    'нн': 'нижний новгород',
+}
+
+# Профессии, записанные латиницей, находятся и по-русски
+PROFESSION_ALIASES = {
+    'гаффер': 'gaffer',
+    'стоп-моушн': 'stop-motion',
+    'стопмоушн': 'stop-motion',
+}
+
+# Ранжируются совпадения среди стольких самых новых профилей: оценка всех
+# совпадений запроса вроде «москва» стоит сотни миллисекунд
+FTS_RANK_CANDIDATES = 1000
+
+def normalize_text(text):
+    return ' '.join(text.lower().replace('ё', 'е').split())
+
+def canonical_city(text):
+    """Единое написание города: «мск», «москва » и «МОСКВА» -> «Москва»"""
+    city = normalize_text(text)
+    city = CITY_ALIASES.get(city, city)
+    return ' '.join(
+        '-'.join(part if part in ('на', 'де') else part.capitalize() for part in word.split('-'))
+        for word in city.split()
+    )
+
+def build_fts_query(text):
+    """Запрос FTS5: все слова должны встретиться, сокращения городов и русские
+    названия профессий на латинице раскрываются.
+
+    Триграммный индекс не ищет слова короче трех букв, поэтому они пропускаются,
+    если это не известное сокращение.
+    """
+    terms = []
+    for word in normalize_text(text).split():
+        word = word.replace('"', '')
+        variants = [word] if len(word) >= 3 else []
+        for aliases in (CITY_ALIASES, PROFESSION_ALIASES):
+            if word in aliases:
+                variants.append(aliases[word])
+        if variants:
+            terms.append('(' + ' OR '.join(f'"{variant}"' for variant in variants) + ')')
+    return ' AND '.join(terms)
+
+# Режим журнала и групповая запись
+DB_SYNCHRONOUS = 'NORMAL'  # OFF / NORMAL / FULL / EXTRA
+DB_BATCH_SIZE = 100  # commit не реже, чем раз в столько изменений
+DB_FLUSH_INTERVAL = 0.05  # и не реже, чем раз в столько секунд
+# Сколько ждать блокировку записи, если в базу пишет другое соединение (бот и manage.py)
+DB_BUSY_TIMEOUT = 30
+
+# Рекомендации: соседи профиля - те, кого сохраняют вместе с ним
+RECOMMENDATION_NEIGHBORS = 20  # соседей на профиль после перестроения
+RECOMMENDATION_MAX_FAVORITES = 100  # избранное больше этого не учитывается: пары растут квадратично
+RECOMMENDATION_DEPARTMENT_WEIGHT = 0.5  # надбавки за совпадение с профилем-источником
+RECOMMENDATION_PROFESSION_WEIGHT = 1.0
+RECOMMENDATION_LOCATION_WEIGHT = 0.5  # надбавка за город смотрящего
+RECOMMENDATION_CANDIDATES = 200  # популярных профилей для новичков без избранного
+RECOMMENDATION_REBUILD_INTERVAL = 6 * 60 * 60  # между перестроениями держатся инкрементальные правки
+RECOMMENDATION_MAX_SAVERS = 1000  # у популярных профилей соседи считаются по выборке сохранивших
+RECOMMENDATION_REBUILD_BATCH = 5000  # сохранений за один запрос перестроения
+
+# Отправленные совпадения сохраненных поисков хранятся, чтобы правка профиля не
+# присылала его подписчику повторно, но не дольше этого срока
+SEARCH_MATCH_RETENTION = 30 * 24 * 60 * 60
+
+# Решардинг: чьи строки меняет изменение таблицы - эти пользователи переносятся заново
+CHANGE_LOG_OWNERS = {
+    'users': ('user_id',),
+    'favorites': ('user_id', 'favorite_user_id'),
+    'profile_media': ('user_id',),
+    'saved_searches': ('user_id',),
+    'search_matches': ('user_id',),
+}
+
+# Триггеры, которые bulk_load снимает на время загрузки
+BULK_LOAD_TRIGGERS = (
+    'users_fts_insert', 'users_fts_update', 'users_fts_delete',
+    'profile_counts_insert', 'profile_counts_update', 'profile_counts_delete',
+)
+
+class Database:
+    def __init__(self, db_name=DB_NAME, synchronous=DB_SYNCHRONOUS, batch_size=DB_BATCH_SIZE):
+        if synchronous.upper() not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+            raise ValueError(f"Недопустимый режим synchronous: {synchronous}")
+        # Соединение используется из отдельного потока AsyncDatabase
+        self.conn = sqlite3.connect(db_name, check_same_thread=False)
+        # Строки доступны и по индексу, и по имени колонки
+        self.conn.row_factory = sqlite3.Row
+        self.cursor = self.conn.cursor()
+        self.cursor.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT * 1000}')
+        self.cursor.execute('PRAGMA journal_mode=WAL')
+        self.cursor.execute(f'PRAGMA synchronous={synchronous}')
+        # INSERT OR REPLACE тогда вызывает и триггеры удаления - иначе FTS и агрегаты разъедутся
+        self.cursor.execute('PRAGMA recursive_triggers = ON')
+        self.batch_size = batch_size
+        self._pending_writes = 0
+        self._migrate()
+        self._seed_lookups()
+        self.conn.commit()
+        self._load_lookups()
+        self._repair_bulk_load()
+
+    def _commit(self):
+        """Откладываем commit до накопления batch_size изменений.
+
+        Изменения выполняются сразу в открытой транзакции, поэтому
+        последующие чтения через это же соединение их видят.
+        """
+        self._pending_writes += 1
+        if self._pending_writes >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._pending_writes:
+            self.conn.commit()
+            self._pending_writes = 0
+    
+    def _file_size(self):
+        self.cursor.execute('PRAGMA page_count')
+        page_count = self.cursor.fetchone()[0]
+        self.cursor.execute('PRAGMA page_size')
+        return page_count * self.cursor.fetchone()[0]
+
+    def _migrate(self):
+        """Приводим схему к последней версии, номер версии хранится в user_version"""
+        migrations = [
+            self._migrate_initial, self._migrate_lookup_codes, self._migrate_admin, self._migrate_favorites_index,
+            self._migrate_neighbors, self._migrate_saved_searches, self._migrate_media, self._migrate_search_order,
+            self._migrate_canonical_cities,
+        ]
+        self.cursor.execute('PRAGMA user_version')
+        version = self.cursor.fetchone()[0]
+        if version >= len(migrations):
+            return
+        self.cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'users'")
+        upgrading = self.cursor.fetchone() is not None
+        size_before = self._file_size()
+        for number, migration in enumerate(migrations[version:], version + 1):
+            logger.info(f"Миграция базы до версии {number}")
+            self.conn.execute('BEGIN')
+            try:
+                migration()
+                self.cursor.execute(f'PRAGMA user_version = {number}')
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+        if upgrading:
+            self.cursor.execute('VACUUM')
+            logger.info(f"Размер базы: {size_before // 1024} КБ -> {self._file_size() // 1024} КБ")
+
+    def _migrate_initial(self):
+        """Версия 1: исходная схема со строковыми цехом, профессией и опытом"""
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            full_name TEXT,
+            department TEXT,
+            profession TEXT,
+            experience TEXT,
+            portfolio TEXT,
+            location TEXT
+        )''')
+        
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS favorites (
+            user_id INTEGER,
+            favorite_user_id INTEGER,
+            PRIMARY KEY (user_id, favorite_user_id),
+            FOREIGN KEY (user_id) REFERENCES users (user_id),
+            FOREIGN KEY (favorite_user_id) REFERENCES users (user_id)
+        )''')
+
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tracked_messages (
+            chat_id INTEGER,
+            message_id INTEGER,
+            sent_at INTEGER
+        )''')
+
+        self.cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_search
+        ON users (department, profession, experience, location)''')
+
+        self.cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'users_fts'")
+        fts_exists = self.cursor.fetchone()
+        self.cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS users_fts
+        USING fts5(full_name, profession, location, portfolio, tokenize = 'trigram')''')
+        if not fts_exists:
+            columns = ', '.join(self._fts_columns(['full_name', 'profession', 'location', 'portfolio'], prefix=''))
+            self.cursor.execute(f'''
+            INSERT INTO users_fts (rowid, full_name, profession, location, portfolio)
+            SELECT user_id, {columns} FROM users''')
+
+    def _migrate_lookup_codes(self):
+        """Версия 2: цех, профессия и опыт хранятся целыми кодами из справочников"""
+        self.cursor.execute('''
+        CREATE TABLE departments (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        )''')
+        self.cursor.execute('''
+        CREATE TABLE professions (
+            id INTEGER PRIMARY KEY,
+            department_id INTEGER NOT NULL REFERENCES departments (id),
+            name TEXT NOT NULL,
+            UNIQUE (department_id, name)
+        )''')
+        self.cursor.execute('''
+        CREATE TABLE experience_levels (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        )''')
+        self._seed_lookups()
+        # Значения, которых уже нет в DEPARTMENTS, тоже сохраняем
+        self.cursor.execute('''
+        INSERT OR IGNORE INTO departments (name)
+        SELECT DISTINCT department FROM users
+        WHERE department != ''
+        ''')
+        self.cursor.execute('''
+        INSERT OR IGNORE INTO professions (department_id, name)
+        SELECT DISTINCT d.id, u.profession FROM users u
+        JOIN departments d ON d.name = u.department
+        WHERE u.profession != ''
+        ''')
+        self.cursor.execute('''
+        INSERT OR IGNORE INTO experience_levels (name)
+        SELECT DISTINCT experience FROM users
+        WHERE experience != ''
+        ''')
+
+        self.cursor.execute('''
+        CREATE TABLE users_new (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            full_name TEXT,
+            department_id INTEGER REFERENCES departments (id),
+            profession_id INTEGER REFERENCES professions (id),
+            experience_id INTEGER REFERENCES experience_levels (id),
+            portfolio TEXT,
+            location TEXT
+        )''')
+        self.cursor.execute('''
+        INSERT INTO users_new
+        SELECT u.user_id, u.username, u.full_name, d.id, p.id, e.id, u.portfolio, u.location
+        FROM users u
+        LEFT JOIN departments d ON d.name = u.department
+        LEFT JOIN professions p ON p.department_id = d.id AND p.name = u.profession
+        LEFT JOIN experience_levels e ON e.name = u.experience''')
+        self.cursor.execute('DROP TABLE users')
+        self.cursor.execute('ALTER TABLE users_new RENAME TO users')
+        self.cursor.execute('''
+        CREATE INDEX idx_users_search
+        ON users (department_id, profession_id, experience_id, location)''')
+
+        # Чтение идет через представление с прежними колонками
+        self.cursor.execute('''
+        CREATE VIEW users_view AS
+        SELECT u.user_id, u.username, u.full_name,
+               d.name AS department, p.name AS profession, e.name AS experience,
+               u.portfolio, u.location,
+               u.department_id, u.profession_id, u.experience_id
+        FROM users u
+        LEFT JOIN departments d ON d.id = u.department_id
+        LEFT JOIN professions p ON p.id = u.profession_id
+        LEFT JOIN experience_levels e ON e.id = u.experience_id''')
+
+        self._create_fts_triggers()
+
+    def _create_fts_triggers(self):
+        columns = ', '.join(self._fts_columns(
+            ['full_name', '(SELECT name FROM professions WHERE id = new.profession_id)', 'location', 'portfolio']
+        ))
+        self.cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+            INSERT INTO users_fts (rowid, full_name, profession, location, portfolio)
+            VALUES (new.user_id, {columns});
+        END''')
+        self.cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE ON users BEGIN
+            DELETE FROM users_fts WHERE rowid = old.user_id;
+            INSERT INTO users_fts (rowid, full_name, profession, location, portfolio)
+            VALUES (new.user_id, {columns});
+        END''')
+        self.cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+            DELETE FROM users_fts WHERE rowid = old.user_id;
+        END''')
+
+    def _migrate_admin(self):
+        """Версия 3: агрегаты для статистики администраторов и задания рассылки"""
+        # Цех и профессия 0 - не указаны (NULL в первичном ключе не дал бы upsert)
+        self.cursor.execute('''
+        CREATE TABLE profile_counts (
+            department_id INTEGER,
+            profession_id INTEGER,
+            users INTEGER NOT NULL,
+            complete INTEGER NOT NULL,
+            with_portfolio INTEGER NOT NULL,
+            PRIMARY KEY (department_id, profession_id)
+        ) WITHOUT ROWID''')
+        self.cursor.execute('''
+        CREATE TABLE favorite_counts (
+            user_id INTEGER PRIMARY KEY,
+            favorited INTEGER NOT NULL
+        )''')
+        self.cursor.execute('CREATE INDEX idx_favorite_counts ON favorite_counts (favorited)')
+        self._rebuild_profile_counts()
+        self._rebuild_favorite_counts()
+        self._create_stats_triggers()
+
+        self.cursor.execute('''
+        CREATE TABLE broadcasts (
+            id INTEGER PRIMARY KEY,
+            text TEXT NOT NULL,
+            created_by INTEGER,
+            created_at INTEGER,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0
+        )''')
+
+    def _migrate_favorites_index(self):
+        """Версия 4: обратный индекс избранного и счетчик добавлений в users_view"""
+        self.cursor.execute('CREATE INDEX idx_favorites_reverse ON favorites (favorite_user_id, user_id)')
+        self.cursor.execute('DROP VIEW users_view')
+        self.cursor.execute('''
+        CREATE VIEW users_view AS
+        SELECT u.user_id, u.username, u.full_name,
+               d.name AS department, p.name AS profession, e.name AS experience,
+               u.portfolio, u.location,
+               u.department_id, u.profession_id, u.experience_id,
+               IFNULL(c.favorited, 0) AS favorited
+        FROM users u
+        LEFT JOIN departments d ON d.id = u.department_id
+        LEFT JOIN professions p ON p.id = u.profession_id
+        LEFT JOIN experience_levels e ON e.id = u.experience_id
+        LEFT JOIN favorite_counts c ON c.user_id = u.user_id''')
+
+    def _migrate_neighbors(self):
+        """Версия 5: индекс соседей для рекомендаций, заполняется rebuild_neighbors"""
+        self.cursor.execute('''
+        CREATE TABLE favorite_neighbors (
+            user_id INTEGER,
+            neighbor_id INTEGER,
+            score REAL NOT NULL,
+            PRIMARY KEY (user_id, neighbor_id)
+        ) WITHOUT ROWID''')
+
+    def _migrate_saved_searches(self):
+        """Версия 6: сохраненные поиски и найденные по ним новые профили"""
+        # Уникальный ключ начинается с полей профиля и служит обратным индексом:
+        # по цеху, профессии, городу и опыту профиля сразу находятся подписчики.
+        # 0 в experience_id и '' в location - «любой»
+        self.cursor.execute('''
+        CREATE TABLE saved_searches (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            department_id INTEGER NOT NULL,
+            profession_id INTEGER NOT NULL,
+            experience_id INTEGER NOT NULL DEFAULT 0,
+            location TEXT NOT NULL DEFAULT '',
+            created_at INTEGER,
+            UNIQUE (department_id, profession_id, location, experience_id, user_id)
+        )''')
+        self.cursor.execute('CREATE INDEX idx_saved_searches_user ON saved_searches (user_id)')
+        # Один профиль попадает в сводку подписчика один раз, даже если совпал с несколькими поисками
+        self.cursor.execute('''
+        CREATE TABLE search_matches (
+            user_id INTEGER,
+            profile_id INTEGER,
+            search_id INTEGER,
+            created_at INTEGER,
+            notified_at INTEGER,
+            PRIMARY KEY (user_id, profile_id)
+        ) WITHOUT ROWID''')
+        self.cursor.execute('''
+        CREATE INDEX idx_search_matches_pending ON search_matches (user_id, created_at)
+        WHERE notified_at IS NULL''')
+
+    def _migrate_media(self):
+        """Версия 7: фото и видео портфолио и их число в users_view"""
+        # Файлы уже лежат на серверах Telegram: храним только file_id, по одной
+        # записи на file_unique_id, сколько бы профилей на файл ни ссылалось
+        self.cursor.execute('''
+        CREATE TABLE media (
+            id INTEGER PRIMARY KEY,
+            file_unique_id TEXT NOT NULL UNIQUE,
+            file_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            created_at INTEGER
+        )''')
+        self.cursor.execute('''
+        CREATE TABLE profile_media (
+            user_id INTEGER,
+            position INTEGER,
+            media_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, position)
+        ) WITHOUT ROWID''')
+        self.cursor.execute('CREATE INDEX idx_profile_media_media ON profile_media (media_id)')
+        self.cursor.execute('DROP VIEW users_view')
+        self.cursor.execute('''
+        CREATE VIEW users_view AS
+        SELECT u.user_id, u.username, u.full_name,
+               d.name AS department, p.name AS profession, e.name AS experience,
+               u.portfolio, u.location,
+               u.department_id, u.profession_id, u.experience_id,
+               IFNULL(c.favorited, 0) AS favorited,
+               (SELECT COUNT(*) FROM profile_media m WHERE m.user_id = u.user_id) AS media
+        FROM users u
+        LEFT JOIN departments d ON d.id = u.department_id
+        LEFT JOIN professions p ON p.id = u.profession_id
+        LEFT JOIN experience_levels e ON e.id = u.experience_id
+        LEFT JOIN favorite_counts c ON c.user_id = u.user_id''')
+
+    def _migrate_search_order(self):
+        """Версия 8: индекс для поиска без опыта и города в порядке user_id"""
+        # В idx_users_search за профессией идут опыт и город, поэтому при «Любой опыт»
+        # страница собиралась из всех совпадений и сортировалась целиком
+        self.cursor.execute('''
+        CREATE INDEX idx_users_profession
+        ON users (department_id, profession_id, user_id)''')
+
+    def _migrate_canonical_cities(self):
+        """Версия 9: города, сохраненные до canonical_city, приводятся к единому написанию"""
+        # Кнопки городов строятся по сохраненным значениям, а выбранный город ищется
+        # через canonical_city: профиль с «мск» давал кнопку «мск (1)» и пустой поиск
+        self.conn.create_function('canonical_city', 1, canonical_city, deterministic=True)
+        self.cursor.execute('''
+        UPDATE users SET location = canonical_city(location)
+        WHERE location IS NOT NULL AND location != canonical_city(location)''')
+
+    @staticmethod
+    def _profile_flags(prefix=''):
+        """Выражения «профиль заполнен» и «есть портфолио» для строки users"""
+        complete = (f"({prefix}department_id IS NOT NULL AND {prefix}profession_id IS NOT NULL "
+                    f"AND {prefix}experience_id IS NOT NULL AND IFNULL({prefix}location, '') != '')")
+        return complete, f"(IFNULL({prefix}portfolio, '') != '')"
+
+    def _rebuild_profile_counts(self):
+        complete, portfolio = self._profile_flags()
+        self.cursor.execute('DELETE FROM profile_counts')
+        self.cursor.execute(f'''
+        INSERT INTO profile_counts
+        SELECT IFNULL(department_id, 0), IFNULL(profession_id, 0), COUNT(*), SUM({complete}), SUM({portfolio})
+        FROM users GROUP BY 1, 2''')
+
+    def _rebuild_favorite_counts(self):
+        self.cursor.execute('DELETE FROM favorite_counts')
+        self.cursor.execute('''
+        INSERT INTO favorite_counts
+        SELECT favorite_user_id, COUNT(*) FROM favorites GROUP BY favorite_user_id''')
+
+    def _create_stats_triggers(self):
+        def change(prefix, sign):
+            complete, portfolio = self._profile_flags(prefix)
+            return f'''
+            INSERT INTO profile_counts (department_id, profession_id, users, complete, with_portfolio)
+            VALUES (IFNULL({prefix}department_id, 0), IFNULL({prefix}profession_id, 0), {sign}1, {sign}{complete}, {sign}{portfolio})
+            ON CONFLICT (department_id, profession_id) DO UPDATE SET
+                users = users + excluded.users,
+                complete = complete + excluded.complete,
+                with_portfolio = with_portfolio + excluded.with_portfolio;'''
+
+        self.cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS profile_counts_insert AFTER INSERT ON users BEGIN
+            {change('new.', '+')}
+        END''')
+        self.cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS profile_counts_update
+        AFTER UPDATE OF department_id, profession_id, experience_id, portfolio, location ON users BEGIN
+            {change('old.', '-')}
+            {change('new.', '+')}
+        END''')
+        self.cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS profile_counts_delete AFTER DELETE ON users BEGIN
+            {change('old.', '-')}
+        END''')
+        self.cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS favorite_counts_insert AFTER INSERT ON favorites BEGIN
+            INSERT INTO favorite_counts (user_id, favorited) VALUES (new.favorite_user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET favorited = favorited + 1;
+        END''')
+        self.cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS favorite_counts_delete AFTER DELETE ON favorites BEGIN
+            UPDATE favorite_counts SET favorited = favorited - 1 WHERE user_id = old.favorite_user_id;
+            DELETE FROM favorite_counts WHERE user_id = old.favorite_user_id AND favorited <= 0;
+        END''')
+
+    @contextmanager
+    def bulk_load(self):
+        """Массовая загрузка профилей.
+
+        Построчное обновление FTS и агрегатов через триггеры в несколько раз
+        медленнее самой вставки, поэтому на время загрузки триггеры снимаются,
+        а индекс и агрегаты потом строятся заново одним запросом.
+
+        Пока идет загрузка, работающий бот ищет по прежнему индексу: новые и
+        измененные за это время профили появятся в текстовом поиске и /stats
+        после перестроения. Перестроение - одна транзакция, поэтому пустого
+        индекса бот не видит.
+        """
+        self.flush()
+        for trigger in BULK_LOAD_TRIGGERS:
+            self.cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+        self.conn.commit()
+        try:
+            yield self
+        finally:
+            self.flush()
+            self._rebuild_after_bulk_load()
+
+    def _rebuild_after_bulk_load(self):
+        """FTS, агрегаты профилей и снятые на время загрузки триггеры"""
+        # Явная транзакция: без нее DROP и CREATE выполнились бы в автокоммите,
+        # и читатели увидели бы пустой индекс на все время перестроения
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.cursor.execute('DROP TABLE IF EXISTS users_fts')
+            self.cursor.execute('''
+            CREATE VIRTUAL TABLE users_fts
+            USING fts5(full_name, profession, location, portfolio, tokenize = 'trigram')''')
+            columns = ', '.join(self._fts_columns(['full_name', 'profession', 'location', 'portfolio'], prefix=''))
+            self.cursor.execute(f'''
+            INSERT INTO users_fts (rowid, full_name, profession, location, portfolio)
+            SELECT user_id, {columns} FROM users_view''')
+            self._rebuild_profile_counts()
+            self._create_fts_triggers()
+            self._create_stats_triggers()
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def _repair_bulk_load(self):
+        """Достраиваем то, что не успел bulk_load, если процесс загрузки был убит"""
+        placeholders = ', '.join('?' * len(BULK_LOAD_TRIGGERS))
+        self.cursor.execute(f'''
+        SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name IN ({placeholders})''',
+        BULK_LOAD_TRIGGERS)
+        if self.cursor.fetchone()[0] < len(BULK_LOAD_TRIGGERS):
+            logger.warning("Массовая загрузка не завершилась: перестраиваем поиск и агрегаты профилей")
+            self._rebuild_after_bulk_load()
+
+    @staticmethod
+    def _fts_columns(columns, prefix='new.'):
+        # Регистр триграммы игнорируют сами, ё приводим к е
+        return [
+            f"replace(replace({column if column.startswith('(') else prefix + column}, 'ё', 'е'), 'Ё', 'Е')"
+            for column in columns
+        ]
+
+    def _seed_lookups(self):
+        """Добавляем в справочники новые цеха, профессии и уровни опыта"""
+        self.cursor.executemany('INSERT OR IGNORE INTO departments (name) VALUES (?)',
+                                ((department,) for department in DEPARTMENTS))
+        self.cursor.executemany('''
+        INSERT OR IGNORE INTO professions (department_id, name)
+        SELECT id, ? FROM departments WHERE name = ?''',
+        ((profession, department) for department, professions in DEPARTMENTS.items() for profession in professions))
+        self.cursor.executemany('INSERT OR IGNORE INTO experience_levels (name) VALUES (?)',
+                                ((level,) for level in EXPERIENCE_LEVELS))
+
+    def _load_lookups(self):
+        self.cursor.execute('SELECT id, name FROM departments')
+        self.department_ids = {name: id for id, name in self.cursor.fetchall()}
+        self.cursor.execute('SELECT id, department_id, name FROM professions')
+        self.profession_ids = {(department_id, name): id for id, department_id, name in self.cursor.fetchall()}
+        self.cursor.execute('SELECT id, name FROM experience_levels')
+        self.experience_ids = {name: id for id, name in self.cursor.fetchall()}
+        self._names = {
+            'department': {id: name for name, id in self.department_ids.items()},
+            'profession': {id: name for (_, name), id in self.profession_ids.items()},
+            'experience': {id: name for name, id in self.experience_ids.items()},
+        }
+
+    def _encode(self, fields, strict=False):
+        """Названия цеха, профессии и опыта -> колонки с кодами справочников.
+
+        Неизвестное название при поиске дает код -1 (ничего не найдется),
+        а при записи (strict) - ValueError.
+        """
+        encoded = {}
+        department_id = self.department_ids.get(fields.get('department'))
+        for key, value in fields.items():
+            if key == 'department':
+                code = department_id
+            elif key == 'profession':
+                if 'department' not in fields:
+                    raise ValueError("Профессия задается только вместе с цехом")
+                code = self.profession_ids.get((department_id, value))
+            elif key == 'experience':
+                code = self.experience_ids.get(value)
+            else:
+                encoded[key] = value
+                continue
+            if code is None and value is not None:
+                if strict:
+                    raise ValueError(f"Неизвестное значение {key}: {value}")
+                code = -1
+            encoded[f'{key}_id'] = code
+        return encoded
+
+    def add_user(self, user_id, username, full_name):
+        self.cursor.execute('''
+        INSERT OR IGNORE INTO users (user_id, username, full_name) 
+        VALUES (?, ?, ?)''', (user_id, username, full_name))
+        # Повторный /start ничего не меняет - commit не нужен
+        if self.cursor.rowcount:
+            self._commit()
+    
+    def add_profiles(self, profiles):
+        """Вставка или замена готовых профилей (словари с колонками users) одним executemany"""
+        columns = ('user_id', 'username', 'full_name', 'department_id', 'profession_id',
+                   'experience_id', 'portfolio', 'location')
+        self.cursor.executemany(
+            f'INSERT OR REPLACE INTO users ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})',
+            (tuple(encoded.get(column) for column in columns)
+             for encoded in (self._encode(profile, strict=True) for profile in profiles))
+        )
+        self._commit()
+
+    def update_profile(self, user_id, **kwargs):
+        kwargs = self._encode(kwargs, strict=True)
+        set_clause = ', '.join([f"{key} = ?" for key in kwargs.keys()])
+        values = list(kwargs.values()) + [user_id]
+        self.cursor.execute(f'''
+        UPDATE users SET {set_clause} WHERE user_id = ?''', values)
+        if kwargs.keys() & {'department_id', 'profession_id', 'experience_id', 'location'}:
+            self._match_saved_searches(user_id)
+        self._commit()
+
+    def _match_saved_searches(self, user_id):
+        """Заполненный профиль -> в очередь сводок всех, чей сохраненный поиск он подходит.
+
+        Один поиск по уникальному ключу saved_searches, сколько бы поисков ни было сохранено.
+        """
+        complete, _ = self._profile_flags('u.')
+        self.cursor.execute(f'''
+        INSERT OR IGNORE INTO search_matches (user_id, profile_id, search_id, created_at)
+        SELECT s.user_id, u.user_id, s.id, ? FROM users u
+        JOIN saved_searches s ON s.department_id = u.department_id AND s.profession_id = u.profession_id
+        AND s.location IN (u.location, '') AND s.experience_id IN (u.experience_id, 0)
+        WHERE u.user_id = ? AND {complete} AND s.user_id != u.user_id''', (int(time.time()), user_id))
+    
+    def delete_user(self, user_id):
+        # Два запроса вместо OR: первый идет по первичному ключу, второй по обратному индексу
+        self.cursor.execute('DELETE FROM favorites WHERE user_id = ?', (user_id,))
+        self.cursor.execute('DELETE FROM favorites WHERE favorite_user_id = ?', (user_id,))
+        self.cursor.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
+        # Чужие записи о нем отсеет join с users_view, их уберет перестроение
+        self.cursor.execute('DELETE FROM favorite_neighbors WHERE user_id = ?', (user_id,))
+        self.cursor.execute('DELETE FROM saved_searches WHERE user_id = ?', (user_id,))
+        self.cursor.execute('DELETE FROM search_matches WHERE user_id = ?', (user_id,))
+        self._replace_profile_media(user_id, [])
+        self._commit()
+    
+    def get_user(self, user_id):
+        self.cursor.execute('SELECT * FROM users_view WHERE user_id = ?', (user_id,))
+        return self.cursor.fetchone()
+
+    def get_users(self, user_ids):
+        """Профили по списку user_id одним запросом, {user_id: row}"""
+        placeholders = ', '.join('?' * len(user_ids))
+        self.cursor.execute(f'SELECT * FROM users_view WHERE user_id IN ({placeholders})', list(user_ids))
+        return {row['user_id']: row for row in self.cursor.fetchall()}
+    
+    def search_users(self, **filters):
+        filters = self._encode(filters)
+        where_clause = ' AND '.join([f"{key} = ?" for key in filters.keys()]) if filters else '1'
+        query = f'SELECT * FROM users_view WHERE {where_clause}'
+        self.cursor.execute(query, list(filters.values()))
+        return self.cursor.fetchall()
+    
+    def count_users(self, **filters):
+        filters = self._encode(filters)
+        where_clause = ' AND '.join([f"{key} = ?" for key in filters.keys()]) if filters else '1'
+        self.cursor.execute(f'SELECT COUNT(*) FROM users WHERE {where_clause}', list(filters.values()))
+        return self.cursor.fetchone()[0]
+
+    def facet_counts(self, column, limit=None, **filters):
+        """Количество профилей по значениям column среди подходящих под filters.
+
+        Считается по индексу idx_users_search, без чтения самой таблицы.
+        """
+        filters = self._encode(filters)
+        names = self._names.get(column)
+        code_column = f'{column}_id' if names is not None else column
+        where_clause = ' AND '.join([f"{key} = ?" for key in filters.keys()]) if filters else '1'
+        query = f'''
+        SELECT {code_column}, COUNT(*) FROM users
+        WHERE {where_clause} AND {code_column} IS NOT NULL AND {code_column} != ''
+        GROUP BY {code_column} ORDER BY COUNT(*) DESC'''
+        values = list(filters.values())
+        if limit:
+            query += ' LIMIT ?'
+            values.append(limit)
+        self.cursor.execute(query, values)
+        if names is None:
+            return [tuple(row) for row in self.cursor.fetchall()]
+        return [(names[code], count) for code, count in self.cursor.fetchall() if code in names]
+
+    def search_users_page(self, after=None, before=None, limit=10, viewer_id=None, **filters):
+        """Страница результатов поиска с keyset-пагинацией по user_id.
+
+        after - вернуть страницу после этого user_id, before - перед ним.
+        Последняя колонка каждой строки - is_favorite для viewer_id.
+        Возвращает (rows, has_prev, has_next), rows упорядочены по user_id.
+        """
+        filters = self._encode(filters)
+        conditions = [f"u.{key} = ?" for key in filters.keys()]
+        values = list(filters.values())
+        if before is not None:
+            conditions.append('u.user_id < ?')
+            values.append(before)
+            order = 'DESC'
+        else:
+            if after is not None:
+                conditions.append('u.user_id > ?')
+                values.append(after)
+            order = 'ASC'
+        where_clause = ' AND '.join(conditions) if conditions else '1'
+        # Страница выбирается по индексу из одной users, представление и избранное
+        # читаются только для ее строк. Берем на одну запись больше, чтобы понять,
+        # есть ли следующая страница
+        self.cursor.execute(f'''
+        WITH page AS MATERIALIZED (
+            SELECT user_id FROM users u WHERE {where_clause}
+            ORDER BY user_id {order} LIMIT ?
+        )
+        SELECT u.*, f.user_id IS NOT NULL AS is_favorite FROM page
+        JOIN users_view u ON u.user_id = page.user_id
+        LEFT JOIN favorites f ON f.user_id = ? AND f.favorite_user_id = u.user_id
+        ORDER BY u.user_id {order}''', values + [limit + 1, viewer_id])
+        rows = self.cursor.fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if before is not None:
+            rows.reverse()
+            return rows, has_more, True
+        return rows, after is not None, has_more
+
+    def search_text(self, query, limit=10, offset=0, viewer_id=None):
+        """Поиск по имени, профессии, городу и портфолио, лучшие совпадения первыми.
+
+        Ранжируются только совпадения среди FTS_RANK_CANDIDATES самых новых
+        профилей. Возвращает (rows, has_next, partial), где partial - совпадений
+        больше, чем ранжировалось, или ([], False, False), если в запросе нет
+        слов длиннее двух букв.
+        """
+        match = build_fts_query(query)
+        if not match:
+            return [], False, False
+        # Кандидатов берем на одного больше, чтобы узнать, что выдача неполная
+        self.cursor.execute('''
+        SELECT u.*, f.user_id IS NOT NULL AS is_favorite, m.rank, m.candidates FROM (
+            SELECT rowid, rank, COUNT(*) OVER () AS candidates FROM (
+                SELECT rowid, rank FROM users_fts WHERE users_fts MATCH ? ORDER BY rowid DESC LIMIT ?
+            )
+        ) AS m
+        JOIN users_view u ON u.user_id = m.rowid
+        LEFT JOIN favorites f ON f.user_id = ? AND f.favorite_user_id = u.user_id
+        ORDER BY m.rank LIMIT ? OFFSET ?''', (match, FTS_RANK_CANDIDATES + 1, viewer_id, limit + 1, offset))
+        rows = self.cursor.fetchall()
+        partial = bool(rows) and rows[0]['candidates'] > FTS_RANK_CANDIDATES
+        return rows[:limit], len(rows) > limit, partial
+
+    def search_text_ids(self, query, limit=FTS_RANK_CANDIDATES):
+        """Только user_id лучших совпадений текстового поиска, для кэширования списком"""
+        return [user_id for _, user_id in self.search_text_ranks(query, limit)]
+
+    def search_text_ranks(self, query, limit=FTS_RANK_CANDIDATES):
+        """[(rank, user_id)] лучших совпадений среди самых новых профилей, лучшие первыми"""
+        match = build_fts_query(query)
+        if not match:
+            return []
+        self.cursor.execute('''
+        SELECT rank, rowid FROM (
+            SELECT rowid, rank FROM users_fts WHERE users_fts MATCH ? ORDER BY rowid DESC LIMIT ?
+        ) ORDER BY rank LIMIT ?''', (match, FTS_RANK_CANDIDATES, limit))
+        return [tuple(row) for row in self.cursor.fetchall()]
+
+    def add_favorite(self, user_id, favorite_user_id):
+        self.cursor.execute('''
+        INSERT OR IGNORE INTO favorites (user_id, favorite_user_id) 
+        VALUES (?, ?)''', (user_id, favorite_user_id))
+        if self.cursor.rowcount:
+            self._update_neighbors(user_id, favorite_user_id, 1)
+        self._commit()
+    
+    def add_favorites(self, pairs):
+        """Пакетное добавление пар (user_id, favorite_user_id)"""
+        self.cursor.executemany('INSERT OR IGNORE INTO favorites (user_id, favorite_user_id) VALUES (?, ?)', pairs)
+        self._commit()
+
+    def iter_profiles(self):
+        """Все профили по порядку user_id, без загрузки в память целиком"""
+        cursor = self.conn.execute('''
+        SELECT user_id, username, full_name, department, profession, experience, portfolio, location
+        FROM users_view ORDER BY user_id''')
+        yield from cursor
+
+    def iter_favorites(self):
+        yield from self.conn.execute('SELECT user_id, favorite_user_id FROM favorites ORDER BY user_id')
+
+    def get_favorites_between(self, shards, owner_shard, favorite_shard):
+        """Пары избранного из шарда owner_shard в шард favorite_shard при делении user_id на shards"""
+        self.cursor.execute('''
+        SELECT user_id, favorite_user_id FROM favorites
+        WHERE user_id % ? = ? AND favorite_user_id % ? = ?''', (shards, owner_shard, shards, favorite_shard))
+        return {tuple(row) for row in self.cursor.fetchall()}
+
+    def remove_favorite(self, user_id, favorite_user_id):
+        self.cursor.execute('''
+        DELETE FROM favorites WHERE user_id = ? AND favorite_user_id = ?''', 
+        (user_id, favorite_user_id))
+        if self.cursor.rowcount:
+            self._update_neighbors(user_id, favorite_user_id, -1)
+        self._commit()
+
+    @staticmethod
+    def _neighbor_weight(a, b):
+        """Вес пары профилей a и b: совпадение цеха и профессии усиливает связь"""
+        return (f"(1 + {RECOMMENDATION_DEPARTMENT_WEIGHT} * IFNULL({a}.department_id = {b}.department_id, 0)"
+                f" + {RECOMMENDATION_PROFESSION_WEIGHT} * IFNULL({a}.profession_id = {b}.profession_id, 0))")
+
+    def _update_neighbors(self, user_id, favorite_user_id, sign):
+        """Правка соседей после добавления (sign=1) или удаления (sign=-1) одной пары.
+
+        Новые пары добавляются сверх RECOMMENDATION_NEIGHBORS, лишнее
+        отрежет следующее перестроение. Соседей популярных профилей
+        перестроение считает по выборке, поэтому здесь они не трогаются.
+        """
+        # Как и при перестроении, большое избранное не учитывается вовсе
+        self.cursor.execute('SELECT COUNT(*) FROM favorites WHERE user_id = ?', (user_id,))
+        favorites_before = self.cursor.fetchone()[0] - (sign > 0)
+        if favorites_before + 1 > RECOMMENDATION_MAX_FAVORITES:
+            return
+        self.cursor.execute(f'''
+        INSERT INTO favorite_neighbors (user_id, neighbor_id, score)
+        SELECT pair.user_id, pair.neighbor_id, {sign} * {self._neighbor_weight('x', 'y')}
+        FROM (
+            SELECT ? AS user_id, favorite_user_id AS neighbor_id FROM favorites WHERE user_id = ? AND favorite_user_id != ?
+            UNION ALL
+            SELECT favorite_user_id, ? FROM favorites WHERE user_id = ? AND favorite_user_id != ?
+        ) pair
+        JOIN users x ON x.user_id = pair.user_id
+        JOIN users y ON y.user_id = pair.neighbor_id
+        LEFT JOIN favorite_counts c ON c.user_id = pair.user_id
+        WHERE IFNULL(c.favorited, 0) <= ?
+        ON CONFLICT (user_id, neighbor_id) DO UPDATE SET score = score + excluded.score''',
+        (favorite_user_id, user_id, favorite_user_id) * 2 + (RECOMMENDATION_MAX_SAVERS,))
+        if sign < 0:
+            self.cursor.execute('''
+            DELETE FROM favorite_neighbors WHERE user_id = ? AND score <= 0''', (favorite_user_id,))
+            self.cursor.execute('''
+            DELETE FROM favorite_neighbors
+            WHERE user_id IN (SELECT favorite_user_id FROM favorites WHERE user_id = ?)
+            AND neighbor_id = ? AND score <= 0''', (user_id, favorite_user_id))
+
+    def rebuild_neighbors(self, after=0, limit=RECOMMENDATION_REBUILD_BATCH):
+        """Перестроение соседей для профилей с user_id > after, не больше limit сохранений за вызов.
+
+        Пары считаются через обратный индекс избранного: кто сохранил профиль
+        и что еще сохранил этот человек. У популярных профилей берутся только
+        первые RECOMMENDATION_MAX_SAVERS сохранивших. Возвращает последний
+        обработанный user_id или None, если профили кончились. Между вызовами
+        база свободна для остальных запросов.
+        """
+        self.cursor.execute('''
+        SELECT user_id, favorited FROM favorite_counts WHERE user_id > ? ORDER BY user_id LIMIT ?''', (after, limit))
+        last, savers = None, 0
+        for user_id, favorited in self.cursor.fetchall():
+            if last is not None and savers + min(favorited, RECOMMENDATION_MAX_SAVERS) > limit:
+                break
+            last = user_id
+            savers += min(favorited, RECOMMENDATION_MAX_SAVERS)
+        # Профилей без избранного нет в favorite_counts, их старых соседей тоже убираем
+        self.cursor.execute('''
+        DELETE FROM favorite_neighbors WHERE user_id > ? AND (? IS NULL OR user_id <= ?)''', (after, last, last))
+        if last is None:
+            self._commit()
+            return None
+        self.cursor.execute(f'''
+        WITH sample AS MATERIALIZED (
+            SELECT user_id, IFNULL((
+                SELECT s.user_id FROM favorites s WHERE s.favorite_user_id = c.user_id
+                ORDER BY s.user_id LIMIT 1 OFFSET ?
+            ), -1) AS last_saver
+            FROM favorite_counts c WHERE c.user_id > ? AND c.user_id <= ?
+        )
+        INSERT INTO favorite_neighbors (user_id, neighbor_id, score)
+        SELECT user_id, neighbor_id, score FROM (
+            SELECT user_id, neighbor_id, score,
+                   ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY score DESC, neighbor_id) AS place
+            FROM (
+                SELECT a.favorite_user_id AS user_id, b.favorite_user_id AS neighbor_id,
+                       COUNT(*) * {self._neighbor_weight('x', 'y')} AS score
+                FROM sample
+                JOIN favorites a ON a.favorite_user_id = sample.user_id
+                JOIN favorites b ON b.user_id = a.user_id AND b.favorite_user_id != a.favorite_user_id
+                JOIN users x ON x.user_id = a.favorite_user_id
+                JOIN users y ON y.user_id = b.favorite_user_id
+                WHERE (sample.last_saver = -1 OR a.user_id < sample.last_saver)
+                AND (SELECT COUNT(*) FROM favorites c WHERE c.user_id = a.user_id) <= ?
+                GROUP BY a.favorite_user_id, b.favorite_user_id
+            )
+        )
+        WHERE place <= ?''', (RECOMMENDATION_MAX_SAVERS, after, last, RECOMMENDATION_MAX_FAVORITES,
+                                 RECOMMENDATION_NEIGHBORS))
+        self._commit()
+        return last
+
+    def get_recommendations(self, user_id, limit=5):
+        """Соседи профилей из избранного, кроме уже сохраненных.
+
+        Без избранного - популярные профили. В обоих случаях профили из
+        города смотрящего поднимаются выше.
+        """
+        self.cursor.execute('SELECT location FROM users WHERE user_id = ?', (user_id,))
+        row = self.cursor.fetchone()
+        location = row[0] if row else None
+        return (self.get_neighbor_recommendations(user_id, location, limit)
+                or self.get_popular_recommendations(user_id, location, limit))
+
+    def get_neighbor_recommendations(self, user_id, location, limit=5):
+        """Соседи профилей из избранного; score - вес с надбавкой за город location"""
+        boost = f"(1 + {RECOMMENDATION_LOCATION_WEIGHT} * IFNULL(u.location = ?, 0))"
+        self.cursor.execute(f'''
+        SELECT u.*, 0 AS is_favorite, r.score * {boost} AS score FROM (
+            SELECT n.neighbor_id, SUM(n.score) AS score FROM favorites f
+            JOIN favorite_neighbors n ON n.user_id = f.favorite_user_id
+            WHERE f.user_id = ? AND n.neighbor_id != ?
+            GROUP BY n.neighbor_id
+        ) r
+        JOIN users_view u ON u.user_id = r.neighbor_id
+        WHERE NOT EXISTS (SELECT 1 FROM favorites x WHERE x.user_id = ? AND x.favorite_user_id = r.neighbor_id)
+        ORDER BY score DESC LIMIT ?''', (location, user_id, user_id, user_id, limit))
+        return self.cursor.fetchall()
+
+    def get_popular_recommendations(self, user_id, location, limit=5):
+        """Популярные профили, кроме уже сохраненных; score - как в get_neighbor_recommendations"""
+        boost = f"(1 + {RECOMMENDATION_LOCATION_WEIGHT} * IFNULL(u.location = ?, 0))"
+        self.cursor.execute(f'''
+        SELECT u.*, 0 AS is_favorite, c.favorited * {boost} AS score FROM (
+            SELECT user_id, favorited FROM favorite_counts counts
+            WHERE EXISTS (SELECT 1 FROM users WHERE user_id = counts.user_id)
+            ORDER BY favorited DESC LIMIT ?
+        ) c
+        JOIN users_view u ON u.user_id = c.user_id
+        WHERE c.user_id != ?
+        AND NOT EXISTS (SELECT 1 FROM favorites x WHERE x.user_id = ? AND x.favorite_user_id = c.user_id)
+        ORDER BY score DESC LIMIT ?''',
+        (location, RECOMMENDATION_CANDIDATES, user_id, user_id, limit))
+        return self.cursor.fetchall()
+
+    def get_favorites(self, user_id):
+        self.cursor.execute('''
+        SELECT u.* FROM users_view u
+        JOIN favorites f ON u.user_id = f.favorite_user_id
+        WHERE f.user_id = ?''', (user_id,))
+        return self.cursor.fetchall()
+    
+    def profile_stats(self):
+        """(цех, профессия, профилей, заполнено, с портфолио) из агрегатов, без обхода users"""
+        self.cursor.execute('''
+        SELECT department_id, profession_id, users, complete, with_portfolio
+        FROM profile_counts WHERE users > 0''')
+        return [
+            (self._names['department'].get(department_id), self._names['profession'].get(profession_id),
+             users, complete, with_portfolio)
+            for department_id, profession_id, users, complete, with_portfolio in self.cursor.fetchall()
+        ]
+
+    def count_profiles(self):
+        """Всего профилей по агрегатам profile_counts, без обхода users"""
+        self.cursor.execute('SELECT IFNULL(SUM(users), 0) FROM profile_counts')
+        return self.cursor.fetchone()[0]
+
+    def top_favorited(self, limit=10):
+        self.cursor.execute('''
+        SELECT u.* FROM favorite_counts c
+        JOIN users_view u ON u.user_id = c.user_id
+        ORDER BY c.favorited DESC LIMIT ?''', (limit,))
+        return self.cursor.fetchall()
+
+    def create_broadcast(self, text, created_by):
+        self.cursor.execute('''
+        INSERT INTO broadcasts (text, created_by, created_at) VALUES (?, ?, ?)''',
+        (text, created_by, int(time.time())))
+        self._commit()
+        return self.cursor.lastrowid
+
+    def get_broadcast(self, broadcast_id):
+        self.cursor.execute('SELECT * FROM broadcasts WHERE id = ?', (broadcast_id,))
+        return self.cursor.fetchone()
+
+    def get_running_broadcasts(self):
+        self.cursor.execute("SELECT * FROM broadcasts WHERE status = 'running' ORDER BY id")
+        return self.cursor.fetchall()
+
+    def get_user_ids_page(self, after, limit):
+        """Следующие limit пользователей после after по порядку user_id"""
+        self.cursor.execute('SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?', (after, limit))
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def get_broadcast_recipients(self, after, limit):
+        """Следующие получатели рассылки: пока это все пользователи по порядку user_id"""
+        return self.get_user_ids_page(after, limit)
+
+    def update_broadcast(self, broadcast_id, status=None, **progress):
+        """Прогресс рассылки: last_user_id, sent, failed"""
+        if status is not None:
+            progress['status'] = status
+        set_clause = ', '.join([f"{key} = ?" for key in progress.keys()])
+        self.cursor.execute(f'UPDATE broadcasts SET {set_clause} WHERE id = ?', list(progress.values()) + [broadcast_id])
+        self._commit()
+
+    def get_admirers(self, user_id, limit=None):
+        """Кто добавил user_id в избранное; is_favorite - добавлен ли он в ответ"""
+        self.cursor.execute('''
+        SELECT u.*, back.user_id IS NOT NULL AS is_favorite FROM favorites f
+        JOIN users_view u ON u.user_id = f.user_id
+        LEFT JOIN favorites back ON back.user_id = f.favorite_user_id AND back.favorite_user_id = f.user_id
+        WHERE f.favorite_user_id = ?
+        ORDER BY f.user_id LIMIT ?''', (user_id, limit if limit is not None else -1))
+        return self.cursor.fetchall()
+
+    def get_mutual_favorites(self, user_id, limit=None):
+        """Профили, которые user_id добавил в избранное и которые добавили его"""
+        self.cursor.execute('''
+        SELECT u.* FROM favorites f
+        JOIN favorites back ON back.user_id = f.favorite_user_id AND back.favorite_user_id = f.user_id
+        JOIN users_view u ON u.user_id = f.favorite_user_id
+        WHERE f.user_id = ?
+        ORDER BY f.favorite_user_id LIMIT ?''', (user_id, limit if limit is not None else -1))
+        return self.cursor.fetchall()
+
+    def count_mutual_favorites(self, user_id):
+        self.cursor.execute('''
+        SELECT COUNT(*) FROM favorites f
+        JOIN favorites back ON back.user_id = f.favorite_user_id AND back.favorite_user_id = f.user_id
+        WHERE f.user_id = ?''', (user_id,))
+        return self.cursor.fetchone()[0]
+
+    def _replace_profile_media(self, user_id, items):
+        self.cursor.execute('SELECT media_id FROM profile_media WHERE user_id = ?', (user_id,))
+        old_ids = [row[0] for row in self.cursor.fetchall()]
+        self.cursor.execute('DELETE FROM profile_media WHERE user_id = ?', (user_id,))
+        now = int(time.time())
+        for position, (kind, file_id, file_unique_id) in enumerate(items):
+            # Тот же файл, присланный заново, получает свежий file_id, но не новую запись
+            self.cursor.execute('''
+            INSERT INTO media (file_unique_id, file_id, kind, created_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (file_unique_id) DO UPDATE SET file_id = excluded.file_id''',
+            (file_unique_id, file_id, kind, now))
+            self.cursor.execute('SELECT id FROM media WHERE file_unique_id = ?', (file_unique_id,))
+            self.cursor.execute('''
+            INSERT OR IGNORE INTO profile_media (user_id, position, media_id) VALUES (?, ?, ?)''',
+            (user_id, position, self.cursor.fetchone()[0]))
+        # Файлы, на которые больше никто не ссылается, не храним
+        self.cursor.executemany('''
+        DELETE FROM media WHERE id = ? AND NOT EXISTS (SELECT 1 FROM profile_media WHERE media_id = ?)''',
+        [(media_id, media_id) for media_id in old_ids])
+
+    def set_profile_media(self, user_id, items):
+        """Фото и видео профиля по порядку: [(kind, file_id, file_unique_id)], [] - удалить все"""
+        self._replace_profile_media(user_id, items)
+        self._commit()
+
+    def get_profile_media(self, user_id):
+        self.cursor.execute('''
+        SELECT m.kind, m.file_id FROM profile_media pm
+        JOIN media m ON m.id = pm.media_id
+        WHERE pm.user_id = ? ORDER BY pm.position''', (user_id,))
+        return self.cursor.fetchall()
+
+    def save_search(self, user_id, department, profession, experience=None, location=None):
+        """Сохраняем поиск; None, если такой уже есть"""
+        fields = self._encode({'department': department, 'profession': profession, 'experience': experience},
+                              strict=True)
+        self.cursor.execute('''
+        INSERT OR IGNORE INTO saved_searches (user_id, department_id, profession_id, experience_id, location, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)''', (user_id, fields['department_id'], fields['profession_id'],
+                                      fields['experience_id'] or 0, location or '', int(time.time())))
+        search_id = self.cursor.lastrowid if self.cursor.rowcount else None
+        self._commit()
+        return search_id
+
+    def get_saved_searches(self, user_id):
+        self.cursor.execute('''
+        SELECT s.id, d.name AS department, p.name AS profession, e.name AS experience, s.location
+        FROM saved_searches s
+        JOIN departments d ON d.id = s.department_id
+        JOIN professions p ON p.id = s.profession_id
+        LEFT JOIN experience_levels e ON e.id = s.experience_id
+        WHERE s.user_id = ? ORDER BY s.id''', (user_id,))
+        return self.cursor.fetchall()
+
+    def delete_saved_search(self, user_id, search_id):
+        self.cursor.execute('DELETE FROM saved_searches WHERE id = ? AND user_id = ?', (search_id, user_id))
+        # Еще не отправленные совпадения по этому поиску тоже не нужны
+        self.cursor.execute('''
+        DELETE FROM search_matches WHERE user_id = ? AND search_id = ? AND notified_at IS NULL''',
+        (user_id, search_id))
+        self._commit()
+
+    def get_pending_matches(self, until, subscribers):
+        """Неотправленные совпадения до момента until для первых subscribers подписчиков.
+
+        Возвращает {user_id подписчика: [профили с is_favorite]}. Удаленные
+        профили пропадают через join, поэтому список может быть пустым.
+        """
+        self.cursor.execute('''
+        SELECT DISTINCT user_id FROM search_matches
+        WHERE notified_at IS NULL AND created_at < ? ORDER BY user_id LIMIT ?''', (until, subscribers))
+        matches = {row[0]: [] for row in self.cursor.fetchall()}
+        if not matches:
+            return matches
+        placeholders = ', '.join('?' * len(matches))
+        self.cursor.execute(f'''
+        SELECT m.user_id AS subscriber_id, u.*, f.user_id IS NOT NULL AS is_favorite FROM search_matches m
+        JOIN users_view u ON u.user_id = m.profile_id
+        LEFT JOIN favorites f ON f.user_id = m.user_id AND f.favorite_user_id = m.profile_id
+        WHERE m.user_id IN ({placeholders}) AND m.notified_at IS NULL AND m.created_at < ?
+        ORDER BY m.user_id, m.created_at''', list(matches) + [until])
+        for row in self.cursor.fetchall():
+            matches[row['subscriber_id']].append(row)
+        return matches
+
+    def mark_matches_notified(self, user_ids, until):
+        """Отмечаем совпадения отправленными и удаляем у этих подписчиков отправленные раньше SEARCH_MATCH_RETENTION"""
+        placeholders = ', '.join('?' * len(user_ids))
+        now = int(time.time())
+        self.cursor.execute(f'''
+        UPDATE search_matches SET notified_at = ?
+        WHERE user_id IN ({placeholders}) AND notified_at IS NULL AND created_at < ?''',
+        [now] + list(user_ids) + [until])
+        # По первичному ключу (user_id, profile_id): только строки этих подписчиков
+        self.cursor.execute(f'''
+        DELETE FROM search_matches
+        WHERE user_id IN ({placeholders}) AND notified_at < ?''',
+        list(user_ids) + [now - SEARCH_MATCH_RETENTION])
+        self._commit()
+
+    def get_search_key(self, user_id):
+        """(department_id, profession_id, experience_id, location) заполненного профиля или None"""
+        complete, _ = self._profile_flags()
+        self.cursor.execute(f'''
+        SELECT department_id, profession_id, experience_id, location FROM users
+        WHERE user_id = ? AND {complete}''', (user_id,))
+        row = self.cursor.fetchone()
+        return tuple(row) if row else None
+
+    def find_saved_searches(self, profile_id, department_id, profession_id, experience_id, location):
+        """[(user_id, search_id)] сохраненных поисков, которым подходит профиль с такими полями"""
+        self.cursor.execute('''
+        SELECT user_id, id FROM saved_searches
+        WHERE department_id = ? AND profession_id = ? AND location IN (?, '') AND experience_id IN (?, 0)
+        AND user_id != ?''', (department_id, profession_id, location, experience_id, profile_id))
+        return [tuple(row) for row in self.cursor.fetchall()]
+
+    def add_search_matches(self, rows):
+        """Совпадения (user_id, profile_id, search_id, created_at, notified_at), уже найденные раньше пропускаются"""
+        self.cursor.executemany('''
+        INSERT OR IGNORE INTO search_matches (user_id, profile_id, search_id, created_at, notified_at)
+        VALUES (?, ?, ?, ?, ?)''', rows)
+        self._commit()
+
+    def is_favorite(self, user_id, favorite_user_id):
+        self.cursor.execute('''
+        SELECT 1 FROM favorites WHERE user_id = ? AND favorite_user_id = ?''', 
+        (user_id, favorite_user_id))
+        return bool(self.cursor.fetchone())
+
+    def get_favorite_ids(self, user_id, favorite_user_ids):
+        """Какие из favorite_user_ids есть в избранном - одним запросом"""
+        favorite_user_ids = list(favorite_user_ids)
+        if not favorite_user_ids:
+            return set()
+        placeholders = ', '.join('?' * len(favorite_user_ids))
+        self.cursor.execute(f'''
+        SELECT favorite_user_id FROM favorites
+        WHERE user_id = ? AND favorite_user_id IN ({placeholders})''',
+        [user_id] + favorite_user_ids)
+        return {row[0] for row in self.cursor.fetchall()}
+
+    def save_tracked_messages(self, rows):
+        """Сохраняем отслеживаемые сообщения, чтобы удалить их после перезапуска"""
+        self.cursor.execute('DELETE FROM tracked_messages')
+        self.cursor.executemany('INSERT INTO tracked_messages VALUES (?, ?, ?)', rows)
+        self.conn.commit()
+
+    def load_tracked_messages(self, since):
+        self.cursor.execute('''
+        SELECT chat_id, message_id, sent_at FROM tracked_messages
+        WHERE sent_at > ? ORDER BY sent_at''', (since,))
+        # Таблица не очищается: до следующего сохранения она - единственная копия
+        return self.cursor.fetchall()
+
+    # Решардинг: перенос строк пользователей между базами и журнал изменений на время переноса
+    def export_users(self, user_ids):
+        """Все строки пользователей user_ids в этой базе, с названиями вместо кодов справочников.
+
+        Связи избранного берутся в обе стороны, совпадения поисков - те,
+        где пользователь подписчик. Соседи для рекомендаций не переносятся:
+        их заново строит rebuild_neighbors.
+        """
+        user_ids = list(user_ids)
+        placeholders = ', '.join('?' * len(user_ids))
+        self.cursor.execute(f'''
+        SELECT user_id, username, full_name, department, profession, experience, portfolio, location
+        FROM users_view WHERE user_id IN ({placeholders})''', user_ids)
+        profiles = [dict(zip(row.keys(), row)) for row in self.cursor.fetchall()]
+        self.cursor.execute(f'''
+        SELECT pm.user_id, m.kind, m.file_id, m.file_unique_id FROM profile_media pm
+        JOIN media m ON m.id = pm.media_id
+        WHERE pm.user_id IN ({placeholders}) ORDER BY pm.user_id, pm.position''', user_ids)
+        media = [tuple(row) for row in self.cursor.fetchall()]
+        self.cursor.execute(f'''
+        SELECT user_id, favorite_user_id FROM favorites WHERE user_id IN ({placeholders})
+        UNION
+        SELECT user_id, favorite_user_id FROM favorites WHERE favorite_user_id IN ({placeholders})''', user_ids * 2)
+        favorites = [tuple(row) for row in self.cursor.fetchall()]
+        self.cursor.execute(f'''
+        SELECT s.id, s.user_id, d.name, p.name, e.name, s.location FROM saved_searches s
+        JOIN departments d ON d.id = s.department_id
+        JOIN professions p ON p.id = s.profession_id
+        LEFT JOIN experience_levels e ON e.id = s.experience_id
+        WHERE s.user_id IN ({placeholders}) ORDER BY s.id''', user_ids)
+        saved_searches = [tuple(row) for row in self.cursor.fetchall()]
+        self.cursor.execute(f'''
+        SELECT user_id, profile_id, search_id, created_at, notified_at FROM search_matches
+        WHERE user_id IN ({placeholders})''', user_ids)
+        search_matches = [tuple(row) for row in self.cursor.fetchall()]
+        return {'profiles': profiles, 'media': media, 'favorites': favorites,
+                'saved_searches': saved_searches, 'search_matches': search_matches}
+
+    def export_globals(self):
+        """Таблицы, которые не делятся по пользователям: рассылки и отслеживаемые сообщения"""
+        self.cursor.execute('SELECT * FROM broadcasts ORDER BY id')
+        broadcasts = [tuple(row) for row in self.cursor.fetchall()]
+        self.cursor.execute('SELECT chat_id, message_id, sent_at FROM tracked_messages')
+        return {'broadcasts': broadcasts, 'tracked_messages': [tuple(row) for row in self.cursor.fetchall()]}
+
+    def import_globals(self, tables):
+        self.cursor.executemany('INSERT OR REPLACE INTO broadcasts VALUES (?, ?, ?, ?, ?, ?, ?, ?)', tables['broadcasts'])
+        self.cursor.executemany('INSERT INTO tracked_messages VALUES (?, ?, ?)', tables['tracked_messages'])
+        self.conn.commit()
+
+    def start_change_log(self):
+        """Триггеры, которые записывают в changed_users всех, чьи строки изменились.
+
+        Триггеры хранятся в файле базы, поэтому срабатывают и на запись
+        из работающего бота.
+        """
+        self.flush()
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS changed_users (user_id INTEGER PRIMARY KEY)')
+        for table, columns in CHANGE_LOG_OWNERS.items():
+            for event, row in (('INSERT', 'new'), ('UPDATE', 'new'), ('DELETE', 'old')):
+                inserts = ' '.join(f'INSERT OR IGNORE INTO changed_users VALUES ({row}.{column});' for column in columns)
+                self.cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS changed_users_{table}_{event.lower()} AFTER {event} ON {table}
+                BEGIN {inserts} END''')
+        self.conn.commit()
+
+    def pop_changed_users(self, limit):
+        """До limit пользователей из журнала изменений; взятые из журнала удаляются"""
+        self.cursor.execute('SELECT user_id FROM changed_users ORDER BY user_id LIMIT ?', (limit,))
+        user_ids = [row[0] for row in self.cursor.fetchall()]
+        if user_ids:
+            self.cursor.execute(f'''
+            DELETE FROM changed_users WHERE user_id IN ({', '.join('?' * len(user_ids))})''', user_ids)
+            self.conn.commit()
+        return user_ids
+
+    def count_changed_users(self):
+        self.cursor.execute('SELECT COUNT(*) FROM changed_users')
+        return self.cursor.fetchone()[0]
+
+    def stop_change_log(self):
+        for table in CHANGE_LOG_OWNERS:
+            for event in ('insert', 'update', 'delete'):
+                self.cursor.execute(f'DROP TRIGGER IF EXISTS changed_users_{table}_{event}')
+        self.cursor.execute('DROP TABLE IF EXISTS changed_users')
+        self.conn.commit()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+# Методы, которые целиком выполняются в шарде пользователя из первого аргумента
+SHARD_USER_METHODS = {
+    'add_user', 'get_user', 'count_mutual_favorites', 'set_profile_media', 'get_profile_media',
+    'save_search', 'get_saved_searches', 'is_favorite', 'get_favorite_ids',
+}
+# Рассылки и отслеживаемые сообщения не делятся по пользователям и лежат в первом шарде
+SHARD_PRIMARY_METHODS = {
+    'create_broadcast', 'get_broadcast', 'get_running_broadcasts', 'update_broadcast',
+    'save_tracked_messages', 'load_tracked_messages', 'export_globals', 'import_globals',
+}
+
+def shard_paths(count, db_name=DB_NAME):
+    """Файлы шардов; единственный шард - прежний файл базы"""
+    if count == 1:
+        return [db_name]
+    base, ext = os.path.splitext(db_name)
+    return [f"{base}.{index}-of-{count}{ext}" for index in range(count)]
+
+class ShardedDatabase:
+    """Database, разложенная по нескольким файлам SQLite по user_id.
+
+    Профиль и все, что принадлежит пользователю (фото и видео, сохраненные
+    поиски, соседи для рекомендаций), лежит в шарде user_id % N. Связь
+    избранного пишется в шарды обоих концов, поэтому в любом шарде join
+    профилей с избранным верен для его собственных профилей: избранное,
+    «Кто добавил меня», отметки is_favorite в поиске и рекомендации - это
+    те же запросы Database, выполненные на всех шардах параллельно и
+    слитые по user_id, рангу или весу. Совпадения сохраненных поисков
+    лежат в шарде найденного профиля. Соседи для рекомендаций считаются
+    только между профилями одного шарда. Методы те же, что у Database.
+    """
+
+    def __init__(self, shards):
+        first = shards[0]
+        for shard in shards[1:]:
+            # Коды справочников хранятся в строках и сравниваются между шардами
+            if (shard.department_ids, shard.profession_ids, shard.experience_ids) != \
+                    (first.department_ids, first.profession_ids, first.experience_ids):
+                raise ValueError("Справочники цехов, профессий и опыта в шардах различаются")
+        self.shards = shards
+        self.primary = first
+        # У каждого шарда свое соединение, и sqlite3 отпускает GIL на время запроса
+        self._executor = ThreadPoolExecutor(max_workers=len(shards), thread_name_prefix='shard')
+
+    def shard(self, user_id):
+        return self.shards[user_id % len(self.shards)]
+
+    def __getattr__(self, name):
+        if name in SHARD_USER_METHODS:
+            def method(user_id, *args, **kwargs):
+                return getattr(self.shard(user_id), name)(user_id, *args, **kwargs)
+            method.__name__ = name
+            return method
+        if name in SHARD_PRIMARY_METHODS:
+            return getattr(self.primary, name)
+        raise AttributeError(name)
+
+    def _each(self, name, args_by_shard):
+        """{шард: аргументы} -> {шард: результат метода name}, шарды работают параллельно"""
+        futures = {shard: self._executor.submit(getattr(shard, name), *args) for shard, args in args_by_shard.items()}
+        return {shard: future.result() for shard, future in futures.items()}
+
+    def _scatter(self, name, *args, **kwargs):
+        """Метод name на всех шардах параллельно, результаты в порядке шардов"""
+        futures = [self._executor.submit(getattr(shard, name), *args, **kwargs) for shard in self.shards]
+        return [future.result() for future in futures]
+
+    def _group(self, items, key):
+        groups = defaultdict(list)
+        for item in items:
+            groups[self.shard(key(item))].append(item)
+        return groups
+
+    def _edge_shards(self, user_id, favorite_user_id):
+        owner, target = self.shard(user_id), self.shard(favorite_user_id)
+        return [owner] if owner is target else [owner, target]
+
+    def flush(self):
+        self._scatter('flush')
+
+    def close(self):
+        self._scatter('close')
+        self._executor.shutdown(wait=True)
+
+    @contextmanager
+    def bulk_load(self):
+        with ExitStack() as stack:
+            for shard in self.shards:
+                stack.enter_context(shard.bulk_load())
+            yield self
+
+    def add_profiles(self, profiles):
+        groups = self._group(profiles, lambda profile: profile['user_id'])
+        self._each('add_profiles', {shard: (group,) for shard, group in groups.items()})
+
+    def update_profile(self, user_id, **kwargs):
+        owner = self.shard(user_id)
+        # Подписчиков из своего шарда находит сам update_profile
+        owner.update_profile(user_id, **kwargs)
+        if len(self.shards) == 1 or not kwargs.keys() & {'department', 'profession', 'experience', 'location'}:
+            return
+        key = owner.get_search_key(user_id)
+        if key is None:
+            return
+        found = self._each('find_saved_searches', {shard: (user_id, *key) for shard in self.shards if shard is not owner})
+        now = int(time.time())
+        matches = [(subscriber_id, user_id, search_id, now, None)
+                   for searches in found.values() for subscriber_id, search_id in searches]
+        if matches:
+            owner.add_search_matches(matches)
+
+    def delete_user(self, user_id):
+        # Связи избранного и совпадения поисков пользователя есть в любом шарде
+        self._scatter('delete_user', user_id)
+
+    def get_users(self, user_ids):
+        users = {}
+        groups = self._group(user_ids, lambda user_id: user_id)
+        for found in self._each('get_users', {shard: (group,) for shard, group in groups.items()}).values():
+            users.update(found)
+        return users
+
+    def search_users(self, **filters):
+        return sorted((row for rows in self._scatter('search_users', **filters) for row in rows),
+                      key=lambda row: row['user_id'])
+
+    def count_users(self, **filters):
+        return sum(self._scatter('count_users', **filters))
+
+    def facet_counts(self, column, limit=None, **filters):
+        counts = Counter()
+        for facets in self._scatter('facet_counts', column, **filters):
+            counts.update(dict(facets))
+        return counts.most_common(limit)
+
+    def search_users_page(self, after=None, before=None, limit=10, viewer_id=None, **filters):
+        pages = self._scatter('search_users_page', after, before, limit, viewer_id, **filters)
+        rows = sorted((row for page, _, _ in pages for row in page), key=lambda row: row['user_id'])
+        if before is not None:
+            return rows[-limit:], len(rows) > limit or any(has_prev for _, has_prev, _ in pages), True
+        return rows[:limit], after is not None, len(rows) > limit or any(has_next for _, _, has_next in pages)
+
+    def search_text(self, query, limit=10, offset=0, viewer_id=None):
+        """Совпадения всех шардов по rank; у каждого шарда своя статистика слов, так что порядок приблизительный"""
+        pages = self._scatter('search_text', query, offset + limit, 0, viewer_id)
+        rows = sorted((row for page, _, _ in pages for row in page), key=lambda row: row['rank'])
+        return (rows[offset:offset + limit], len(rows) > offset + limit or any(has_next for _, has_next, _ in pages),
+                any(partial for _, _, partial in pages))
+
+    def search_text_ranks(self, query, limit=FTS_RANK_CANDIDATES):
+        return list(itertools.islice(heapq.merge(*self._scatter('search_text_ranks', query, limit)), limit))
+
+    def search_text_ids(self, query, limit=FTS_RANK_CANDIDATES):
+        return [user_id for _, user_id in self.search_text_ranks(query, limit)]
+
+    def add_favorite(self, user_id, favorite_user_id):
+        """Связь пишется сначала в шард user_id, затем в шард favorite_user_id.
+
+        Общей транзакции у шардов нет: если процесс упадет между записями
+        (или до flush одного из шардов), копия во втором шарде потеряется:
+        счетчик favorited у favorite_user_id и отметки «в избранном» в поиске
+        разойдутся с избранным user_id. Шард владельца считается верным, расхождения
+        исправляет repair_favorites (python manage.py repair-favorites).
+        """
+        for shard in self._edge_shards(user_id, favorite_user_id):
+            shard.add_favorite(user_id, favorite_user_id)
+
+    def add_favorites(self, pairs):
+        groups = defaultdict(list)
+        for pair in pairs:
+            for shard in self._edge_shards(*pair):
+                groups[shard].append(pair)
+        self._each('add_favorites', {shard: (group,) for shard, group in groups.items()})
+
+    def remove_favorite(self, user_id, favorite_user_id):
+        """Как add_favorite: после сбоя копия связи может остаться в шарде favorite_user_id"""
+        for shard in self._edge_shards(user_id, favorite_user_id):
+            shard.remove_favorite(user_id, favorite_user_id)
+
+    def repair_favorites(self):
+        """Сверяем копии связей между шардами с шардом владельца -> (добавлено, удалено).
+
+        Копии читаются раньше оригиналов: связь, добавленная или удаленная
+        ботом во время сверки, уже есть в шарде владельца и будет исправлена
+        в ту же сторону. Правки идут через add_favorite/remove_favorite шарда,
+        поэтому favorite_counts и соседи для рекомендаций обновляются вместе
+        со связями.
+        """
+        count = len(self.shards)
+        added = removed = 0
+        for (owner_index, owner), (target_index, target) in itertools.permutations(enumerate(self.shards), 2):
+            self.flush()
+            copies = target.get_favorites_between(count, owner_index, target_index)
+            originals = owner.get_favorites_between(count, owner_index, target_index)
+            for pair in sorted(originals - copies):
+                target.add_favorite(*pair)
+            for pair in sorted(copies - originals):
+                target.remove_favorite(*pair)
+            added += len(originals - copies)
+            removed += len(copies - originals)
+        self.flush()
+        return added, removed
+
+    def iter_profiles(self):
+        return heapq.merge(*(shard.iter_profiles() for shard in self.shards), key=lambda row: row[0])
+
+    def iter_favorites(self):
+        # Связь между шардами выгружается один раз - из шарда сохранившего
+        def own(shard):
+            return (row for row in shard.iter_favorites() if self.shard(row[0]) is shard)
+        return heapq.merge(*(own(shard) for shard in self.shards), key=lambda row: row[0])
+
+    def rebuild_neighbors(self, after=0, limit=RECOMMENDATION_REBUILD_BATCH):
+        """Порция перестроения в каждом шарде; after - 0 или значение, которое вернул прошлый вызов"""
+        cursors = after or (0,) * len(self.shards)
+        futures = [self._executor.submit(shard.rebuild_neighbors, cursor, limit) if cursor is not None else None
+                   for shard, cursor in zip(self.shards, cursors)]
+        cursors = tuple(future.result() if future else None for future in futures)
+        return None if all(cursor is None for cursor in cursors) else cursors
+
+    def get_recommendations(self, user_id, limit=5):
+        user = self.get_user(user_id)
+        location = user['location'] if user else None
+        for name in ('get_neighbor_recommendations', 'get_popular_recommendations'):
+            rows = [row for rows in self._scatter(name, user_id, location, limit) for row in rows]
+            if rows:
+                return heapq.nlargest(limit, rows, key=lambda row: row['score'])
+        return []
+
+    def get_favorites(self, user_id):
+        return [row for rows in self._scatter('get_favorites', user_id) for row in rows]
+
+    def profile_stats(self):
+        totals = {}
+        for stats in self._scatter('profile_stats'):
+            for department, profession, *counts in stats:
+                total = totals.setdefault((department, profession), [0] * len(counts))
+                for i, count in enumerate(counts):
+                    total[i] += count
+        return [(department, profession, *counts) for (department, profession), counts in totals.items()]
+
+    def count_profiles(self):
+        return sum(self._scatter('count_profiles'))
+
+    def top_favorited(self, limit=10):
+        rows = [row for rows in self._scatter('top_favorited', limit) for row in rows]
+        return heapq.nlargest(limit, rows, key=lambda row: row['favorited'])
+
+    def get_user_ids_page(self, after, limit):
+        return list(itertools.islice(heapq.merge(*self._scatter('get_user_ids_page', after, limit)), limit))
+
+    def get_broadcast_recipients(self, after, limit):
+        return self.get_user_ids_page(after, limit)
+
+    def _merge_by_user(self, name, user_id, limit):
+        pages = self._scatter(name, user_id, limit)
+        return list(itertools.islice(heapq.merge(*pages, key=lambda row: row['user_id']), limit))
+
+    def get_admirers(self, user_id, limit=None):
+        return self._merge_by_user('get_admirers', user_id, limit)
+
+    def get_mutual_favorites(self, user_id, limit=None):
+        return self._merge_by_user('get_mutual_favorites', user_id, limit)
+
+    def delete_saved_search(self, user_id, search_id):
+        # Поиск лежит у подписчика, а его совпадения - у найденных профилей
+        self._scatter('delete_saved_search', user_id, search_id)
+
+    def get_pending_matches(self, until, subscribers):
+        # Первые subscribers подписчиков среди всех шардов есть среди первых subscribers каждого шарда
+        batches = self._scatter('get_pending_matches', until, subscribers)
+        chosen = sorted(set().union(*batches))[:subscribers]
+        return {user_id: [row for batch in batches for row in batch.get(user_id, [])] for user_id in chosen}
+
+    def mark_matches_notified(self, user_ids, until):
+        self._scatter('mark_matches_notified', user_ids, until)
+
+    def export_users(self, user_ids):
+        user_ids = list(user_ids)
+        exported = {'profiles': [], 'media': [], 'favorites': set(), 'saved_searches': [], 'search_matches': []}
+        for data in self._scatter('export_users', user_ids):
+            for table, rows in data.items():
+                if table == 'favorites':
+                    exported[table].update(rows)
+                else:
+                    exported[table].extend(rows)
+        exported['favorites'] = sorted(exported['favorites'])
+        return exported
+
+    def import_users(self, data, replace=()):
+        """Строки из export_users другой раскладки шардов; пользователи replace сначала удаляются целиком"""
+        for user_id in replace:
+            self.delete_user(user_id)
+        self.add_profiles(data['profiles'])
+        for user_id, items in itertools.groupby(data['media'], key=lambda item: item[0]):
+            self.shard(user_id).set_profile_media(user_id, [item[1:] for item in items])
+        # Номера поисков в новой раскладке другие, совпадения ссылаются на новые
+        search_ids = {}
+        for search_id, user_id, department, profession, experience, location in data['saved_searches']:
+            search_ids[user_id, search_id] = self.shard(user_id).save_search(
+                user_id, department, profession, experience, location
+            )
+        matches = [(user_id, profile_id, search_ids[user_id, search_id], created_at, notified_at)
+                   for user_id, profile_id, search_id, created_at, notified_at in data['search_matches']
+                   if search_ids.get((user_id, search_id))]
+        groups = self._group(matches, lambda match: match[1])
+        self._each('add_search_matches', {shard: (group,) for shard, group in groups.items()})
+        self.add_favorites(data['favorites'])
+
+    def start_change_log(self):
+        self._scatter('start_change_log')
+
+    def pop_changed_users(self, limit):
+        return sorted(set().union(*self._scatter('pop_changed_users', limit)))
+
+    def count_changed_users(self):
+        return sum(self._scatter('count_changed_users'))
+
+    def stop_change_log(self):
+        self._scatter('stop_change_log')
+
+def open_database(shards=DB_SHARDS, db_name=DB_NAME, **kwargs):
+    """Database для одного шарда, иначе ShardedDatabase по файлам shard_paths"""
+    if shards == 1:
+        return Database(db_name, **kwargs)
+    return ShardedDatabase([Database(path, **kwargs) for path in shard_paths(shards, db_name)])
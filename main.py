@@ -1,107 +1,669 @@
+import argparse
+import base64
+import hashlib
+import hmac
+import html
+import inspect
+import os
+import queue
 import sqlite3
+import threading
 import logging
+import asyncio
+import functools
+import heapq
+import itertools
+import json
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict, defaultdict, deque
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
 from aiogram import Bot, Dispatcher, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.dispatcher.storage import BaseStorage
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.utils import executor
+from aiogram.utils.exceptions import RetryAfter, MessageToDeleteNotFound, MessageCantBeDeleted
 from config import BOT_TOKEN, ADMINS
+from database import (
+    DEPARTMENTS, EXPERIENCE_LEVELS, DB_BUSY_TIMEOUT, DB_FLUSH_INTERVAL, FTS_RANK_CANDIDATES,
+    RECOMMENDATION_REBUILD_BATCH, RECOMMENDATION_REBUILD_INTERVAL, build_fts_query, canonical_city, open_database,
+)
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Инициализация бота и диспетчера
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(bot, storage=storage)
+# Метрики
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))  # 0 - метрики не публикуются
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')  # только для локального сборщика, не наружу
+METRICS_PATH = '/metrics'
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
 
-# База данных
-DB_NAME = 'cinema_collab.db'
+class Histogram:
+    __slots__ = ('counts', 'sum')
 
-class Database:
     def __init__(self):
-        self.conn = sqlite3.connect(DB_NAME)
-        self.cursor = self.conn.cursor()
-        self._create_tables()
-    
-    def _create_tables(self):
-        self.cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            full_name TEXT,
-            department TEXT,
-            profession TEXT,
-            experience TEXT,
-            portfolio TEXT,
-            location TEXT
-        )''')
-        
-        self.cursor.execute('''
-        CREATE TABLE IF NOT EXISTS favorites (
-            user_id INTEGER,
-            favorite_user_id INTEGER,
-            PRIMARY KEY (user_id, favorite_user_id),
-            FOREIGN KEY (user_id) REFERENCES users (user_id),
-            FOREIGN KEY (favorite_user_id) REFERENCES users (user_id)
-        )''')
-        self.conn.commit()
-    
-    def add_user(self, user_id, username, full_name):
-        self.cursor.execute('''
-        INSERT OR IGNORE INTO users (user_id, username, full_name) 
-        VALUES (?, ?, ?)''', (user_id, username, full_name))
-        self.conn.commit()
-    
-    def update_profile(self, user_id, **kwargs):
-        set_clause = ', '.join([f"{key} = ?" for key in kwargs.keys()])
-        values = list(kwargs.values()) + [user_id]
-        self.cursor.execute(f'''
-        UPDATE users SET {set_clause} WHERE user_id = ?''', values)
-        self.conn.commit()
-    
-    def delete_user(self, user_id):
-        self.cursor.execute('DELETE FROM favorites WHERE user_id = ? OR favorite_user_id = ?', (user_id, user_id))
-        self.cursor.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
-        self.conn.commit()
-    
-    def get_user(self, user_id):
-        self.cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        return self.cursor.fetchone()
-    
-    def search_users(self, **filters):
-        where_clause = ' AND '.join([f"{key} = ?" for key in filters.keys()]) if filters else '1'
-        query = f'SELECT * FROM users WHERE {where_clause}'
-        self.cursor.execute(query, list(filters.values()))
-        return self.cursor.fetchall()
-    
-    def add_favorite(self, user_id, favorite_user_id):
-        self.cursor.execute('''
-        INSERT OR IGNORE INTO favorites (user_id, favorite_user_id) 
-        VALUES (?, ?)''', (user_id, favorite_user_id))
-        self.conn.commit()
-    
-    def remove_favorite(self, user_id, favorite_user_id):
-        self.cursor.execute('''
-        DELETE FROM favorites WHERE user_id = ? AND favorite_user_id = ?''', 
-        (user_id, favorite_user_id))
-        self.conn.commit()
-    
-    def get_favorites(self, user_id):
-        self.cursor.execute('''
-        SELECT u.* FROM users u
-        JOIN favorites f ON u.user_id = f.favorite_user_id
-        WHERE f.user_id = ?''', (user_id,))
-        return self.cursor.fetchall()
-    
-    def is_favorite(self, user_id, favorite_user_id):
-        self.cursor.execute('''
-        SELECT 1 FROM favorites WHERE user_id = ? AND favorite_user_id = ?''', 
-        (user_id, favorite_user_id))
-        return bool(self.cursor.fetchone())
-
-db = Database()
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+
+class Metrics:
+    """Счетчики и гистограммы задержек в текстовом формате Prometheus.
+
+    Метки серии - кортеж пар (имя, значение). Запись - одна операция
+    со словарем и списком, поэтому метрики можно не выключать в бою.
+    """
+
+    def __init__(self):
+        self.counters = defaultdict(Counter)
+        self.histograms = defaultdict(dict)
+
+    def inc(self, name, labels=(), value=1):
+        self.counters[name][labels] += value
+
+    def observe(self, name, labels, value):
+        histogram = self.histograms[name].get(labels)
+        if histogram is None:
+            histogram = self.histograms[name][labels] = Histogram()
+        histogram.observe(value)
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+    def render(self, gauges=()):
+        """gauges - тройки (имя, метки, значение), снятые в момент запроса.
+
+        Потоки базы и FSM добавляют серии прямо во время отрисовки, поэтому
+        словари обходятся по копиям: list() копирует их без переключения потоков.
+        """
+        lines = []
+        for name, series in sorted(list(self.counters.items())):
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(f"{name}{self.format_labels(labels)} {value}" for labels, value in list(series.items()))
+        for name, series in sorted(list(self.histograms.items())):
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in list(series.items()):
+                total = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram.counts):
+                    total += count
+                    lines.append(f"{name}_bucket{self.format_labels(labels + (('le', bound),))} {total}")
+                lines.append(f"{name}_sum{self.format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{self.format_labels(labels)} {total}")
+        typed = set()
+        for name, labels, value in gauges:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name}{self.format_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def timed_call(metric, func, *args, **kwargs):
+    """Вызов func с записью времени и ошибок в metric (для потоков базы)"""
+    started = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    except Exception as e:
+        metrics.inc(f'{metric}_errors_total', (('method', func.__name__), ('error', type(e).__name__)))
+        raise
+    finally:
+        metrics.observe(f'{metric}_seconds', (('method', func.__name__),), time.perf_counter() - started)
+
+class InstrumentedBot(Bot):
+    """Bot, который считает вызовы Bot API, их время и ошибки (в том числе RetryAfter)"""
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception as e:
+            metrics.inc('bot_api_errors_total', (('method', method), ('error', type(e).__name__)))
+            raise
+        finally:
+            metrics.observe('bot_api_request_seconds', (('method', method),), time.perf_counter() - started)
+
+# Инициализация бота
+bot = InstrumentedBot(token=BOT_TOKEN)
+
+class AsyncDatabase:
+    """Асинхронная обертка над Database.
+
+    Все запросы выполняются в одном выделенном потоке, поэтому sqlite3
+    и commit не блокируют цикл событий, а порядок запросов сохраняется.
+    Поток забирает из очереди все накопившиеся вызовы разом и возвращает
+    их результаты в цикл событий одним обратным вызовом: под нагрузкой
+    переключений между потоками меньше, чем запросов.
+    Методы те же, что у Database, но их нужно вызывать через await.
+    """
+
+    def __init__(self, database):
+        self._db = database
+        self._calls = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._serve, name='db', daemon=True)
+        self._thread.start()
+        self._flusher = None
+
+    def _serve(self):
+        while True:
+            batch = [self._calls.get()]
+            while True:
+                try:
+                    batch.append(self._calls.get_nowait())
+                except queue.Empty:
+                    break
+            results = defaultdict(list)
+            stop = False
+            for loop, future, func, args, kwargs in batch:
+                if func is None:
+                    stop = True
+                    results[loop].append((future, None, None))
+                    continue
+                try:
+                    results[loop].append((future, timed_call('bot_db_query', func, *args, **kwargs), None))
+                except Exception as e:
+                    results[loop].append((future, None, e))
+            for loop, items in results.items():
+                loop.call_soon_threadsafe(self._resolve, items)
+            if stop:
+                return
+
+    @staticmethod
+    def _resolve(items):
+        for future, result, error in items:
+            if future.cancelled():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._calls.put((loop, future, func, args, kwargs))
+        return await future
+
+    def __getattr__(self, name):
+        attr = getattr(self._db, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        async def method(*args, **kwargs):
+            return await self._run(attr, *args, **kwargs)
+
+        method.__name__ = name
+        return method
+
+    def start_flusher(self, interval=DB_FLUSH_INTERVAL):
+        """Периодический commit накопленных изменений"""
+        async def flush_loop():
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    await self.flush()
+                except Exception as e:
+                    logger.error(f"Ошибка при записи в базу: {e}")
+
+        self._flusher = asyncio.create_task(flush_loop())
+
+    async def close(self):
+        if self._flusher:
+            self._flusher.cancel()
+        await self._run(self._db.close)
+        # Пустой вызов останавливает поток после всех поставленных раньше
+        await self._run(None)
+        self._thread.join()
+
+# Кэш чтений
+CACHE_SIZE = 10000
+CACHE_TTL = 5 * 60  # None - без ограничения времени жизни
+
+class LRUCache:
+    """Кэш с вытеснением давно не использованных записей и необязательным TTL.
+
+    on_evict(key, value) вызывается для записей, вытесненных по размеру.
+    """
+
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL, on_evict=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None or (self.ttl is not None and item[1] < time.monotonic()):
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            key, item = self._data.popitem(last=False)
+            self.evictions += 1
+            if self.on_evict:
+                self.on_evict(key, item[0])
+
+    def pop(self, key):
+        item = self._data.pop(key, None)
+        return item[0] if item else None
+
+    def items(self):
+        return [(key, item[0]) for key, item in self._data.items()]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self._data)}
+
+_MISSING = object()
+
+class CachedDatabase(AsyncDatabase):
+    """AsyncDatabase с кэшем get_user, get_favorites и get_profile_media.
+
+    Записи сбрасываются точно теми методами, которые меняют их данные.
+    Для списков избранного хранится обратный индекс: профиль -> владельцы
+    закэшированных списков, в которых он есть, поэтому правка профиля
+    сбрасывает только эти списки.
+    """
+
+    def __init__(self, database, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        super().__init__(database)
+        self.users = LRUCache(maxsize, ttl)
+        self.favorites = LRUCache(maxsize, ttl, on_evict=self._unlink_favorites)
+        self.media = LRUCache(maxsize, ttl)
+        self._listed = defaultdict(set)
+
+    async def get_user(self, user_id):
+        user = self.users.get(user_id, _MISSING)
+        if user is _MISSING:
+            user = await self._run(self._db.get_user, user_id)
+            self.users.set(user_id, user)
+        return user
+
+    async def get_users(self, user_ids):
+        """Профили в порядке user_ids, недостающие в кэше читаются одним запросом"""
+        users = {user_id: self.users.get(user_id, _MISSING) for user_id in user_ids}
+        missing = [user_id for user_id, user in users.items() if user is _MISSING]
+        if missing:
+            found = await self._run(self._db.get_users, missing)
+            for user_id in missing:
+                users[user_id] = found.get(user_id)
+                self.users.set(user_id, users[user_id])
+        return [users[user_id] for user_id in user_ids if users[user_id] is not None]
+
+    async def get_profile_media(self, user_id):
+        media = self.media.get(user_id, _MISSING)
+        if media is _MISSING:
+            media = await self._run(self._db.get_profile_media, user_id)
+            self.media.set(user_id, media)
+        return media
+
+    async def set_profile_media(self, user_id, items):
+        await self._run(self._db.set_profile_media, user_id, items)
+        self.media.pop(user_id)
+        # В профиле хранится число медиа
+        self._forget_user(user_id)
+
+    async def get_favorites(self, user_id):
+        favorites = self.favorites.get(user_id, _MISSING)
+        if favorites is _MISSING:
+            favorites = await self._run(self._db.get_favorites, user_id)
+            # Истекшая запись еще лежит в кэше со своими ссылками
+            self._forget_favorites(user_id)
+            self.favorites.set(user_id, favorites)
+            for row in favorites:
+                self._listed[row['user_id']].add(user_id)
+        return favorites
+
+    def _unlink_favorites(self, owner_id, favorites):
+        for row in favorites or ():
+            owners = self._listed.get(row['user_id'])
+            if owners:
+                owners.discard(owner_id)
+                if not owners:
+                    del self._listed[row['user_id']]
+
+    def _forget_favorites(self, owner_id):
+        self._unlink_favorites(owner_id, self.favorites.pop(owner_id))
+
+    def _forget_user(self, user_id):
+        self.users.pop(user_id)
+        # Списки избранного, в которых есть этот профиль
+        for owner_id in list(self._listed.get(user_id, ())):
+            self._forget_favorites(owner_id)
+
+    async def add_user(self, user_id, username, full_name):
+        await self._run(self._db.add_user, user_id, username, full_name)
+        self.users.pop(user_id)
+
+    async def update_profile(self, user_id, **kwargs):
+        await self._run(self._db.update_profile, user_id, **kwargs)
+        self._forget_user(user_id)
+
+    async def delete_user(self, user_id):
+        await self._run(self._db.delete_user, user_id)
+        self._forget_user(user_id)
+        self._forget_favorites(user_id)
+        self.media.pop(user_id)
+
+    async def add_favorite(self, user_id, favorite_user_id):
+        await self._run(self._db.add_favorite, user_id, favorite_user_id)
+        self._forget_favorites(user_id)
+        # Счетчик добавлений в избранное есть и в профиле, и в списках, где он показан
+        self._forget_user(favorite_user_id)
+
+    async def remove_favorite(self, user_id, favorite_user_id):
+        await self._run(self._db.remove_favorite, user_id, favorite_user_id)
+        self._forget_favorites(user_id)
+        self._forget_user(favorite_user_id)
+
+    def cache_stats(self):
+        return {'users': self.users.stats(), 'favorites': self.favorites.stats(), 'media': self.media.stats()}
+
+db = CachedDatabase(open_database())
+
+# Хранилище состояний FSM
+FSM_DB_NAME = 'cinema_collab_fsm.db'
+FSM_STATE_TTL = 24 * 60 * 60  # незавершенные сценарии забываются через сутки
+FSM_EXPIRE_INTERVAL = 60 * 60
+
+class SQLiteStorage(BaseStorage):
+    """Хранилище FSM в SQLite.
+
+    Состояние, данные и bucket каждой пары (chat, user) лежат в одной строке
+    и пишутся в автокоммите. Запросы выполняются в отдельном потоке.
+
+    Файл отдельный от основной базы: Database под нагрузкой почти все время
+    держит открытую транзакцию (групповой commit), и второй писатель в тот же
+    файл не успевает взять блокировку за время ожидания.
+    """
+
+    def __init__(self, db_name=FSM_DB_NAME, ttl=FSM_STATE_TTL):
+        self.ttl = ttl
+        self.conn = sqlite3.connect(db_name, check_same_thread=False, isolation_level=None)
+        self.conn.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT * 1000}')
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            chat INTEGER,
+            user INTEGER,
+            state TEXT,
+            data TEXT,
+            bucket TEXT,
+            updated_at INTEGER,
+            PRIMARY KEY (chat, user)
+        ) WITHOUT ROWID''')
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fsm')
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(timed_call, 'bot_fsm_query', func, *args))
+
+    def _get(self, chat, user, column):
+        row = self.conn.execute(f'''
+        SELECT {column} FROM fsm_storage
+        WHERE chat = ? AND user = ? AND updated_at > ?''',
+        (chat, user, int(time.time()) - self.ttl)).fetchone()
+        return row[0] if row else None
+
+    def _set(self, chat, user, column, value):
+        # Просроченная строка не должна воскреснуть вместе со старыми данными
+        self.conn.execute('DELETE FROM fsm_storage WHERE chat = ? AND user = ? AND updated_at <= ?',
+                          (chat, user, int(time.time()) - self.ttl))
+        self.conn.execute(f'''
+        INSERT INTO fsm_storage (chat, user, {column}, updated_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT (chat, user) DO UPDATE SET {column} = excluded.{column}, updated_at = excluded.updated_at''',
+        (chat, user, value, int(time.time())))
+        # Пустые строки не храним
+        self.conn.execute('''
+        DELETE FROM fsm_storage
+        WHERE chat = ? AND user = ? AND state IS NULL AND data IS NULL AND bucket IS NULL''',
+        (chat, user))
+
+    def _update(self, chat, user, column, values):
+        # Чтение и запись в одной транзакции: update_data не теряет параллельные изменения
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            current = self._get(chat, user, column)
+            merged = json.loads(current) if current else {}
+            merged.update(values)
+            self._set(chat, user, column, self._dumps(merged))
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+
+    @staticmethod
+    def _dumps(value):
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':')) if value else None
+
+    def _expire(self):
+        self.conn.execute('DELETE FROM fsm_storage WHERE updated_at <= ?', (int(time.time()) - self.ttl,))
+
+    async def expire(self):
+        await self._run(self._expire)
+
+    def _state_counts(self):
+        return self.conn.execute('''
+        SELECT state, COUNT(*) FROM fsm_storage
+        WHERE state IS NOT NULL AND updated_at > ? GROUP BY state''',
+        (int(time.time()) - self.ttl,)).fetchall()
+
+    async def state_counts(self):
+        """Сколько пользователей сейчас в каждом состоянии FSM"""
+        return await self._run(self._state_counts)
+
+    async def close(self):
+        await self._run(self.conn.close)
+        self._executor.shutdown(wait=True)
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        chat, user = self.check_address(chat=chat, user=user)
+        state = await self._run(self._get, chat, user, 'state')
+        return state if state is not None else self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        chat, user = self.check_address(chat=chat, user=user)
+        data = await self._run(self._get, chat, user, 'data')
+        return json.loads(data) if data else (default or {})
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        chat, user = self.check_address(chat=chat, user=user)
+        await self._run(self._set, chat, user, 'state', self.resolve_state(state))
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        chat, user = self.check_address(chat=chat, user=user)
+        await self._run(self._set, chat, user, 'data', self._dumps(data))
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        chat, user = self.check_address(chat=chat, user=user)
+        if data is None:
+            data = {}
+        data.update(kwargs)
+        await self._run(self._update, chat, user, 'data', data)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None):
+        chat, user = self.check_address(chat=chat, user=user)
+        bucket = await self._run(self._get, chat, user, 'bucket')
+        return json.loads(bucket) if bucket else (default or {})
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        chat, user = self.check_address(chat=chat, user=user)
+        await self._run(self._set, chat, user, 'bucket', self._dumps(bucket))
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        chat, user = self.check_address(chat=chat, user=user)
+        if bucket is None:
+            bucket = {}
+        bucket.update(kwargs)
+        await self._run(self._update, chat, user, 'bucket', bucket)
+
+# Инициализация диспетчера
+storage = SQLiteStorage()
+dp = Dispatcher(bot, storage=storage)
+
+# Имя обработчика текущего обновления - для счетчика ошибок
+handler_name = ContextVar('handler_name', default='')
+
+class MetricsMiddleware(BaseMiddleware):
+    """Время обработки обновлений целиком и по обработчикам"""
+
+    async def on_pre_process_update(self, update, data):
+        data['_started'] = time.perf_counter()
+
+    async def on_post_process_update(self, update, results, data):
+        metrics.observe('bot_update_seconds', (), time.perf_counter() - data['_started'])
+
+    async def _start_handler(self, data):
+        # Для кнопок считаем обработчик из маршрута, а не общий route_callback
+        route = data.get('callback_route')
+        name = route[0].__name__ if route else current_handler.get().__name__
+        handler_name.set(name)
+        data['_handler'] = name
+        data['_handler_started'] = time.perf_counter()
+
+    async def _stop_handler(self, data):
+        if '_handler' in data:
+            metrics.observe('bot_handler_seconds', (('handler', data['_handler']),),
+                            time.perf_counter() - data['_handler_started'])
+
+    async def on_process_message(self, message, data):
+        await self._start_handler(data)
+
+    async def on_process_callback_query(self, callback, data):
+        await self._start_handler(data)
+
+    async def on_post_process_message(self, message, results, data):
+        await self._stop_handler(data)
+
+    async def on_post_process_callback_query(self, callback, results, data):
+        await self._stop_handler(data)
+
+dp.middleware.setup(MetricsMiddleware())
+
+@dp.errors_handler()
+async def count_errors(update, exception):
+    # Ничего не возвращаем: aiogram после этого сам выводит исключение в лог
+    metrics.inc('bot_handler_errors_total', (('handler', handler_name.get()), ('error', type(exception).__name__)))
+
+# Данные inline-кнопок: «версия:действие:аргументы:подпись», Telegram принимает не больше 64 байт
+CALLBACK_VERSION = '1'  # поднять, если меняется смысл аргументов: старые кнопки станут «устаревшими»
+CALLBACK_SIGNATURE_SIZE = 6  # байт HMAC-SHA256, в base64 - 8 символов
+CALLBACK_DATA_LIMIT = 64
+# Без CALLBACK_SECRET ключ выводится из токена бота: при смене токена старые кнопки перестают работать
+CALLBACK_SECRET = os.getenv('CALLBACK_SECRET') or hashlib.sha256(f"callback:{BOT_TOKEN}".encode()).hexdigest()
+
+class CallbackCodec:
+    """Подписанные данные кнопок: поддельное или чужой версии нажатие не дойдет до обработчика"""
+
+    def __init__(self, secret, version=CALLBACK_VERSION, signature_size=CALLBACK_SIGNATURE_SIZE):
+        self.secret = secret.encode()
+        self.version = version
+        self.signature_size = signature_size
+
+    def _sign(self, body):
+        digest = hmac.new(self.secret, body.encode(), hashlib.sha256).digest()[:self.signature_size]
+        return base64.urlsafe_b64encode(digest).decode().rstrip('=')
+
+    def encode(self, action, *args):
+        body = ':'.join((self.version, action, *map(str, args)))
+        if any(':' in str(arg) for arg in args):
+            raise ValueError(f"Аргумент кнопки {action} содержит ':'")
+        data = f"{body}:{self._sign(body)}"
+        if len(data.encode()) > CALLBACK_DATA_LIMIT:
+            raise ValueError(f"Данные кнопки {action} длиннее {CALLBACK_DATA_LIMIT} байт")
+        return data
+
+    def decode(self, data):
+        """(действие, [аргументы]) или None, если подпись или версия не сходится"""
+        body, _, signature = (data or '').rpartition(':')
+        if not hmac.compare_digest(signature.encode(), self._sign(body).encode()):
+            return None
+        version, action, *args = body.split(':')
+        if version != self.version:
+            return None
+        return action, args
+
+class CallbackRouter:
+    """Обработчики кнопок по действию: один поиск в словаре вместо перебора фильтров aiogram"""
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.routes = {}
+
+    def route(self, action, *converters):
+        """Регистрирует обработчик handler(callback, *аргументы[, state]); аргументы приводятся converters"""
+        def decorator(handler):
+            if action in self.routes:
+                raise ValueError(f"Действие {action} уже зарегистрировано")
+            wants_state = 'state' in inspect.signature(handler).parameters
+            self.routes[action] = (handler, converters, wants_state)
+            return handler
+        return decorator
+
+    def data(self, action, *args):
+        return self.codec.encode(action, *args)
+
+    def resolve(self, callback):
+        """Фильтр aiogram: найденный обработчик с аргументами попадает в data обновления"""
+        decoded = self.codec.decode(callback.data)
+        route = self.routes.get(decoded[0]) if decoded else None
+        if route is None or len(decoded[1]) != len(route[1]):
+            return {'callback_route': None}
+        handler, converters, wants_state = route
+        try:
+            args = [convert(arg) for convert, arg in zip(converters, decoded[1])]
+        except ValueError:
+            return {'callback_route': None}
+        return {'callback_route': (handler, args, wants_state)}
+
+callbacks = CallbackRouter(CallbackCodec(CALLBACK_SECRET))
+
+# Единственный обработчик кнопок; работает в любом состоянии, как и все кнопки бота
+@dp.callback_query_handler(callbacks.resolve, state='*')
+async def route_callback(callback: types.CallbackQuery, callback_route, state: FSMContext):
+    if callback_route is None:
+        await callback.answer("Кнопка устарела, откройте раздел заново")
+        return
+    handler, args, wants_state = callback_route
+    if wants_state:
+        await handler(callback, *args, state=state)
+    else:
+        await handler(callback, *args)
 
 # Классы состояний
 class ProfileStates(StatesGroup):
@@ -109,191 +671,439 @@ class ProfileStates(StatesGroup):
     profession = State()
     experience = State()
     portfolio = State()
+    media = State()
     location = State()
 
 class SearchStates(StatesGroup):
     department = State()
     profession = State()
+    experience = State()
+    location = State()
 
-# Полная структура цехов и профессий
-DEPARTMENTS = {
-    "Режиссерский цех": [
-        "Режиссеры-постановщики",
-        "Режиссеры анимации",
-        "Вторые режиссеры",
-        "Ассистенты второго режиссера",
-        "Ассистенты режиссера по актерам",
-        "Помощники режиссера",
-        "Бригадиры АМС",
-        "Кастинг-директора"
-    ],
-    "Звуковой цех": [
-        "Звукорежиссеры",
-        "Ассистенты звукорежиссера"
-    ],
-    "Операторский цех": [
-        "Вторые операторы",
-        "Камермены",
-        "Фокус-пуллеры",
-        "Операторы и пилоты коптеров",
-        "Осветители",
-        "Грип",
-        "Gaffer"
-    ],
-    "Художественно-постановочный цех": [
-        "Художники-постановщики",
-        "Ассистенты художника-постановщика",
-        "Декораторы",
-        "Постановщики кадра"
-    ],
-    "Художники по реквизиту": [
-        "Художники по реквизиту(ассистент режиссера по реквизиту)",
-        "Ассистенты художника по реквизиту",
-        "Реквизиторы"
-    ],
-    "Художники по гриму": [
-        "Художники по гриму",
-        "Ассистенты художника по гриму",
-        "Гримеры",
-        "Постижеры"
-    ],
-    "Художники по костюмам": [
-        "Художники по костюмам",
-        "Ассистенты художника по костюмам",
-        "Художники-фактуровщики",
-        "Костюмеры"
-    ],
-    "Актерский цех": [
-        "Исполнители ролей первого плана",
-        "Исполнители линейных ролей",
-        "Эпизодники",
-        "Дублеры",
-        "Статисты",
-        "Групповка",
-        "Актеры массовых сцен"
-    ],
-    "Продюсерский департамент": [
-        "Продюсеры кино и телевидения",
-        "Продюсеры анимации",
-        "Исполнительные продюсеры",
-        "Линейные продюсеры",
-        "Ассистенты продюсеров",
-        "Менеджеры подготовки кинообъектов (Локейшен-менеджеры)"
-    ],
-    "Административный цех": [
-        "Директора фильма",
-        "Заместители директора фильма (по подготовке, транспорту, объектам)",
-        "Инженер по охране труда",
-        "Администраторы съемочных групп и площадки",
-        "Координаторы",
-        "Рабочие",
-        "Буфет"
-    ],
-    "Транспортный цех": [
-        "Водители"
-    ],
-    "Каскадерско-пиротехнический департамент": [
-        "Постановщики трюков",
-        "Каскадеры",
-        "Пиротехники"
-    ],
-    "Цех скрипт-супервайзеров": [
-        "Скрипт-супервайзеры"
-    ],
-    "Монтажный цех": [
-        "Режиссеры монтажа",
-        "Ассистенты режиссера монтажа",
-        "Монтажеры",
-        "Логгеры"
-    ],
-    "Анимация": [
-        "Художники-постановщики анимационных фильмов",
-        "Концепт-художники",
-        "Художники персонажей",
-        "Художники по фонам",
-        "Режиссеры аниматика",
-        "Аниматикеры",
-        "Лейаут-художники",
-        "Художники-аниматоры",
-        "Прорисовщики",
-        "Заливщики",
-        "2D аниматоры (перекладка/гибридная анимация/костная)",
-        "2D риггинг",
-        "3D аниматоры",
-        "Stop-motion аниматоры",
-        "3D риггинг",
-        "Моделлеры",
-        "3D Лейаут",
-        "Компоузеры",
-        "Специалисты по свету",
-        "Рендер"
-    ]
-}
+class TextSearchStates(StatesGroup):
+    query = State()
 
-EXPERIENCE_LEVELS = ["Без опыта", "До 1 года", "1-3 года", "3-5 лет", "5+ лет"]
+# Количество профилей на одной странице результатов поиска
+SEARCH_PAGE_SIZE = 5
+# Сколько самых частых городов предлагать в поиске
+SEARCH_FACET_LIMIT = 10
+# Сколько профилей показывать в списках «Кто добавил меня» и «Взаимные»
+FAVORITES_LIST_LIMIT = 50
+RECOMMENDATIONS_LIMIT = 5
+PORTFOLIO_MEDIA_LIMIT = 10  # столько файлов помещается в один альбом Telegram
 
-# Клавиатуры
-def get_main_menu():
+# Альбомы, на которые уже ответили
+answered_media_groups = LRUCache(1000, 60)
+SAVED_SEARCHES_LIMIT = 10  # сохраненных поисков на пользователя
+SEARCH_DIGEST_INTERVAL = 60 * 60  # сводка новых профилей не чаще раза в час
+SEARCH_DIGEST_BATCH = 30  # подписчиков за один проход
+SEARCH_DIGEST_PROFILES = 10  # профилей в одной сводке, об остальных - только число
+
+# Клавиатуры строятся один раз при запуске и дальше только переиспользуются
+def _build_main_menu():
     keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
     keyboard.add("🔍 Поиск коллег", "👤 Мой профиль")
-    keyboard.add("⭐ Избранное")
+    keyboard.add("🔎 Поиск по тексту", "⭐ Избранное")
+    keyboard.add("✨ Рекомендации")
     return keyboard
 
-def get_departments_keyboard():
+def _build_departments_keyboard():
     keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
     keyboard.add(*DEPARTMENTS.keys())
     keyboard.add("🔙 Назад")
     return keyboard
 
-def get_professions_keyboard(department):
+def _build_professions_keyboard(department):
     keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    professions = DEPARTMENTS.get(department, [])
-    for profession in professions:
+    for profession in DEPARTMENTS.get(department, []):
         keyboard.add(profession)
     keyboard.add("🔙 Назад")
     return keyboard
 
-def get_profile_keyboard():
+def _build_profile_keyboard():
     keyboard = types.InlineKeyboardMarkup()
     keyboard.add(
-        types.InlineKeyboardButton("✏️ Редактировать", callback_data="edit_profile"),
-        types.InlineKeyboardButton("🗑️ Удалить анкету", callback_data="delete_profile")
+        types.InlineKeyboardButton("✏️ Редактировать", callback_data=callbacks.data('edit_profile')),
+        types.InlineKeyboardButton("🗑️ Удалить анкету", callback_data=callbacks.data('delete_profile'))
     )
     return keyboard
 
+def _build_delete_confirm_keyboard():
+    keyboard = types.InlineKeyboardMarkup()
+    keyboard.add(
+        types.InlineKeyboardButton("✅ Да, удалить", callback_data=callbacks.data('confirm_delete')),
+        types.InlineKeyboardButton("❌ Нет, отмена", callback_data=callbacks.data('cancel_delete'))
+    )
+    return keyboard
+
+MAIN_MENU_KEYBOARD = _build_main_menu()
+DEPARTMENTS_KEYBOARD = _build_departments_keyboard()
+PROFESSIONS_KEYBOARDS = {department: _build_professions_keyboard(department) for department in DEPARTMENTS}
+EMPTY_PROFESSIONS_KEYBOARD = _build_professions_keyboard(None)
+PROFILE_KEYBOARD = _build_profile_keyboard()
+DELETE_CONFIRM_KEYBOARD = _build_delete_confirm_keyboard()
+EXPERIENCE_KEYBOARD = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2).add(*EXPERIENCE_LEVELS).add("🔙 Назад")
+PORTFOLIO_KEYBOARD = types.ReplyKeyboardMarkup(resize_keyboard=True).add("Пропустить").add("🔙 Назад")
+MEDIA_KEYBOARD = types.ReplyKeyboardMarkup(resize_keyboard=True).add("✅ Готово", "Пропустить").add(
+    "🗑 Удалить фото и видео").add("🔙 Назад")
+LOCATION_KEYBOARD = types.ReplyKeyboardMarkup(resize_keyboard=True).add("🔙 Назад")
+
+def get_main_menu():
+    return MAIN_MENU_KEYBOARD
+
+def get_departments_keyboard():
+    return DEPARTMENTS_KEYBOARD
+
+def get_professions_keyboard(department):
+    return PROFESSIONS_KEYBOARDS.get(department, EMPTY_PROFESSIONS_KEYBOARD)
+
+def get_profile_keyboard():
+    return PROFILE_KEYBOARD
+
+# Карточки профилей
+PROFILE_CARD_CACHE_SIZE = 10000
+# Профиль могут изменить и не через обработчики бота (manage.py, другой процесс):
+# такие правки видны в карточках не позже чем через столько секунд
+PROFILE_CARD_TTL = 60
+
+profile_cards = LRUCache(PROFILE_CARD_CACHE_SIZE, PROFILE_CARD_TTL)
+
+def _cached_card(user, kind, render):
+    key = (user['user_id'], kind)
+    card = profile_cards.get(key)
+    if card is None:
+        card = render(user)
+        profile_cards.set(key, card)
+    return card
+
+def escape_html(value):
+    """Текст пользователя для сообщений с parse_mode HTML.
+
+    Карточки многих профилей собираются в одно сообщение: один неэкранированный
+    «<» в имени сломал бы всю страницу.
+    """
+    return html.escape(str(value), quote=False)
+
+def _render_public_card(user):
+    return (
+        f"<b>Имя:</b> {escape_html(user['full_name'])}\n"
+        f"<b>Цех:</b> {user['department']}\n"
+        f"<b>Профессия:</b> {user['profession']}\n"
+        f"<b>Опыт:</b> {user['experience']}\n"
+        f"<b>Локация:</b> {escape_html(user['location'])}\n\n"
+        f"<a href='tg://user?id={user['user_id']}'>Написать</a>"
+    )
+
+def _render_own_card(user):
+    return (
+        f"👤 <b>Ваш профиль:</b>\n\n"
+        f"<b>Цех:</b> {user['department'] or 'Не указано'}\n"
+        f"<b>Профессия:</b> {user['profession'] or 'Не указано'}\n"
+        f"<b>Опыт:</b> {user['experience'] or 'Не указано'}\n"
+        f"<b>Портфолио:</b> {escape_html(user['portfolio'] or 'Не указано')}\n"
+        f"<b>Локация:</b> {escape_html(user['location'] or 'Не указано')}\n\n"
+    )
+
+def render_profile_card(user, title):
+    """Карточка профиля для поиска и избранного"""
+    # Счетчик меняется чаще самого профиля, поэтому он не входит в кэш карточки
+    favorited = f"\n⭐ В избранном у {user['favorited']}" if user['favorited'] else ""
+    return f"👤 <b>{title}:</b>\n\n" + _cached_card(user, 'public', _render_public_card) + favorited
+
+def render_own_profile(user, footer):
+    favorited = f"⭐ Вас добавили в избранное: {user['favorited']}\n\n" if user['favorited'] else ""
+    media = f"🎬 Фото и видео в портфолио: {user['media']}\n\n" if user['media'] else ""
+    return _cached_card(user, 'own', _render_own_card) + media + favorited + footer
+
+def forget_profile_card(user_id):
+    """Сбрасываем карточки после изменения или удаления профиля"""
+    profile_cards.pop((user_id, 'public'))
+    profile_cards.pop((user_id, 'own'))
+
+# Очередь отправки сообщений
+GLOBAL_SEND_RATE = 30  # сообщений в секунду на весь бот
+CHAT_SEND_RATE = 1  # сообщений в секунду в один чат
+CHAT_SEND_BURST = 3  # сколько сообщений в чат можно отправить разом
+MESSAGE_LIMIT = 4096
+
+PRIORITY_INTERACTIVE = 0  # ответы на действия пользователя
+PRIORITY_BULK = 1  # списки профилей и рассылки
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class SendQueue:
+    """Общая очередь исходящих вызовов Bot API.
+
+    Ограничивает скорость отправки на весь бот и на каждый чат,
+    пропускает интерактивные ответы вперед массовых и прозрачно
+    повторяет вызов после RetryAfter. Порядок сообщений в одном чате
+    сохраняется.
+
+    У каждого чата своя очередь и своя задача отправки: ожидание лимита
+    чата или RetryAfter задерживает только этот чат. Общий токен берется,
+    когда чат уже готов отправить, и раздается в порядке приоритета.
+    """
+
+    def __init__(self, bot, global_rate=GLOBAL_SEND_RATE, chat_rate=CHAT_SEND_RATE, chat_burst=CHAT_SEND_BURST):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, global_rate)
+        # chat_id -> (TokenBucket, куча ожидающих вызовов)
+        self._chats = {}
+        self._senders = {}
+        # Чаты, ждущие общий токен: (priority, seq, future)
+        self._ready = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._worker = None
+
+    def __len__(self):
+        """Вызовов в очереди, еще не переданных Bot API"""
+        return sum(len(pending) for _, pending in self._chats.values())
+
+    def start(self):
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker:
+            self._worker.cancel()
+            self._worker = None
+        for task in list(self._senders.values()):
+            task.cancel()
+        self._senders.clear()
+
+    async def call(self, chat_id, method, /, *args, priority=PRIORITY_INTERACTIVE, **kwargs):
+        """Ставим вызов bot.<method>(*args, **kwargs) в очередь и ждем результат"""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        bucket, pending = self._chat(chat_id)
+        heapq.heappush(pending, (priority, next(self._seq), method, args, kwargs, future))
+        if chat_id not in self._senders:
+            self._senders[chat_id] = asyncio.create_task(self._send_chat(chat_id, bucket, pending))
+        return await future
+
+    async def send_message(self, chat_id, text, priority=PRIORITY_INTERACTIVE, **kwargs):
+        return await self.call(chat_id, 'send_message', chat_id, text, priority=priority, **kwargs)
+
+    def _chat(self, chat_id):
+        if chat_id not in self._chats:
+            if len(self._chats) >= 10000:
+                # Забываем чаты, в которые давно ничего не отправляли
+                self._chats = {
+                    key: value for key, value in self._chats.items()
+                    if value[1] or key in self._senders or not value[0].is_full()
+                }
+            self._chats[chat_id] = (TokenBucket(self.chat_rate, self.chat_burst), [])
+        return self._chats[chat_id]
+
+    async def _turn(self, priority):
+        """Ждем общий токен: интерактивные вызовы получают его раньше массовых"""
+        future = asyncio.get_running_loop().create_future()
+        await self._ready.put((priority, next(self._seq), future))
+        await future
+
+    async def _run(self):
+        while True:
+            _, _, future = await self._ready.get()
+            if future.done():
+                # Задача чата отменена, пока ждала очереди
+                continue
+            await self._global.acquire()
+            if not future.done():
+                future.set_result(None)
+
+    async def _send_chat(self, chat_id, bucket, pending):
+        try:
+            while pending:
+                priority, _, method, args, kwargs, future = heapq.heappop(pending)
+                if future.done():
+                    # Вызывающий уже не ждет результата (например, отмененная рассылка)
+                    continue
+                await bucket.acquire()
+                while True:
+                    await self._turn(priority)
+                    try:
+                        result = await getattr(self.bot, method)(*args, **kwargs)
+                    except RetryAfter as e:
+                        logger.warning(f"Превышен лимит Telegram в чате {chat_id}, ждем {e.timeout} с")
+                        await asyncio.sleep(e.timeout)
+                        continue
+                    except Exception as e:
+                        if not future.done():
+                            future.set_exception(e)
+                        break
+                    if not future.done():
+                        future.set_result(result)
+                    break
+        finally:
+            self._senders.pop(chat_id, None)
+
+def pack_cards(cards, limit=MESSAGE_LIMIT, separator="\n\n"):
+    """Группируем карточки так, чтобы каждая группа помещалась в одно сообщение"""
+    groups = []
+    group, size = [], 0
+    for card in cards:
+        extra = len(card) + (len(separator) if group else 0)
+        if group and size + extra > limit:
+            groups.append(group)
+            group, size = [], 0
+            extra = len(card)
+        group.append(card)
+        size += extra
+    if group:
+        groups.append(group)
+    return groups
+
+sender = SendQueue(bot)
+
+async def answer(message, text, priority=PRIORITY_INTERACTIVE, **kwargs):
+    """Ответ в чат сообщения через общую очередь отправки"""
+    return await sender.send_message(message.chat.id, text, priority=priority, **kwargs)
+
+async def edit_text(message, text, **kwargs):
+    return await sender.call(message.chat.id, 'edit_message_text', text,
+                             chat_id=message.chat.id, message_id=message.message_id, **kwargs)
+
+async def edit_reply_markup(message, reply_markup=None):
+    return await sender.call(message.chat.id, 'edit_message_reply_markup',
+                             chat_id=message.chat.id, message_id=message.message_id, reply_markup=reply_markup)
+
+# Telegram позволяет удалять сообщения бота только в течение 48 часов
+MESSAGE_DELETE_WINDOW = 48 * 60 * 60
+CLEANUP_CONCURRENCY = 5
+
 # Хранилище для ID сообщений бота
-user_message_ids = {}
+TRACKED_MESSAGES_PER_CHAT = 50
+TRACKED_MESSAGES_EXPIRE_INTERVAL = 60 * 60
+TRACKED_MESSAGES_PERSIST = True  # сохранять между перезапусками
+# При падении процесса теряются только сообщения, отправленные после последнего сохранения
+TRACKED_MESSAGES_SAVE_INTERVAL = 5 * 60
+
+class TrackedMessages:
+    """Сообщения бота, которые нужно удалить при следующей очистке чата.
+
+    Для каждого чата хранится array('q') с парами (message_id, sent_at)
+    в порядке отправки: не больше per_chat сообщений и не старше ttl.
+    """
+
+    def __init__(self, per_chat=TRACKED_MESSAGES_PER_CHAT, ttl=MESSAGE_DELETE_WINDOW):
+        self.per_chat = per_chat
+        self.ttl = ttl
+        self._chats = {}
+
+    def __len__(self):
+        return len(self._chats)
+
+    def add(self, chat_id, message_id, sent_at=None):
+        items = self._chats.get(chat_id)
+        if items is None:
+            items = self._chats[chat_id] = array('q')
+        items.extend((message_id, int(sent_at if sent_at is not None else time.time())))
+        if len(items) > 2 * self.per_chat:
+            del items[:2]
+
+    def pop(self, chat_id):
+        items = self._chats.pop(chat_id, None)
+        if not items:
+            return []
+        return list(zip(items[::2], items[1::2]))
+
+    def expire(self, now=None):
+        """Забываем сообщения, которые уже нельзя удалить, и пустые чаты"""
+        deadline = (now if now is not None else time.time()) - self.ttl
+        for chat_id in list(self._chats):
+            items = self._chats[chat_id]
+            keep = 0
+            while keep < len(items) and items[keep + 1] <= deadline:
+                keep += 2
+            if keep == len(items):
+                del self._chats[chat_id]
+            elif keep:
+                del items[:keep]
+
+    def dump(self):
+        for chat_id, items in self._chats.items():
+            for i in range(0, len(items), 2):
+                yield chat_id, items[i], items[i + 1]
+
+    def load(self, rows):
+        for chat_id, message_id, sent_at in rows:
+            self.add(chat_id, message_id, sent_at)
+
+tracked_messages = TrackedMessages()
+
+cleanup_semaphore = asyncio.Semaphore(CLEANUP_CONCURRENCY)
+cleanup_stats = {'deleted': 0, 'failed': 0, 'skipped': 0}
+cleanup_tasks = set()
 
 async def cleanup_chat(chat_id):
-    """Удаляем только сообщения бота"""
-    try:
-        if chat_id in user_message_ids:
-            for msg_id in user_message_ids[chat_id]:
-                try:
-                    await bot.delete_message(chat_id, msg_id)
-                except:
-                    continue
-            user_message_ids[chat_id] = []
-    except Exception as e:
-        logger.error(f"Ошибка при очистке чата: {e}")
+    """Удаляем только сообщения бота - в фоне, не задерживая ответ"""
+    messages = tracked_messages.pop(chat_id)
+    if messages:
+        task = asyncio.create_task(delete_messages(chat_id, messages))
+        cleanup_tasks.add(task)
+        task.add_done_callback(cleanup_tasks.discard)
+
+async def delete_messages(chat_id, messages):
+    deadline = time.time() - MESSAGE_DELETE_WINDOW
+    fresh = [message_id for message_id, sent_at in messages if sent_at > deadline]
+    cleanup_stats['skipped'] += len(messages) - len(fresh)
+    await asyncio.gather(*(delete_message(chat_id, message_id) for message_id in fresh))
+    logger.debug(f"Очистка чата {chat_id}: {cleanup_stats}")
+
+async def delete_message(chat_id, message_id):
+    async with cleanup_semaphore:
+        try:
+            # Через общую очередь: удаления делят лимиты с отправкой, а после
+            # RetryAfter вызов повторяется, а не теряется
+            await sender.call(chat_id, 'delete_message', chat_id, message_id, priority=PRIORITY_BULK)
+            cleanup_stats['deleted'] += 1
+        except (MessageToDeleteNotFound, MessageCantBeDeleted):
+            # Сообщение уже удалено пользователем или слишком старое
+            cleanup_stats['skipped'] += 1
+        except Exception as e:
+            cleanup_stats['failed'] += 1
+            logger.warning(f"Ошибка при удалении сообщения {message_id} в чате {chat_id}: {e}")
 
 async def track_message(chat_id, message_id):
     """Отслеживаем сообщения бота"""
-    if chat_id not in user_message_ids:
-        user_message_ids[chat_id] = []
-    user_message_ids[chat_id].append(message_id)
+    tracked_messages.add(chat_id, message_id)
 
 # Обработчики команд
 @dp.message_handler(commands=['start', 'help'])
 async def cmd_start(message: types.Message):
     await cleanup_chat(message.chat.id)
-    db.add_user(message.from_user.id, message.from_user.username, message.from_user.full_name)
-    msg = await message.answer(
+    await db.add_user(message.from_user.id, message.from_user.username, message.from_user.full_name)
+    msg = await answer(message, 
         "👋 Добро пожаловать в бот для поиска коллег в киноиндустрии!\n"
         "Вы можете создать профиль и найти специалистов для совместной работы.\n\n"
         "Доступные команды:\n"
         "/start - начать работу с ботом\n"
         "/help - помощь\n"
+        "/searches - сохраненные поиски\n"
         "Используйте кнопки меню для навигации",
         reply_markup=get_main_menu()
     )
@@ -302,127 +1112,165 @@ async def cmd_start(message: types.Message):
 @dp.message_handler(text="👤 Мой профиль")
 async def my_profile(message: types.Message):
     await cleanup_chat(message.chat.id)
-    user = db.get_user(message.from_user.id)
+    user = await db.get_user(message.from_user.id)
     if not user:
-        msg = await message.answer("Профиль не найден. Начните с команды /start", reply_markup=get_main_menu())
+        msg = await answer(message, "Профиль не найден. Начните с команды /start", reply_markup=get_main_menu())
         await track_message(message.chat.id, msg.message_id)
         return
     
-    profile_text = (
-        f"👤 <b>Ваш профиль:</b>\n\n"
-        f"<b>Цех:</b> {user[3] or 'Не указано'}\n"
-        f"<b>Профессия:</b> {user[4] or 'Не указано'}\n"
-        f"<b>Опыт:</b> {user[5] or 'Не указано'}\n"
-        f"<b>Портфолио:</b> {user[6] or 'Не указано'}\n"
-        f"<b>Локация:</b> {user[7] or 'Не указано'}\n\n"
-        "Используйте кнопки ниже для управления профилем."
-    )
+    profile_text = render_own_profile(user, "Используйте кнопки ниже для управления профилем.")
     
-    msg = await message.answer(profile_text, reply_markup=get_profile_keyboard(), parse_mode="HTML")
+    msg = await answer(message, profile_text, reply_markup=get_profile_keyboard(), parse_mode="HTML")
     await track_message(message.chat.id, msg.message_id)
 
-@dp.callback_query_handler(text="edit_profile")
-async def edit_profile(callback: types.CallbackQuery):
+@callbacks.route('edit_profile')
+async def edit_profile(callback: types.CallbackQuery, state: FSMContext):
     await cleanup_chat(callback.message.chat.id)
-    msg = await callback.message.answer("Выберите цех:", reply_markup=get_departments_keyboard())
+    msg = await answer(callback.message, "Выберите цех:", reply_markup=get_departments_keyboard())
     await track_message(callback.message.chat.id, msg.message_id)
     await ProfileStates.department.set()
+    # Файлы из брошенного раньше редактирования не должны попасть в профиль
+    await state.update_data(media_since=msg.message_id, media_action=None)
     await callback.answer()
 
-@dp.callback_query_handler(text="delete_profile")
+@callbacks.route('delete_profile')
 async def delete_profile(callback: types.CallbackQuery):
-    keyboard = types.InlineKeyboardMarkup()
-    keyboard.add(
-        types.InlineKeyboardButton("✅ Да, удалить", callback_data="confirm_delete"),
-        types.InlineKeyboardButton("❌ Нет, отмена", callback_data="cancel_delete")
-    )
-    await callback.message.edit_text(
+    await edit_text(
+        callback.message,
         "⚠️ Вы уверены, что хотите удалить свой профиль?\n"
         "Это действие нельзя отменить! Все ваши данные будут безвозвратно удалены.",
-        reply_markup=keyboard
+        reply_markup=DELETE_CONFIRM_KEYBOARD
     )
     await callback.answer()
 
-@dp.callback_query_handler(text="confirm_delete")
+@callbacks.route('confirm_delete')
 async def confirm_delete(callback: types.CallbackQuery):
-    db.delete_user(callback.from_user.id)
-    msg = await callback.message.answer("🗑️ Ваш профиль успешно удален!", reply_markup=get_main_menu())
+    await db.delete_user(callback.from_user.id)
+    forget_profile_card(callback.from_user.id)
+    msg = await answer(callback.message, "🗑️ Ваш профиль успешно удален!", reply_markup=get_main_menu())
     await track_message(callback.message.chat.id, msg.message_id)
     await callback.answer()
 
-@dp.callback_query_handler(text="cancel_delete")
+@callbacks.route('cancel_delete')
 async def cancel_delete(callback: types.CallbackQuery):
-    user = db.get_user(callback.from_user.id)
+    user = await db.get_user(callback.from_user.id)
     if user:
-        profile_text = (
-            f"👤 <b>Ваш профиль:</b>\n\n"
-            f"<b>Цех:</b> {user[3] or 'Не указано'}\n"
-            f"<b>Профессия:</b> {user[4] or 'Не указано'}\n"
-            f"<b>Опыт:</b> {user[5] or 'Не указано'}\n"
-            f"<b>Портфолио:</b> {user[6] or 'Не указано'}\n"
-            f"<b>Локация:</b> {user[7] or 'Не указано'}\n\n"
-            "Удаление профиля отменено."
-        )
-        await callback.message.edit_text(profile_text, reply_markup=get_profile_keyboard(), parse_mode="HTML")
+        profile_text = render_own_profile(user, "Удаление профиля отменено.")
+        await edit_text(callback.message, profile_text, reply_markup=get_profile_keyboard(), parse_mode="HTML")
     else:
-        await callback.message.edit_text("Удаление профиля отменено.", reply_markup=get_main_menu())
+        await edit_text(callback.message, "Удаление профиля отменено.", reply_markup=get_main_menu())
     await callback.answer()
 
 @dp.message_handler(text="🔍 Поиск коллег")
 async def search_colleagues(message: types.Message):
     await cleanup_chat(message.chat.id)
-    msg = await message.answer("Выберите цех для поиска:", reply_markup=get_departments_keyboard())
+    msg = await answer(message, "Выберите цех для поиска:", reply_markup=get_departments_keyboard())
     await track_message(message.chat.id, msg.message_id)
     await SearchStates.department.set()
 
 @dp.message_handler(text="⭐ Избранное")
 async def show_favorites(message: types.Message):
     await cleanup_chat(message.chat.id)
-    favorites = db.get_favorites(message.from_user.id)
+    favorites = await db.get_favorites(message.from_user.id)
+    keyboard = await build_favorites_menu(message.from_user.id)
     if not favorites:
-        msg = await message.answer("У вас пока нет избранных профилей.", reply_markup=get_main_menu())
+        msg = await answer(message, "У вас пока нет избранных профилей.", reply_markup=keyboard)
         await track_message(message.chat.id, msg.message_id)
         return
     
-    main_msg = await message.answer("Ваши избранные профили:", reply_markup=get_main_menu())
+    main_msg = await answer(message, "Ваши избранные профили:", reply_markup=keyboard)
     await track_message(message.chat.id, main_msg.message_id)
+    await send_profile_cards(message, favorites, "Профиль", is_favorite=True)
+
+async def build_favorites_menu(user_id):
+    user = await db.get_user(user_id)
+    admirers = user['favorited'] if user else 0
+    mutual = await db.count_mutual_favorites(user_id)
+    keyboard = types.InlineKeyboardMarkup()
+    keyboard.add(types.InlineKeyboardButton(f"👀 Кто добавил меня ({admirers})",
+                                            callback_data=callbacks.data('favorites_admirers')))
+    keyboard.add(types.InlineKeyboardButton(f"💞 Взаимные ({mutual})", callback_data=callbacks.data('favorites_mutual')))
+    return keyboard
+
+async def send_profile_cards(message, users, title, is_favorite=None):
+    """Карточки с кнопками избранного, по нескольку в одном сообщении.
+
+    is_favorite=None - признак берется из колонки is_favorite каждой строки.
+    """
+    cards = [render_profile_card(user, f"#{number} {title}") for number, user in enumerate(users, 1)]
     
-    for user in favorites:
-        profile_text = (
-            f"👤 <b>Профиль:</b>\n\n"
-            f"<b>Имя:</b> {user[2]}\n"
-            f"<b>Цех:</b> {user[3]}\n"
-            f"<b>Профессия:</b> {user[4]}\n"
-            f"<b>Опыт:</b> {user[5]}\n"
-            f"<b>Локация:</b> {user[7]}\n\n"
-            f"<a href='tg://user?id={user[0]}'>Написать</a>"
-        )
-        
+    # Несколько карточек в одном сообщении вместо сообщения на каждый профиль
+    number = 0
+    for group in pack_cards(cards):
         keyboard = types.InlineKeyboardMarkup()
-        keyboard.add(types.InlineKeyboardButton(
-            "❌ Удалить из избранного", 
-            callback_data=f"remove_favorite_{user[0]}"
-        ))
+        for _ in group:
+            user = users[number]
+            number += 1
+            keyboard.row(*get_profile_buttons(
+                user, user['is_favorite'] if is_favorite is None else is_favorite, f" #{number}"
+            ))
         
-        msg = await message.answer(profile_text, reply_markup=keyboard, parse_mode="HTML")
+        msg = await answer(message, "\n\n".join(group), reply_markup=keyboard, parse_mode="HTML",
+                           priority=PRIORITY_BULK)
+        await track_message(message.chat.id, msg.message_id)
+
+@callbacks.route('favorites_admirers')
+async def show_admirers(callback: types.CallbackQuery):
+    admirers = await db.get_admirers(callback.from_user.id, limit=FAVORITES_LIST_LIMIT + 1)
+    if not admirers:
+        await callback.answer("Пока никто не добавил вас в избранное")
+        return
+    
+    text = "👀 Вас добавили в избранное:"
+    if len(admirers) > FAVORITES_LIST_LIMIT:
+        admirers = admirers[:FAVORITES_LIST_LIMIT]
+        text += f" (первые {FAVORITES_LIST_LIMIT})"
+    msg = await answer(callback.message, text)
+    await track_message(callback.message.chat.id, msg.message_id)
+    await send_profile_cards(callback.message, admirers, "Добавил(а) вас")
+    await callback.answer()
+
+@callbacks.route('favorites_mutual')
+async def show_mutual_favorites(callback: types.CallbackQuery):
+    mutual = await db.get_mutual_favorites(callback.from_user.id, limit=FAVORITES_LIST_LIMIT)
+    if not mutual:
+        await callback.answer("Взаимных добавлений пока нет")
+        return
+    
+    msg = await answer(callback.message, "💞 Вы добавили друг друга в избранное:")
+    await track_message(callback.message.chat.id, msg.message_id)
+    await send_profile_cards(callback.message, mutual, "Взаимно", is_favorite=True)
+    await callback.answer()
+
+@dp.message_handler(text="✨ Рекомендации")
+async def show_recommendations(message: types.Message):
+    await cleanup_chat(message.chat.id)
+    recommendations = await db.get_recommendations(message.from_user.id, limit=RECOMMENDATIONS_LIMIT)
+    if not recommendations:
+        msg = await answer(message, "Пока нечего порекомендовать. Загляните позже!", reply_markup=get_main_menu())
         await track_message(message.chat.id, msg.message_id)
+        return
+    
+    main_msg = await answer(message, "✨ Возможно, вам будут интересны эти коллеги:", reply_markup=get_main_menu())
+    await track_message(message.chat.id, main_msg.message_id)
+    await send_profile_cards(message, recommendations, "Рекомендация", is_favorite=False)
 
 # Обработчики состояний для профиля
 @dp.message_handler(state=ProfileStates.department)
 async def process_department(message: types.Message, state: FSMContext):
     if message.text == "🔙 Назад":
         await state.finish()
-        msg = await message.answer("Главное меню:", reply_markup=get_main_menu())
+        msg = await answer(message, "Главное меню:", reply_markup=get_main_menu())
         await track_message(message.chat.id, msg.message_id)
         return
     
     if message.text not in DEPARTMENTS:
-        msg = await message.answer("Пожалуйста, выберите цех из списка:", reply_markup=get_departments_keyboard())
+        msg = await answer(message, "Пожалуйста, выберите цех из списка:", reply_markup=get_departments_keyboard())
         await track_message(message.chat.id, msg.message_id)
         return
     
     await state.update_data(department=message.text)
-    msg = await message.answer("Выберите профессию:", reply_markup=get_professions_keyboard(message.text))
+    msg = await answer(message, "Выберите профессию:", reply_markup=get_professions_keyboard(message.text))
     await track_message(message.chat.id, msg.message_id)
     await ProfileStates.profession.set()
 
@@ -431,7 +1279,7 @@ async def process_profession(message: types.Message, state: FSMContext):
     if message.text == "🔙 Назад":
         await ProfileStates.department.set()
         data = await state.get_data()
-        msg = await message.answer("Выберите цех:", reply_markup=get_departments_keyboard())
+        msg = await answer(message, "Выберите цех:", reply_markup=get_departments_keyboard())
         await track_message(message.chat.id, msg.message_id)
         return
     
@@ -439,14 +1287,12 @@ async def process_profession(message: types.Message, state: FSMContext):
     department = data.get('department')
     
     if message.text not in DEPARTMENTS.get(department, []):
-        msg = await message.answer("Пожалуйста, выберите профессию из списка:", reply_markup=get_professions_keyboard(department))
+        msg = await answer(message, "Пожалуйста, выберите профессию из списка:", reply_markup=get_professions_keyboard(department))
         await track_message(message.chat.id, msg.message_id)
         return
     
     await state.update_data(profession=message.text)
-    msg = await message.answer("Укажите ваш опыт:", reply_markup=types.ReplyKeyboardMarkup(
-        resize_keyboard=True, row_width=2
-    ).add(*EXPERIENCE_LEVELS).add("🔙 Назад"))
+    msg = await answer(message, "Укажите ваш опыт:", reply_markup=EXPERIENCE_KEYBOARD)
     await track_message(message.chat.id, msg.message_id)
     await ProfileStates.experience.set()
 
@@ -455,21 +1301,17 @@ async def process_experience(message: types.Message, state: FSMContext):
     if message.text == "🔙 Назад":
         data = await state.get_data()
         await ProfileStates.profession.set()
-        msg = await message.answer("Выберите профессию:", reply_markup=get_professions_keyboard(data.get('department')))
+        msg = await answer(message, "Выберите профессию:", reply_markup=get_professions_keyboard(data.get('department')))
         await track_message(message.chat.id, msg.message_id)
         return
     
     if message.text not in EXPERIENCE_LEVELS:
-        msg = await message.answer("Пожалуйста, выберите уровень опыта из списка:", reply_markup=types.ReplyKeyboardMarkup(
-            resize_keyboard=True, row_width=2
-        ).add(*EXPERIENCE_LEVELS).add("🔙 Назад"))
+        msg = await answer(message, "Пожалуйста, выберите уровень опыта из списка:", reply_markup=EXPERIENCE_KEYBOARD)
         await track_message(message.chat.id, msg.message_id)
         return
     
     await state.update_data(experience=message.text)
-    msg = await message.answer("Пришлите ссылку на ваше портфолио (если есть):", reply_markup=types.ReplyKeyboardMarkup(
-        resize_keyboard=True
-    ).add("Пропустить").add("🔙 Назад"))
+    msg = await answer(message, "Пришлите ссылку на ваше портфолио (если есть):", reply_markup=PORTFOLIO_KEYBOARD)
     await track_message(message.chat.id, msg.message_id)
     await ProfileStates.portfolio.set()
 
@@ -477,43 +1319,88 @@ async def process_experience(message: types.Message, state: FSMContext):
 async def process_portfolio(message: types.Message, state: FSMContext):
     if message.text == "🔙 Назад":
         await ProfileStates.experience.set()
-        msg = await message.answer("Укажите ваш опыт:", reply_markup=types.ReplyKeyboardMarkup(
-            resize_keyboard=True, row_width=2
-        ).add(*EXPERIENCE_LEVELS).add("🔙 Назад"))
+        msg = await answer(message, "Укажите ваш опыт:", reply_markup=EXPERIENCE_KEYBOARD)
         await track_message(message.chat.id, msg.message_id)
         return
     
     portfolio = message.text if message.text != "Пропустить" else ""
     await state.update_data(portfolio=portfolio)
-    msg = await message.answer("Укажите вашу локацию (город):", reply_markup=types.ReplyKeyboardMarkup(
-        resize_keyboard=True
-    ).add("🔙 Назад"))
+    await ask_media(message)
+
+async def ask_media(message):
+    msg = await answer(message, f"Пришлите фото или видео для портфолио (до {PORTFOLIO_MEDIA_LIMIT}, можно альбомом) "
+                                f"и нажмите «✅ Готово». «Пропустить» оставит текущие.", reply_markup=MEDIA_KEYBOARD)
+    await track_message(message.chat.id, msg.message_id)
+    await ProfileStates.media.set()
+
+def get_draft_media(data):
+    """Фото и видео, присланные в этом редактировании, в порядке отправки"""
+    since = data.get('media_since', 0)
+    items = sorted(value for key, value in data.items() if key.startswith('draft_media_'))
+    return [(kind, file_id, file_unique_id) for message_id, kind, file_id, file_unique_id in items
+            if message_id > since][:PORTFOLIO_MEDIA_LIMIT]
+
+@dp.message_handler(content_types=[types.ContentType.PHOTO, types.ContentType.VIDEO], state=ProfileStates.media)
+async def process_media_file(message: types.Message, state: FSMContext):
+    if message.photo:
+        kind, file = 'photo', message.photo[-1]  # самый крупный размер
+    else:
+        kind, file = 'video', message.video
+    # Каждый файл под своим ключом: сообщения альбома приходят разом, и слияние
+    # данных в хранилище FSM не теряет ни одно из них
+    await state.update_data({f"draft_media_{file.file_unique_id}": [message.message_id, kind, file.file_id, file.file_unique_id]})
+    
+    # На альбом отвечаем один раз, а не на каждый файл
+    if message.media_group_id:
+        if message.media_group_id in answered_media_groups:
+            return
+        answered_media_groups.set(message.media_group_id, True)
+    msg = await answer(message, "Добавлено. Пришлите еще или нажмите «✅ Готово».", reply_markup=MEDIA_KEYBOARD)
+    await track_message(message.chat.id, msg.message_id)
+
+@dp.message_handler(state=ProfileStates.media)
+async def process_media(message: types.Message, state: FSMContext):
+    if message.text == "🔙 Назад":
+        await ProfileStates.portfolio.set()
+        msg = await answer(message, "Пришлите ссылку на ваше портфолио (если есть):", reply_markup=PORTFOLIO_KEYBOARD)
+        await track_message(message.chat.id, msg.message_id)
+        return
+    
+    actions = {"✅ Готово": 'replace', "Пропустить": 'keep', "🗑 Удалить фото и видео": 'clear'}
+    if message.text not in actions:
+        msg = await answer(message, "Пришлите фото или видео либо выберите вариант на клавиатуре.",
+                           reply_markup=MEDIA_KEYBOARD)
+        await track_message(message.chat.id, msg.message_id)
+        return
+    
+    await state.update_data(media_action=actions[message.text])
+    msg = await answer(message, "Укажите вашу локацию (город):", reply_markup=LOCATION_KEYBOARD)
     await track_message(message.chat.id, msg.message_id)
     await ProfileStates.location.set()
 
 @dp.message_handler(state=ProfileStates.location)
 async def process_location(message: types.Message, state: FSMContext):
     if message.text == "🔙 Назад":
-        await ProfileStates.portfolio.set()
-        msg = await message.answer("Пришлите ссылку на ваше портфолио (если есть):", reply_markup=types.ReplyKeyboardMarkup(
-            resize_keyboard=True
-        ).add("Пропустить").add("🔙 Назад"))
-        await track_message(message.chat.id, msg.message_id)
+        await ask_media(message)
         return
     
     data = await state.get_data()
     
-    db.update_profile(
+    await db.update_profile(
         message.from_user.id,
         department=data.get('department'),
         profession=data.get('profession'),
         experience=data.get('experience'),
         portfolio=data.get('portfolio', ''),
-        location=message.text
+        location=canonical_city(message.text)
     )
+    media = get_draft_media(data)
+    if data.get('media_action') == 'clear' or (data.get('media_action') == 'replace' and media):
+        await db.set_profile_media(message.from_user.id, media if data['media_action'] == 'replace' else [])
+    forget_profile_card(message.from_user.id)
     
     await state.finish()
-    msg = await message.answer("✅ Ваш профиль успешно обновлен!", reply_markup=get_main_menu())
+    msg = await answer(message, "✅ Ваш профиль успешно обновлен!", reply_markup=get_main_menu())
     await track_message(message.chat.id, msg.message_id)
 
 # Обработчики состояний для поиска
@@ -521,17 +1408,17 @@ async def process_location(message: types.Message, state: FSMContext):
 async def search_department(message: types.Message, state: FSMContext):
     if message.text == "🔙 Назад":
         await state.finish()
-        msg = await message.answer("Главное меню:", reply_markup=get_main_menu())
+        msg = await answer(message, "Главное меню:", reply_markup=get_main_menu())
         await track_message(message.chat.id, msg.message_id)
         return
     
     if message.text not in DEPARTMENTS:
-        msg = await message.answer("Пожалуйста, выберите цех из списка:", reply_markup=get_departments_keyboard())
+        msg = await answer(message, "Пожалуйста, выберите цех из списка:", reply_markup=get_departments_keyboard())
         await track_message(message.chat.id, msg.message_id)
         return
     
     await state.update_data(department=message.text)
-    msg = await message.answer("Выберите профессию:", reply_markup=get_professions_keyboard(message.text))
+    msg = await answer(message, "Выберите профессию:", reply_markup=get_professions_keyboard(message.text))
     await track_message(message.chat.id, msg.message_id)
     await SearchStates.profession.set()
 
@@ -539,7 +1426,7 @@ async def search_department(message: types.Message, state: FSMContext):
 async def search_profession(message: types.Message, state: FSMContext):
     if message.text == "🔙 Назад":
         await SearchStates.department.set()
-        msg = await message.answer("Выберите цех:", reply_markup=get_departments_keyboard())
+        msg = await answer(message, "Выберите цех:", reply_markup=get_departments_keyboard())
         await track_message(message.chat.id, msg.message_id)
         return
     
@@ -547,83 +1434,759 @@ async def search_profession(message: types.Message, state: FSMContext):
     department = data.get('department')
     
     if message.text not in DEPARTMENTS.get(department, []):
-        msg = await message.answer("Пожалуйста, выберите профессию из списка:", reply_markup=get_professions_keyboard(department))
+        msg = await answer(message, "Пожалуйста, выберите профессию из списка:", reply_markup=get_professions_keyboard(department))
         await track_message(message.chat.id, msg.message_id)
         return
     
-    results = db.search_users(
-        department=department,
-        profession=message.text
-    )
+    search = {'department': department, 'profession': message.text}
+    total = await db.count_users(**search)
     
-    if not results:
-        msg = await message.answer("Никого не найдено. Попробуйте изменить параметры поиска.", 
+    if not total:
+        msg = await answer(message, "Никого не найдено. Попробуйте изменить параметры поиска.", 
                            reply_markup=get_professions_keyboard(department))
         await track_message(message.chat.id, msg.message_id)
         return
     
-    main_msg = await message.answer(f"🔍 Найдено {len(results)} специалистов:", reply_markup=get_main_menu())
+    await state.update_data(search=search)
+    await ask_search_experience(message, search, total)
+
+def split_facet_label(text):
+    """«Москва (132)» -> «Москва»"""
+    label, _, count = text.rpartition(' (')
+    return label if label and count.endswith(')') else text
+
+def build_facet_keyboard(counts, any_label, total):
+    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+    keyboard.add(f"{any_label} ({total})")
+    keyboard.add(*(f"{value} ({count})" for value, count in counts))
+    keyboard.add("🔙 Назад")
+    return keyboard
+
+async def ask_search_experience(message, search, total):
+    counts = await db.facet_counts('experience', **search)
+    # Уровни опыта показываем в естественном порядке
+    counts = sorted(counts, key=lambda item: EXPERIENCE_LEVELS.index(item[0]) if item[0] in EXPERIENCE_LEVELS else len(EXPERIENCE_LEVELS))
+    msg = await answer(message, f"Найдено {total}. Уточните опыт:",
+                       reply_markup=build_facet_keyboard(counts, "Любой опыт", total))
+    await track_message(message.chat.id, msg.message_id)
+    await SearchStates.experience.set()
+
+async def ask_search_location(message, search, total):
+    counts = await db.facet_counts('location', limit=SEARCH_FACET_LIMIT, **search)
+    msg = await answer(message, f"Найдено {total}. Выберите город или напишите свой:",
+                       reply_markup=build_facet_keyboard(counts, "Любой город", total))
+    await track_message(message.chat.id, msg.message_id)
+    await SearchStates.location.set()
+
+@dp.message_handler(state=SearchStates.experience)
+async def search_experience(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    search = data.get('search', {})
+    search.pop('experience', None)
+    
+    if message.text == "🔙 Назад":
+        await SearchStates.profession.set()
+        msg = await answer(message, "Выберите профессию:", reply_markup=get_professions_keyboard(search.get('department')))
+        await track_message(message.chat.id, msg.message_id)
+        return
+    
+    experience = split_facet_label(message.text)
+    if experience != "Любой опыт":
+        if experience not in EXPERIENCE_LEVELS:
+            await ask_search_experience(message, search, await db.count_users(**search))
+            return
+        search['experience'] = experience
+    
+    await state.update_data(search=search)
+    await ask_search_location(message, search, await db.count_users(**search))
+
+@dp.message_handler(state=SearchStates.location)
+async def search_location(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    search = data.get('search', {})
+    search.pop('location', None)
+    
+    if message.text == "🔙 Назад":
+        search.pop('experience', None)
+        await state.update_data(search=search)
+        await ask_search_experience(message, search, await db.count_users(**search))
+        return
+    
+    location = split_facet_label(message.text)
+    if location != "Любой город":
+        search['location'] = canonical_city(location)
+    
+    total = await db.count_users(**search)
+    if not total:
+        msg = await answer(message, "Никого не найдено. Выберите другой город.")
+        await track_message(message.chat.id, msg.message_id)
+        return
+    
+    # Параметры поиска остаются в данных FSM для кнопок листания
+    await state.reset_state(with_data=False)
+    await state.update_data(search=search)
+    
+    main_msg = await answer(message, f"🔍 Найдено {total} специалистов:", reply_markup=get_main_menu())
     await track_message(message.chat.id, main_msg.message_id)
     
-    for user in results:
-        is_favorite = db.is_favorite(message.from_user.id, user[0])
-        profile_text = (
-            f"👤 <b>Найден специалист:</b>\n\n"
-            f"<b>Имя:</b> {user[2]}\n"
-            f"<b>Цех:</b> {user[3]}\n"
-            f"<b>Профессия:</b> {user[4]}\n"
-            f"<b>Опыт:</b> {user[5]}\n"
-            f"<b>Локация:</b> {user[7]}\n\n"
-            f"<a href='tg://user?id={user[0]}'>Написать</a>"
-        )
-        
+    text, keyboard = await render_search_page(message.from_user.id, search)
+    msg = await answer(message, text, reply_markup=keyboard, parse_mode="HTML")
+    await track_message(message.chat.id, msg.message_id)
+
+def get_profile_buttons(user, is_favorite, label=''):
+    """Кнопки под карточкой: избранное и, если есть, фото и видео портфолио"""
+    buttons = [get_favorite_button(user['user_id'], is_favorite, label)]
+    if user['media']:
+        buttons.append(types.InlineKeyboardButton(f"🎬 Портфолио{label}",
+                                                  callback_data=callbacks.data('profile_media', user['user_id'])))
+    return buttons
+
+def get_favorite_button(user_id, is_favorite, label=''):
+    if is_favorite:
+        return types.InlineKeyboardButton(f"❌ Удалить из избранного{label}",
+                                          callback_data=callbacks.data('remove_favorite', user_id))
+    return types.InlineKeyboardButton(f"⭐ Добавить в избранное{label}", callback_data=callbacks.data('add_favorite', user_id))
+
+def build_results_page(results, prev_data=None, next_data=None):
+    """Одна страница результатов - одно сообщение с кнопками избранного и листания"""
+    cards = []
+    keyboard = types.InlineKeyboardMarkup()
+    for number, user in enumerate(results, 1):
+        cards.append(render_profile_card(user, f"#{number} Найден специалист"))
+        keyboard.row(*get_profile_buttons(user, user['is_favorite'], f" #{number}"))
+    
+    navigation = []
+    if prev_data:
+        navigation.append(types.InlineKeyboardButton("⬅️ Назад", callback_data=prev_data))
+    if next_data:
+        navigation.append(types.InlineKeyboardButton("Далее ➡️", callback_data=next_data))
+    if navigation:
+        keyboard.row(*navigation)
+    return "\n\n".join(cards), keyboard
+
+async def render_search_page(viewer_id, search, after=None, before=None):
+    results, has_prev, has_next = await db.search_users_page(
+        after=after, before=before, limit=SEARCH_PAGE_SIZE, viewer_id=viewer_id, **search
+    )
+    if not results:
+        return "Больше никого не найдено.", None
+    text, keyboard = build_results_page(
+        results,
+        prev_data=callbacks.data('search_page', 'prev', results[0]['user_id']) if has_prev else None,
+        next_data=callbacks.data('search_page', 'next', results[-1]['user_id']) if has_next else None,
+    )
+    keyboard.add(types.InlineKeyboardButton("🔔 Сообщать о новых", callback_data=callbacks.data('save_search')))
+    return text, keyboard
+
+@callbacks.route('search_page', str, int)
+async def search_page(callback: types.CallbackQuery, direction, user_id, state: FSMContext):
+    search = (await state.get_data()).get('search')
+    if not search:
+        await callback.answer("Поиск устарел, начните заново")
+        return
+    
+    if direction == 'next':
+        text, keyboard = await render_search_page(callback.from_user.id, search, after=user_id)
+    else:
+        text, keyboard = await render_search_page(callback.from_user.id, search, before=user_id)
+    await edit_text(callback.message, text, reply_markup=keyboard, parse_mode="HTML")
+    await callback.answer()
+
+# Сохраненные поиски
+def describe_search(search):
+    parts = [f"{search['department']} / {search['profession']}"]
+    if search['experience']:
+        parts.append(search['experience'])
+    if search['location']:
+        parts.append(search['location'])
+    return ", ".join(parts)
+
+def build_saved_searches(searches):
+    if not searches:
+        return "У вас нет сохраненных поисков. Сохранить поиск можно кнопкой «🔔 Сообщать о новых».", None
+    keyboard = types.InlineKeyboardMarkup()
+    for search in searches:
+        keyboard.add(types.InlineKeyboardButton(f"❌ {describe_search(search)}",
+                                                callback_data=callbacks.data('delete_search', search['id'])))
+    return "🔔 Сохраненные поиски. Новые подходящие профили приходят сводкой раз в час, " \
+           "нажмите на поиск, чтобы удалить его:", keyboard
+
+@callbacks.route('save_search')
+async def save_search(callback: types.CallbackQuery, state: FSMContext):
+    search = (await state.get_data()).get('search')
+    if not search:
+        await callback.answer("Поиск устарел, начните заново")
+        return
+    
+    if len(await db.get_saved_searches(callback.from_user.id)) >= SAVED_SEARCHES_LIMIT:
+        await callback.answer(f"Можно сохранить не больше {SAVED_SEARCHES_LIMIT} поисков, удалите лишние: /searches",
+                              show_alert=True)
+        return
+    
+    if await db.save_search(callback.from_user.id, **search):
+        await callback.answer("🔔 Поиск сохранен: пришлю новые подходящие профили. Список поисков: /searches",
+                              show_alert=True)
+    else:
+        await callback.answer("Этот поиск уже сохранен")
+
+@dp.message_handler(commands=['searches'])
+async def show_saved_searches(message: types.Message):
+    await cleanup_chat(message.chat.id)
+    text, keyboard = build_saved_searches(await db.get_saved_searches(message.from_user.id))
+    msg = await answer(message, text, reply_markup=keyboard)
+    await track_message(message.chat.id, msg.message_id)
+
+@callbacks.route('delete_search', int)
+async def delete_saved_search(callback: types.CallbackQuery, search_id):
+    await db.delete_saved_search(callback.from_user.id, search_id)
+    text, keyboard = build_saved_searches(await db.get_saved_searches(callback.from_user.id))
+    await edit_text(callback.message, text, reply_markup=keyboard)
+    await callback.answer("Поиск удален")
+
+async def send_search_digest(user_id, profiles):
+    """Одна сводка: первые SEARCH_DIGEST_PROFILES профилей карточками, об остальных - числом"""
+    text = f"🔔 Новые профили по вашим сохраненным поискам: {len(profiles)}"
+    if len(profiles) > SEARCH_DIGEST_PROFILES:
+        text += f", показаны первые {SEARCH_DIGEST_PROFILES}. Остальные - в поиске"
+    await sender.send_message(user_id, text, priority=PRIORITY_BULK)
+    profiles = profiles[:SEARCH_DIGEST_PROFILES]
+    cards = [render_profile_card(user, f"#{number} Новый профиль") for number, user in enumerate(profiles, 1)]
+    number = 0
+    for group in pack_cards(cards):
         keyboard = types.InlineKeyboardMarkup()
-        if is_favorite:
-            keyboard.add(types.InlineKeyboardButton(
-                "❌ Удалить из избранного", 
-                callback_data=f"remove_favorite_{user[0]}"
-            ))
-        else:
-            keyboard.add(types.InlineKeyboardButton(
-                "⭐ Добавить в избранное", 
-                callback_data=f"add_favorite_{user[0]}"
-            ))
-        
-        msg = await message.answer(profile_text, reply_markup=keyboard, parse_mode="HTML")
+        for _ in group:
+            user = profiles[number]
+            number += 1
+            keyboard.row(*get_profile_buttons(user, user['is_favorite'], f" #{number}"))
+        await sender.send_message(user_id, "\n\n".join(group), reply_markup=keyboard, parse_mode="HTML",
+                                  priority=PRIORITY_BULK)
+
+async def send_search_digests():
+    """Сводки по сохраненным поискам, пачками подписчиков через общую очередь отправки"""
+    # Совпадения, найденные во время прохода, попадут в следующую сводку
+    until = int(time.time())
+    while True:
+        matches = await db.get_pending_matches(until, SEARCH_DIGEST_BATCH)
+        if not matches:
+            break
+        results = await asyncio.gather(
+            *(send_search_digest(user_id, profiles) for user_id, profiles in matches.items() if profiles),
+            return_exceptions=True
+        )
+        for result in results:
+            result = type(result).__name__ if isinstance(result, Exception) else 'sent'
+            metrics.inc('bot_search_digests_total', (('result', result),))
+        # Недоставленные сводки не повторяем: пользователь мог заблокировать бота
+        await db.mark_matches_notified(list(matches), until)
+
+async def search_digests_loop():
+    while True:
+        await asyncio.sleep(SEARCH_DIGEST_INTERVAL)
+        try:
+            await send_search_digests()
+        except Exception as e:
+            logger.error(f"Ошибка при отправке сводок по сохраненным поискам: {e}")
+
+# Текстовый поиск
+@dp.message_handler(text="🔎 Поиск по тексту")
+async def text_search(message: types.Message):
+    await cleanup_chat(message.chat.id)
+    msg = await answer(message, "Введите имя, профессию или город, например: «гаффер мск» или «аниматор спб»",
+                       reply_markup=LOCATION_KEYBOARD)
+    await track_message(message.chat.id, msg.message_id)
+    await TextSearchStates.query.set()
+
+async def render_text_search_page(viewer_id, query, offset=0):
+    results, has_next, partial = await db.search_text(query, limit=SEARCH_PAGE_SIZE, offset=offset, viewer_id=viewer_id)
+    if not results:
+        return None, None
+    text, keyboard = build_results_page(
+        results,
+        prev_data=callbacks.data('text_page', offset - SEARCH_PAGE_SIZE) if offset else None,
+        next_data=callbacks.data('text_page', offset + SEARCH_PAGE_SIZE) if has_next else None,
+    )
+    if partial:
+        text += (f"\n\n<i>Совпадений больше {FTS_RANK_CANDIDATES}: показаны лучшие из "
+                 f"{FTS_RANK_CANDIDATES} самых новых профилей. Уточните запрос.</i>")
+    return text, keyboard
+
+@dp.message_handler(state=TextSearchStates.query)
+async def text_search_query(message: types.Message, state: FSMContext):
+    if message.text == "🔙 Назад":
+        await state.finish()
+        msg = await answer(message, "Главное меню:", reply_markup=get_main_menu())
         await track_message(message.chat.id, msg.message_id)
+        return
     
-    await state.finish()
+    text, keyboard = await render_text_search_page(message.from_user.id, message.text)
+    if not text:
+        msg = await answer(message, "Никого не найдено. Попробуйте другой запрос (не короче трех букв).")
+        await track_message(message.chat.id, msg.message_id)
+        return
+    
+    await state.reset_state(with_data=False)
+    await state.update_data(text_search=message.text)
+    main_msg = await answer(message, "🔎 Результаты поиска:", reply_markup=get_main_menu())
+    await track_message(message.chat.id, main_msg.message_id)
+    msg = await answer(message, text, reply_markup=keyboard, parse_mode="HTML")
+    await track_message(message.chat.id, msg.message_id)
+
+@callbacks.route('text_page', int)
+async def text_search_page(callback: types.CallbackQuery, offset, state: FSMContext):
+    offset = max(0, offset)
+    query = (await state.get_data()).get('text_search')
+    text, keyboard = await render_text_search_page(callback.from_user.id, query, offset) if query else (None, None)
+    if not text:
+        await callback.answer("Поиск устарел, начните заново")
+        return
+    await edit_text(callback.message, text, reply_markup=keyboard, parse_mode="HTML")
+    await callback.answer()
+
+# Поиск в inline-режиме: @bot гаффер москва в любом чате (включается в @BotFather, /setinline)
+INLINE_PAGE_SIZE = 20  # Telegram принимает не больше 50 результатов за ответ
+INLINE_RESULTS_LIMIT = 200  # сколько user_id запоминается на один запрос
+INLINE_CACHE_SIZE = 5000
+INLINE_CACHE_TTL = 60  # новые и измененные профили появятся в выдаче не позже
+INLINE_CACHE_TIME = 60  # сколько Telegram кэширует ответ у себя
+
+# Запрос -> список user_id: пока человек печатает и листает, SQLite не трогается
+inline_results = LRUCache(INLINE_CACHE_SIZE, INLINE_CACHE_TTL)
+# Поиски, которые еще идут: одинаковые запросы, пришедшие разом, ждут один поиск
+inline_searches = {}
+
+async def find_inline_results(query):
+    # Запросы, отличающиеся регистром, пробелами и сокращениями, дают один ключ
+    key = build_fts_query(query)
+    if not key:
+        return []
+    user_ids = inline_results.get(key)
+    if user_ids is None:
+        search = inline_searches.get(key)
+        if search is None:
+            search = inline_searches[key] = asyncio.ensure_future(
+                db.search_text_ids(query, limit=INLINE_RESULTS_LIMIT)
+            )
+            search.add_done_callback(lambda _: inline_searches.pop(key, None))
+        user_ids = await asyncio.shield(search)
+        inline_results.set(key, user_ids)
+    return user_ids
+
+def build_inline_result(user):
+    return types.InlineQueryResultArticle(
+        id=str(user['user_id']),
+        title=user['full_name'] or "Без имени",
+        description=", ".join(filter(None, (user['profession'], user['experience'], user['location']))),
+        # Та же карточка, что в поиске: имя и город в ней уже экранированы escape_html
+        input_message_content=types.InputTextMessageContent(
+            _cached_card(user, 'public', _render_public_card), parse_mode="HTML"
+        ),
+    )
+
+@dp.inline_handler()
+async def inline_search(inline_query: types.InlineQuery):
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    user_ids = await find_inline_results(inline_query.query)
+    users = await db.get_users(user_ids[offset:offset + INLINE_PAGE_SIZE])
+    next_offset = str(offset + INLINE_PAGE_SIZE) if offset + INLINE_PAGE_SIZE < len(user_ids) else ""
+    await inline_query.answer(
+        [build_inline_result(user) for user in users],
+        cache_time=INLINE_CACHE_TIME, is_personal=False, next_offset=next_offset,
+    )
+
+# Фото и видео портфолио
+@callbacks.route('profile_media', int)
+async def show_profile_media(callback: types.CallbackQuery, user_id):
+    media = await db.get_profile_media(user_id)
+    if not media:
+        await callback.answer("Фото и видео больше нет")
+        return
+    
+    # Файлы отправляются по file_id: Telegram берет их у себя, бот ничего не загружает
+    album = types.MediaGroup()
+    for kind, file_id in media:
+        if kind == 'photo':
+            album.attach_photo(file_id)
+        else:
+            album.attach_video(file_id)
+    messages = await sender.call(callback.message.chat.id, 'send_media_group', callback.message.chat.id, album,
+                                 priority=PRIORITY_BULK)
+    for msg in messages:
+        await track_message(callback.message.chat.id, msg.message_id)
+    await callback.answer()
 
 # Обработчики избранного
-@dp.callback_query_handler(lambda c: c.data.startswith('add_favorite_'))
-async def add_to_favorites(callback: types.CallbackQuery):
-    favorite_user_id = int(callback.data.split('_')[2])
-    db.add_favorite(callback.from_user.id, favorite_user_id)
+def replace_favorite_button(markup, callback_data, favorite_user_id, is_favorite):
+    """Меняем только нажатую кнопку, остальная клавиатура сохраняется"""
+    for row in markup.inline_keyboard:
+        for i, button in enumerate(row):
+            if button.callback_data == callback_data:
+                label = button.text.partition(' #')[2]
+                row[i] = get_favorite_button(favorite_user_id, is_favorite, f" #{label}" if label else '')
+    return markup
+
+@callbacks.route('add_favorite', int)
+async def add_to_favorites(callback: types.CallbackQuery, favorite_user_id):
+    await db.add_favorite(callback.from_user.id, favorite_user_id)
     await callback.answer("✅ Добавлено в избранное")
-    await callback.message.edit_reply_markup(reply_markup=types.InlineKeyboardMarkup().add(
-        types.InlineKeyboardButton("❌ Удалить из избранного", callback_data=f"remove_favorite_{favorite_user_id}")
-    ))
-
-@dp.callback_query_handler(lambda c: c.data.startswith('remove_favorite_'))
-async def remove_from_favorites(callback: types.CallbackQuery):
-    favorite_user_id = int(callback.data.split('_')[2])
-    db.remove_favorite(callback.from_user.id, favorite_user_id)
+    await edit_reply_markup(
+        callback.message, replace_favorite_button(callback.message.reply_markup, callback.data, favorite_user_id, True)
+    )
+
+@callbacks.route('remove_favorite', int)
+async def remove_from_favorites(callback: types.CallbackQuery, favorite_user_id):
+    await db.remove_favorite(callback.from_user.id, favorite_user_id)
     await callback.answer("❌ Удалено из избранного")
-    await callback.message.edit_reply_markup(reply_markup=types.InlineKeyboardMarkup().add(
-        types.InlineKeyboardButton("⭐ Добавить в избранное", callback_data=f"add_favorite_{favorite_user_id}")
-    ))
+    await edit_reply_markup(
+        callback.message, replace_favorite_button(callback.message.reply_markup, callback.data, favorite_user_id, False)
+    )
+
+# Команды администраторов
+ADMIN_TOP_LIMIT = 10
+BROADCAST_BATCH_SIZE = 30  # прогресс сохраняется после каждой пачки
+
+BROADCAST_STATUSES = {'running': "идет", 'done': "завершена", 'cancelled': "отменена"}
+
+broadcast_tasks = {}
+
+def render_stats(stats, top):
+    users = sum(row[2] for row in stats)
+    complete = sum(row[3] for row in stats)
+    with_portfolio = sum(row[4] for row in stats)
+    
+    def share(count):
+        return f"{count * 100 // users}%" if users else "0%"
+    
+    departments = Counter()
+    for department, _, count, _, _ in stats:
+        departments[department or "Не указан"] += count
+    professions = sorted((row for row in stats if row[1]), key=lambda row: -row[2])[:ADMIN_TOP_LIMIT]
+    
+    lines = [
+        "📊 <b>Статистика</b>\n",
+        f"Профилей: {users}",
+        f"Заполнены полностью: {complete} ({share(complete)})",
+        f"С портфолио: {with_portfolio} ({share(with_portfolio)})\n",
+        "<b>По цехам:</b>",
+    ]
+    lines.extend(f"{department} - {count}" for department, count in departments.most_common())
+    lines.append("\n<b>Популярные профессии:</b>")
+    lines.extend(f"{profession} ({department}) - {count}" for department, profession, count, _, _ in professions)
+    lines.append("\n<b>Чаще всего в избранном:</b>")
+    lines.extend(
+        f"<a href='tg://user?id={user['user_id']}'>{escape_html(user['full_name'])}</a>, "
+        f"{user['profession'] or '-'} - {user['favorited']}"
+        for user in top
+    )
+    return "\n".join(lines)
+
+@dp.message_handler(commands=['stats'], user_id=ADMINS)
+async def admin_stats(message: types.Message):
+    stats = await db.profile_stats()
+    top = await db.top_favorited(ADMIN_TOP_LIMIT)
+    await answer(message, render_stats(stats, top), parse_mode="HTML")
+
+async def run_broadcast(broadcast_id):
+    """Рассылка по всем пользователям пачками через общую очередь отправки.
+
+    Прогресс пишется в базу после каждой пачки, поэтому после перезапуска
+    рассылка продолжается с того же места (последняя пачка может прийти
+    части получателей повторно).
+    """
+    try:
+        broadcast = await db.get_broadcast(broadcast_id)
+        if broadcast['status'] != 'running':
+            return
+        last_user_id, sent, failed = broadcast['last_user_id'], broadcast['sent'], broadcast['failed']
+        while True:
+            recipients = await db.get_broadcast_recipients(last_user_id, BROADCAST_BATCH_SIZE)
+            if not recipients:
+                break
+            # Массовый приоритет: ответы пользователям уходят вперед рассылки
+            results = await asyncio.gather(
+                *(sender.send_message(user_id, broadcast['text'], priority=PRIORITY_BULK) for user_id in recipients),
+                return_exceptions=True
+            )
+            for result in results:
+                if isinstance(result, Exception):
+                    failed += 1
+                    metrics.inc('bot_broadcast_messages_total', (('result', type(result).__name__),))
+                else:
+                    sent += 1
+                    metrics.inc('bot_broadcast_messages_total', (('result', 'sent'),))
+            last_user_id = recipients[-1]
+            await db.update_broadcast(broadcast_id, last_user_id=last_user_id, sent=sent, failed=failed)
+        await db.update_broadcast(broadcast_id, status='done')
+        await sender.send_message(broadcast['created_by'],
+                                  f"📣 Рассылка #{broadcast_id} завершена: доставлено {sent}, ошибок {failed}")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        # Статус остается running - рассылка продолжится при следующем запуске
+        logger.error(f"Ошибка в рассылке #{broadcast_id}: {e}")
+    finally:
+        broadcast_tasks.pop(broadcast_id, None)
+
+def start_broadcast(broadcast_id):
+    broadcast_tasks[broadcast_id] = asyncio.create_task(run_broadcast(broadcast_id))
+
+@dp.message_handler(commands=['broadcast'], user_id=ADMINS)
+async def admin_broadcast(message: types.Message):
+    text = message.get_args()
+    if not text:
+        await answer(message, "Использование: /broadcast текст сообщения")
+        return
+    broadcast_id = await db.create_broadcast(text, message.from_user.id)
+    start_broadcast(broadcast_id)
+    await answer(message, f"📣 Рассылка #{broadcast_id} запущена.\n"
+                          f"/broadcast_status {broadcast_id} - прогресс, /broadcast_cancel {broadcast_id} - отмена")
+
+@dp.message_handler(commands=['broadcast_status', 'broadcast_cancel'], user_id=ADMINS)
+async def admin_broadcast_control(message: types.Message):
+    args = message.get_args()
+    broadcast = await db.get_broadcast(int(args)) if args.isdigit() else None
+    if not broadcast:
+        await answer(message, f"Использование: /{message.get_command(pure=True)} номер рассылки")
+        return
+    
+    if message.get_command(pure=True) == 'broadcast_cancel' and broadcast['status'] == 'running':
+        task = broadcast_tasks.pop(broadcast['id'], None)
+        if task:
+            task.cancel()
+        await db.update_broadcast(broadcast['id'], status='cancelled')
+        broadcast = await db.get_broadcast(broadcast['id'])
+    
+    total = await db.count_profiles()
+    await answer(message, f"📣 Рассылка #{broadcast['id']} {BROADCAST_STATUSES[broadcast['status']]}\n"
+                          f"Доставлено {broadcast['sent']}, ошибок {broadcast['failed']}, всего пользователей {total}")
 
 # Обработчик текстовых сообщений
 @dp.message_handler()
 async def handle_text(message: types.Message):
     if message.text == "🔙 Назад":
-        msg = await message.answer("Главное меню:", reply_markup=get_main_menu())
+        msg = await answer(message, "Главное меню:", reply_markup=get_main_menu())
         await track_message(message.chat.id, msg.message_id)
     else:
-        msg = await message.answer("Используйте кнопки меню для навигации", reply_markup=get_main_menu())
+        msg = await answer(message, "Используйте кнопки меню для навигации", reply_markup=get_main_menu())
         await track_message(message.chat.id, msg.message_id)
 
+async def expire_tracked_messages():
+    while True:
+        await asyncio.sleep(TRACKED_MESSAGES_EXPIRE_INTERVAL)
+        tracked_messages.expire()
+
+async def save_tracked_messages():
+    """Периодический снимок отслеживаемых сообщений на случай падения без on_shutdown"""
+    while True:
+        await asyncio.sleep(TRACKED_MESSAGES_SAVE_INTERVAL)
+        try:
+            await db.save_tracked_messages(list(tracked_messages.dump()))
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении отслеживаемых сообщений: {e}")
+
+async def expire_fsm_states():
+    while True:
+        await asyncio.sleep(FSM_EXPIRE_INTERVAL)
+        try:
+            await storage.expire()
+        except Exception as e:
+            logger.error(f"Ошибка при очистке состояний FSM: {e}")
+
+async def collect_metrics():
+    """Накопленные метрики плюс текущие значения, снятые в момент запроса"""
+    gauges = [('bot_fsm_states', (('state', state),), count) for state, count in await storage.state_counts()]
+    gauges.append(('bot_send_queue_size', (), len(sender)))
+    gauges.append(('bot_tracked_chats', (), len(tracked_messages)))
+    gauges.append(('bot_cleanup_tasks', (), len(cleanup_tasks)))
+    gauges.extend(('bot_cleanup_messages', (('result', result),), count) for result, count in cleanup_stats.items())
+    for cache, stats in dict(db.cache_stats(), inline=inline_results.stats(), cards=profile_cards.stats()).items():
+        gauges.extend((f'bot_cache_{key}', (('cache', cache),), value) for key, value in stats.items())
+    return metrics.render(gauges)
+
+async def handle_metrics(request):
+    return web.Response(text=await collect_metrics(), content_type='text/plain')
+
+async def start_metrics_server(port):
+    app = web.Application()
+    app.router.add_get(METRICS_PATH, handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, port).start()
+    logger.info(f"Метрики доступны на {METRICS_HOST}:{port}{METRICS_PATH}")
+
+async def refresh_recommendations():
+    """Периодическое перестроение соседей для рекомендаций, порциями"""
+    while True:
+        started = time.perf_counter()
+        after = 0
+        try:
+            while after is not None:
+                after = await db.rebuild_neighbors(after, limit=RECOMMENDATION_REBUILD_BATCH)
+            logger.info(f"Соседи для рекомендаций перестроены за {time.perf_counter() - started:.1f} с")
+        except Exception as e:
+            logger.error(f"Ошибка при перестроении рекомендаций: {e}")
+        await asyncio.sleep(RECOMMENDATION_REBUILD_INTERVAL)
+
+async def on_startup(dispatcher):
+    db.start_flusher()
+    if METRICS_PORT:
+        await start_metrics_server(METRICS_PORT)
+    if TRACKED_MESSAGES_PERSIST:
+        tracked_messages.load(await db.load_tracked_messages(time.time() - MESSAGE_DELETE_WINDOW))
+        asyncio.create_task(save_tracked_messages())
+    asyncio.create_task(expire_tracked_messages())
+    asyncio.create_task(expire_fsm_states())
+    asyncio.create_task(refresh_recommendations())
+    asyncio.create_task(search_digests_loop())
+    for broadcast in await db.get_running_broadcasts():
+        logger.info(f"Продолжаем рассылку #{broadcast['id']} после пользователя {broadcast['last_user_id']}")
+        start_broadcast(broadcast['id'])
+
+async def on_shutdown(dispatcher):
+    # Незавершенные рассылки остаются в статусе running и продолжатся при запуске
+    for task in list(broadcast_tasks.values()):
+        task.cancel()
+    if cleanup_tasks:
+        await asyncio.wait(cleanup_tasks)
+    logger.info(f"Очистка чатов: удалено {cleanup_stats['deleted']}, "
+                f"ошибок {cleanup_stats['failed']}, пропущено {cleanup_stats['skipped']}")
+    await sender.stop()
+    if TRACKED_MESSAGES_PERSIST:
+        await db.save_tracked_messages(list(tracked_messages.dump()))
+    logger.info(f"Кэш базы: {db.cache_stats()}")
+    await db.close()
+
+# Webhook
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '')  # например https://bot.example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+# Telegram присылает его в заголовке каждого запроса, чужие запросы отклоняются
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()
+WEBHOOK_SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', 8080))
+UPDATE_CONCURRENCY = 64  # обновлений, обрабатываемых одновременно
+UPDATE_QUEUE_SIZE = 1000  # принятых, но еще не обработанных
+
+def get_update_chat_id(update):
+    """Ключ, по которому сохраняется порядок обработки обновлений"""
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    if update.inline_query:
+        return update.inline_query.from_user.id
+    return 0
+
+class UpdatePipeline:
+    """Обработка входящих обновлений с сохранением порядка внутри чата.
+
+    У каждого чата с необработанными обновлениями своя задача, которая
+    обрабатывает их по одному, поэтому сценарии FSM не перемешиваются,
+    а медленное обновление задерживает только свой чат. Одновременно
+    обрабатывается не больше concurrency обновлений; когда принято
+    queue_size необработанных, put ждет, и webhook отвечает Telegram позже.
+
+    Бот работает в одном процессе: один цикл событий и один поток базы.
+    Несколько процессов на одной базе не поддерживаются: кэши профилей,
+    карточек и inline-выдачи не знают о чужих записях, а групповой commit
+    держит блокировку записи почти все время. Масштабирование на несколько
+    ядер отложено.
+    """
+
+    def __init__(self, dispatcher, concurrency=UPDATE_CONCURRENCY, queue_size=UPDATE_QUEUE_SIZE):
+        self.dispatcher = dispatcher
+        self._running = asyncio.Semaphore(concurrency)
+        self._accepted = asyncio.Semaphore(queue_size)
+        # chat_id -> очередь его необработанных обновлений
+        self._chats = {}
+        self._tasks = set()
+
+    def __len__(self):
+        return sum(len(pending) for pending in self._chats.values())
+
+    async def stop(self):
+        """Дожидаемся обработки уже принятых обновлений"""
+        while self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    async def put(self, update):
+        await self._accepted.acquire()
+        chat_id = get_update_chat_id(update)
+        pending = self._chats.get(chat_id)
+        if pending is not None:
+            pending.append(update)
+            return
+        pending = self._chats[chat_id] = deque([update])
+        task = asyncio.create_task(self._work(chat_id, pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _work(self, chat_id, pending):
+        Bot.set_current(self.dispatcher.bot)
+        Dispatcher.set_current(self.dispatcher)
+        try:
+            while pending:
+                update = pending[0]
+                try:
+                    async with self._running:
+                        # Отдельная задача - отдельный контекст: aiogram кэширует состояние FSM
+                        # в contextvars, и без этого следующее обновление увидело бы чужое
+                        await asyncio.create_task(self.dispatcher.process_update(update))
+                except Exception as e:
+                    logger.exception(f"Ошибка при обработке обновления {update.update_id}: {e}")
+                finally:
+                    pending.popleft()
+                    self._accepted.release()
+        finally:
+            del self._chats[chat_id]
+
+async def handle_webhook(request):
+    secret = request.headers.get(WEBHOOK_SECRET_HEADER, '')
+    if not hmac.compare_digest(secret, request.app['webhook_secret']):
+        logger.warning(f"Запрос к webhook без верного секрета от {request.remote}")
+        return web.Response(status=401)
+    update = types.Update(**(await request.json()))
+    await request.app['pipeline'].put(update)
+    return web.Response()
+
+def create_webhook_app(dispatcher, concurrency=UPDATE_CONCURRENCY, secret=WEBHOOK_SECRET,
+                       on_startup=on_startup, on_shutdown=on_shutdown):
+    """Приложение aiohttp только с путем webhook; метрики - отдельно, см. METRICS_PORT"""
+    app = web.Application()
+    app['pipeline'] = UpdatePipeline(dispatcher, concurrency=concurrency)
+    app['webhook_secret'] = secret
+    app.router.add_post(WEBHOOK_PATH, handle_webhook)
+
+    async def startup(app):
+        if on_startup:
+            await on_startup(dispatcher)
+        if WEBHOOK_HOST:
+            await dispatcher.bot.set_webhook(WEBHOOK_HOST + WEBHOOK_PATH, secret_token=secret)
+
+    async def shutdown(app):
+        await app['pipeline'].stop()
+        if on_shutdown:
+            await on_shutdown(dispatcher)
+        await dispatcher.storage.close()
+        await dispatcher.storage.wait_closed()
+        session = await dispatcher.bot.get_session()
+        await session.close()
+
+    app.on_startup.append(startup)
+    app.on_shutdown.append(shutdown)
+    return app
+
 # Запуск бота
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--webhook', action='store_true', help='принимать обновления через webhook')
+    parser.add_argument('--concurrency', type=int, default=UPDATE_CONCURRENCY,
+                        help='одновременно обрабатываемых обновлений в режиме webhook')
+    args = parser.parse_args()
+
     logger.info("Бот запускается...")
-    executor.start_polling(dp, skip_updates=True)
+    if args.webhook:
+        web.run_app(create_webhook_app(dp, concurrency=args.concurrency), host=WEBAPP_HOST, port=WEBAPP_PORT)
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
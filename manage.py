@@ -0,0 +1,264 @@
+"""Массовый импорт и экспорт профилей и избранного.
+
+Формат (csv или jsonl) берется из расширения файла или задается --format.
+Импорт идет пачками по --batch строк, каждая пачка - одна транзакция;
+строки с неизвестным цехом, профессией или опытом пропускаются.
+
+Решардинг переносит данные в другое число шардов (DB_SHARDS) без остановки
+бота: reshard копирует всех пользователей, пока бот работает со старыми
+шардами, а изменения, сделанные за это время, пишутся триггерами в журнал
+и переносятся заново. Для переключения бот останавливается, reshard --finish
+переносит остаток журнала и рассылки, и бот запускается с новым DB_SHARDS.
+
+Импорт и решардинг можно запускать при работающем боте: запись в базу ждет
+чужую транзакцию до DB_BUSY_TIMEOUT секунд. Пока идет import-users, текстовый
+поиск и /stats бота работают по прежнему индексу и агрегатам без новых
+профилей; в конце они перестраиваются одной транзакцией.
+
+Связь избранного между шардами пишется двумя отдельными записями, и после
+сбоя копия в шарде добавленного может разойтись с шардом владельца:
+repair-favorites сверяет их и исправляет копии.
+
+Запуск из корня репозитория:
+    python manage.py import-users profiles.csv
+    python manage.py import-favorites favorites.jsonl
+    python manage.py export-users profiles.jsonl
+    python manage.py export-favorites favorites.csv
+    python manage.py --shards 1 reshard 4
+    python manage.py --shards 1 reshard 4 --finish
+    python manage.py --shards 4 repair-favorites
+"""
+import argparse
+import csv
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+
+from database import (
+    Database, ShardedDatabase, DB_NAME, DB_SHARDS, DEPARTMENTS, EXPERIENCE_LEVELS, canonical_city, open_database,
+    shard_paths,
+)
+
+logger = logging.getLogger('manage')
+
+PROFILE_COLUMNS = ('user_id', 'username', 'full_name', 'department', 'profession', 'experience', 'portfolio', 'location')
+FAVORITE_COLUMNS = ('user_id', 'favorite_user_id')
+IMPORT_BATCH_SIZE = 50000
+# Сколько отбракованных строк показывать в логе, остальные только считаются
+MAX_REPORTED_ERRORS = 10
+RESHARD_BATCH_SIZE = 1000  # пользователей за один перенос
+# Пока бот работает, журнал изменений не опустеет: догоняем, пока за проход меняется больше стольких
+RESHARD_ONLINE_CHANGES = 100
+
+
+def get_format(path, fmt):
+    if fmt:
+        return fmt
+    if path.endswith('.csv'):
+        return 'csv'
+    if path.endswith('.jsonl') or path == '-':
+        return 'jsonl'
+    raise SystemExit(f"Не удалось определить формат {path}, укажите --format")
+
+
+def open_file(path, mode):
+    if path == '-':
+        return sys.stdin if mode == 'r' else sys.stdout
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+def read_rows(file, fmt):
+    if fmt == 'csv':
+        yield from csv.DictReader(file)
+    else:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_rows(file, fmt, columns, rows):
+    count = 0
+    if fmt == 'csv':
+        writer = csv.writer(file)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    else:
+        for row in rows:
+            file.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n')
+            count += 1
+    return count
+
+
+def validate_profile(row):
+    """Строка файла -> профиль для Database.add_profiles или ValueError"""
+    profile = {column: row.get(column) or None for column in PROFILE_COLUMNS}
+    profile['user_id'] = int(profile['user_id'])
+    department = profile['department']
+    if department is not None and department not in DEPARTMENTS:
+        raise ValueError(f"неизвестный цех {department!r}")
+    if profile['profession'] is not None and profile['profession'] not in DEPARTMENTS.get(department, []):
+        raise ValueError(f"профессии {profile['profession']!r} нет в цехе {department!r}")
+    if profile['experience'] is not None and profile['experience'] not in EXPERIENCE_LEVELS:
+        raise ValueError(f"неизвестный опыт {profile['experience']!r}")
+    if profile['location'] is not None:
+        profile['location'] = canonical_city(profile['location'])
+    return profile
+
+
+def validate_favorite(row):
+    return int(row['user_id']), int(row['favorite_user_id'])
+
+
+def valid_rows(rows, validate, errors):
+    for line, row in enumerate(rows, start=1):
+        try:
+            yield validate(row)
+        except (ValueError, TypeError, KeyError) as e:
+            errors[0] += 1
+            if errors[0] <= MAX_REPORTED_ERRORS:
+                logger.warning(f"Строка {line} пропущена: {e}")
+
+
+def import_rows(args, validate, insert):
+    fmt = get_format(args.path, args.format)
+    errors = [0]
+    imported = 0
+    started = time.perf_counter()
+    with open_file(args.path, 'r') as file:
+        rows = valid_rows(read_rows(file, fmt), validate, errors)
+        while True:
+            batch = list(itertools.islice(rows, args.batch))
+            if not batch:
+                break
+            insert(batch)
+            imported += len(batch)
+            logger.info(f"Загружено {imported}")
+    logger.info(f"Готово: {imported} строк за {time.perf_counter() - started:.1f} с, пропущено {errors[0]}")
+
+
+def import_users(args, database):
+    # Индекс FTS перестраивается один раз в конце, а не триггером на каждую строку
+    with database.bulk_load():
+        import_rows(args, validate_profile, database.add_profiles)
+
+
+def import_favorites(args, database):
+    import_rows(args, validate_favorite, database.add_favorites)
+
+
+def export_rows(args, columns, rows):
+    fmt = get_format(args.path, args.format)
+    with open_file(args.path, 'w') as file:
+        count = write_rows(file, fmt, columns, rows)
+    logger.info(f"Выгружено {count} строк")
+
+
+def export_users(args, database):
+    export_rows(args, PROFILE_COLUMNS, database.iter_profiles())
+
+
+def export_favorites(args, database):
+    export_rows(args, FAVORITE_COLUMNS, database.iter_favorites())
+
+
+def copy_users(source, target, user_ids, replace):
+    target.import_users(source.export_users(user_ids), replace=user_ids if replace else ())
+    target.flush()
+
+
+def catch_up(source, target, batch, until_left):
+    """Переносим заново пользователей из журнала изменений, пока за проход их больше until_left"""
+    while True:
+        user_ids = source.pop_changed_users(batch)
+        if user_ids:
+            copy_users(source, target, user_ids, replace=True)
+            logger.info(f"Перенесено изменений: {len(user_ids)}")
+        if len(user_ids) <= until_left:
+            return
+
+
+def reshard(args, source):
+    paths = shard_paths(args.to, args.db)
+    if paths == shard_paths(args.shards, args.db):
+        raise SystemExit("Число шардов не меняется")
+    existing = [path for path in paths if os.path.exists(path)]
+    if args.finish and len(existing) < len(paths):
+        raise SystemExit("Новых шардов нет, сначала запустите reshard без --finish")
+    if not args.finish and existing:
+        raise SystemExit(f"Файлы {', '.join(existing)} уже есть: удалите их или продолжите с --finish")
+
+    target = ShardedDatabase([Database(path, synchronous='OFF', batch_size=args.batch) for path in paths])
+    try:
+        if args.finish:
+            # Бот остановлен: журнал больше не пополняется и переносится до конца
+            catch_up(source, target, args.batch, 0)
+            target.import_globals(source.export_globals())
+            source.stop_change_log()
+            logger.info(f"Готово, запустите бота с DB_SHARDS={args.to}")
+            return
+
+        # Журнал включается до копирования: все, что изменится во время него, перенесется заново
+        source.start_change_log()
+        started = time.perf_counter()
+        copied = 0
+        after = 0
+        with target.bulk_load():
+            while True:
+                user_ids = source.get_user_ids_page(after, args.batch)
+                if not user_ids:
+                    break
+                copy_users(source, target, user_ids, replace=False)
+                copied += len(user_ids)
+                after = user_ids[-1]
+                logger.info(f"Скопировано пользователей: {copied}")
+            catch_up(source, target, args.batch, RESHARD_ONLINE_CHANGES)
+        logger.info(f"Скопировано за {time.perf_counter() - started:.1f} с, в журнале изменений "
+                    f"{source.count_changed_users()}. Остановите бота и запустите reshard {args.to} --finish")
+    finally:
+        target.close()
+
+
+def repair_favorites(args, database):
+    if not isinstance(database, ShardedDatabase):
+        raise SystemExit("База не разделена на шарды, сверять нечего")
+    added, removed = database.repair_favorites()
+    logger.info(f"Копии избранного в шардах: добавлено {added}, удалено {removed}")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Импорт и экспорт данных бота")
+    parser.add_argument('--db', default=DB_NAME)
+    parser.add_argument('--shards', type=int, default=DB_SHARDS, help="текущее число шардов")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name, handler in (('import-users', import_users), ('import-favorites', import_favorites),
+                          ('export-users', export_users), ('export-favorites', export_favorites)):
+        subparser = subparsers.add_parser(name)
+        subparser.add_argument('path', help="файл .csv/.jsonl или - для stdin/stdout")
+        subparser.add_argument('--format', choices=('csv', 'jsonl'))
+        subparser.add_argument('--batch', type=int, default=IMPORT_BATCH_SIZE)
+        subparser.set_defaults(handler=handler)
+    subparser = subparsers.add_parser('reshard')
+    subparser.add_argument('to', type=int, help="новое число шардов")
+    subparser.add_argument('--finish', action='store_true', help="перенести остаток после остановки бота")
+    subparser.add_argument('--batch', type=int, default=RESHARD_BATCH_SIZE)
+    subparser.set_defaults(handler=reshard)
+    subparser = subparsers.add_parser('repair-favorites', help="сверить копии избранного между шардами")
+    subparser.set_defaults(handler=repair_favorites)
+    args = parser.parse_args()
+
+    # Каждая пачка - одна транзакция; при сбое теряется только незавершенная пачка
+    database = open_database(args.shards, args.db, synchronous='OFF', batch_size=1)
+    try:
+        args.handler(args, database)
+    finally:
+        database.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+"""Общая подготовка тестов.
+
+main при импорте создает бота и открывает базы в текущем каталоге, поэтому
+тесты запускаются во временном каталоге, а если рядом нет config.py -
+с тестовым токеном. Сеть не нужна: Bot API подменяется в самих тестах.
+
+Запуск из корня репозитория:
+    python -m pytest -q tests
+"""
+import os
+import sys
+import tempfile
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix='cinema_collab_tests_'))
+
+try:
+    import config  # noqa: F401
+except ImportError:
+    config = types.ModuleType('config')
+    config.BOT_TOKEN = '123456:TEST-TOKEN-TEST-TOKEN-TEST-TOKEN-TES'
+    config.ADMINS = [1]
+    sys.modules['config'] = config
@@ -0,0 +1,83 @@
+import os
+import subprocess
+import sys
+
+from database import Database
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Загрузка, которую убили посреди bulk_load: finally не выполняется
+KILLED_LOAD = '''
+import os, sys
+sys.path.insert(0, sys.argv[1])
+from database import Database
+database = Database('killed.db')
+with database.bulk_load():
+    database.add_profiles([{'user_id': 2, 'full_name': 'Иван Загруженный', 'department': None,
+                            'profession': None, 'experience': None, 'location': 'Казань'}])
+    database.flush()
+    os._exit(1)
+'''
+
+
+def test_killed_bulk_load_is_repaired_on_open():
+    database = Database('killed.db')
+    database.add_profiles([{'user_id': 1, 'full_name': 'Ольга', 'department': None, 'profession': None,
+                            'experience': None, 'location': 'Москва'}])
+    database.close()
+    assert subprocess.run([sys.executable, '-c', KILLED_LOAD, ROOT]).returncode == 1
+
+    database = Database('killed.db')
+    try:
+        assert [row['user_id'] for row in database.search_text('загруженный', limit=5)[0]] == [2]
+        database.update_profile(1, full_name='Ольга Переименованная')
+        assert [row['user_id'] for row in database.search_text('переименованная', limit=5)[0]] == [1]
+        assert database.count_profiles() == 2
+    finally:
+        database.close()
+
+
+def test_bot_connection_keeps_searching_while_the_index_is_rebuilt():
+    database = Database('rebuild.db')
+    database.add_profiles([{'user_id': 1, 'full_name': 'Ольга', 'department': None, 'profession': None,
+                            'experience': None, 'location': 'Москва'}])
+    database.flush()
+    reader = Database('rebuild.db')
+    try:
+        with database.bulk_load():
+            database.add_profiles([{'user_id': 2, 'full_name': 'Иван', 'department': None, 'profession': None,
+                                    'experience': None, 'location': 'Москва'}])
+            database.flush()
+            # Прежний индекс: загруженный профиль еще не виден, но и старые не пропали
+            assert [row['user_id'] for row in reader.search_text('москва', limit=5)[0]] == [1]
+        assert sorted(row['user_id'] for row in reader.search_text('москва', limit=5)[0]) == [1, 2]
+        reader.cursor.execute('PRAGMA busy_timeout')
+        assert reader.cursor.fetchone()[0] > 0
+    finally:
+        reader.close()
+        database.close()
+
+
+def test_index_rebuild_is_a_single_transaction(monkeypatch):
+    database = Database('atomic.db')
+    try:
+        database.add_profiles([{'user_id': 1, 'full_name': 'Ольга', 'department': None, 'profession': None,
+                                'experience': None, 'location': 'Москва'}])
+        database.flush()
+
+        def fail():
+            raise RuntimeError('сбой посреди перестроения')
+
+        monkeypatch.setattr(database, '_rebuild_profile_counts', fail)
+        try:
+            database._rebuild_after_bulk_load()
+        except RuntimeError:
+            pass
+        # DROP TABLE users_fts откатился вместе с остальным перестроением
+        reader = Database('atomic.db')
+        try:
+            assert [row['user_id'] for row in reader.search_text('ольга', limit=5)[0]] == [1]
+        finally:
+            reader.close()
+    finally:
+        database.close()
@@ -0,0 +1,75 @@
+from types import SimpleNamespace
+
+import pytest
+
+from main import CALLBACK_DATA_LIMIT, CallbackCodec, CallbackRouter
+
+SECRET = 'test-callback-secret'
+
+
+def router():
+    callbacks = CallbackRouter(CallbackCodec(SECRET))
+
+    @callbacks.route('toggle_favorite', int)
+    async def toggle_favorite(callback, user_id):
+        pass
+
+    @callbacks.route('delete_profile')
+    async def delete_profile(callback):
+        pass
+
+    return callbacks
+
+
+def resolve(callbacks, data):
+    return callbacks.resolve(SimpleNamespace(data=data))['callback_route']
+
+
+def test_valid_button_resolves_to_its_handler():
+    callbacks = router()
+    handler, args, wants_state = resolve(callbacks, callbacks.data('toggle_favorite', 42))
+    assert handler.__name__ == 'toggle_favorite' and args == [42] and not wants_state
+
+
+def test_signature_from_another_secret_is_rejected():
+    forged = CallbackCodec('attacker-secret').encode('delete_profile')
+    assert CallbackCodec(SECRET).decode(forged) is None
+    assert resolve(router(), forged) is None
+
+
+def test_route_swapped_under_a_valid_signature_is_rejected():
+    callbacks = router()
+    data = callbacks.data('toggle_favorite', 42)
+    _, _, signature = data.rpartition(':')
+    for body in ('1:delete_profile', '1:toggle_favorite:43', '2:toggle_favorite:42', '1:toggle_favorite:42:1'):
+        assert resolve(callbacks, f"{body}:{signature}") is None
+
+
+def test_truncated_or_malformed_payload_is_rejected():
+    callbacks = router()
+    data = callbacks.data('toggle_favorite', 42)
+    for end in range(len(data)):
+        assert resolve(callbacks, data[:end]) is None
+    for garbage in (None, '', ':', 'toggle_favorite', data + 'x', data.replace(':', '', 1)):
+        assert resolve(callbacks, garbage) is None
+
+
+def test_signed_but_unconvertible_arguments_are_rejected():
+    callbacks = router()
+    # Подпись верна, но аргумент не число: обработчик не вызывается
+    assert resolve(callbacks, callbacks.data('toggle_favorite', 'abc')) is None
+    assert resolve(callbacks, callbacks.data('toggle_favorite', 1, 2)) is None
+    assert resolve(callbacks, callbacks.data('unknown_action')) is None
+
+
+def test_old_version_buttons_are_rejected():
+    old = CallbackCodec(SECRET, version='0').encode('delete_profile')
+    assert resolve(router(), old) is None
+
+
+def test_encode_refuses_ambiguous_or_oversized_data():
+    codec = CallbackCodec(SECRET)
+    with pytest.raises(ValueError):
+        codec.encode('toggle_favorite', '1:delete_profile')
+    with pytest.raises(ValueError):
+        codec.encode('toggle_favorite', 'x' * CALLBACK_DATA_LIMIT)
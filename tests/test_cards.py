@@ -0,0 +1,50 @@
+import re
+
+from main import build_inline_result, build_results_page, forget_profile_card, render_own_profile, render_stats
+
+TAGS = re.compile(r"</?b>|<a href='tg://user\?id=\d+'>|</a>|</?i>")
+
+
+def profile(user_id, full_name, location='Москва', portfolio=None):
+    return {
+        'user_id': user_id, 'username': None, 'full_name': full_name, 'department': 'Операторский',
+        'profession': 'Гаффер', 'experience': '1-3 года', 'location': location, 'portfolio': portfolio,
+        'favorited': 0, 'is_favorite': False, 'media': 0,
+    }
+
+
+def test_user_text_is_escaped_in_a_page_of_cards():
+    users = [profile(901, '<3 Оля & Ко', location='<b>Москва'), profile(902, 'Иван')]
+    for user in users:
+        forget_profile_card(user['user_id'])
+    text, _ = build_results_page(users)
+    assert '&lt;3 Оля &amp; Ко' in text and '&lt;b&gt;Москва' in text
+    # Кроме разметки самой карточки в тексте нет ни одного «<»
+    assert '<' not in TAGS.sub('', text)
+
+
+def test_own_card_escapes_portfolio():
+    user = profile(903, 'Оля', portfolio='https://example.com/?a=1&b=<2>')
+    forget_profile_card(user['user_id'])
+    text = render_own_profile(user, '')
+    assert 'https://example.com/?a=1&amp;b=&lt;2&gt;' in text
+    assert '<' not in TAGS.sub('', text)
+
+
+def test_stats_escape_top_favorited_names():
+    top = [dict(profile(904, '</a><b>Оля & Ко'), favorited=5)]
+    text = render_stats([('Операторский цех', 'Gaffer', 1, 1, 0)], top)
+    assert '&lt;/a&gt;&lt;b&gt;Оля &amp; Ко</a>' in text
+    assert '<' not in TAGS.sub('', text)
+
+
+def test_inline_result_escapes_user_text():
+    user = profile(905, '<3 Оля', location='Москва & область')
+    forget_profile_card(user['user_id'])
+    result = build_inline_result(user)
+    text = result.input_message_content.message_text
+    assert result.input_message_content.parse_mode == 'HTML'
+    assert '&lt;3 Оля' in text and 'Москва &amp; область' in text
+    assert '<' not in TAGS.sub('', text)
+    # Заголовок и описание Telegram показывает как обычный текст
+    assert result.title == '<3 Оля'
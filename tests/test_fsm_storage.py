@@ -0,0 +1,66 @@
+import asyncio
+
+from main import SQLiteStorage
+
+
+def run(scenario):
+    async def wrapper():
+        storage = SQLiteStorage('fsm.db', ttl=60)
+        storage.conn.execute('DELETE FROM fsm_storage')
+        try:
+            return await scenario(storage)
+        finally:
+            await storage.close()
+
+    return asyncio.run(wrapper())
+
+
+def age(storage, seconds):
+    """Сдвигаем время последней записи всех строк назад"""
+    storage.conn.execute('UPDATE fsm_storage SET updated_at = updated_at - ?', (seconds,))
+
+
+def test_state_and_data_expire_after_ttl():
+    async def scenario(storage):
+        await storage.set_state(chat=1, user=1, state='Profile:name')
+        await storage.update_data(chat=1, user=1, data={'name': 'Оля'})
+        age(storage, 30)
+        assert await storage.get_state(chat=1, user=1) == 'Profile:name'
+        age(storage, 31)
+        assert await storage.get_state(chat=1, user=1) is None
+        assert await storage.get_data(chat=1, user=1) == {}
+        # Новая запись после истечения не возвращает старые данные
+        await storage.update_data(chat=1, user=1, step=2)
+        assert await storage.get_data(chat=1, user=1) == {'step': 2}
+        await storage.set_state(chat=2, user=2, state='Search:city')
+        age(storage, 61)
+        await storage.expire()
+        return storage.conn.execute('SELECT COUNT(*) FROM fsm_storage').fetchone()[0]
+
+    assert run(scenario) == 0
+
+
+def test_reset_state_keeps_data_unless_asked():
+    async def scenario(storage):
+        await storage.set_state(chat=1, user=1, state='Search:experience')
+        await storage.update_data(chat=1, user=1, department='Операторский')
+        await storage.reset_state(chat=1, user=1, with_data=False)
+        kept = (await storage.get_state(chat=1, user=1), await storage.get_data(chat=1, user=1))
+        await storage.reset_state(chat=1, user=1)
+        cleared = (await storage.get_state(chat=1, user=1), await storage.get_data(chat=1, user=1))
+        return kept, cleared
+
+    kept, cleared = run(scenario)
+    assert kept == (None, {'department': 'Операторский'})
+    assert cleared == (None, {})
+
+
+def test_finish_removes_the_row():
+    async def scenario(storage):
+        await storage.set_state(chat=1, user=1, state='Profile:name')
+        await storage.update_data(chat=1, user=1, name='Оля')
+        await storage.finish(chat=1, user=1)
+        state = await storage.get_state(chat=1, user=1)
+        return state, storage.conn.execute('SELECT COUNT(*) FROM fsm_storage').fetchone()[0]
+
+    assert run(scenario) == (None, 0)
@@ -0,0 +1,28 @@
+import threading
+import time
+
+from main import Metrics
+
+
+def test_render_while_threads_add_series():
+    metrics = Metrics()
+    stop = threading.Event()
+
+    def writer():
+        # Новые серии появляются по одной, как новые методы и ошибки в потоке базы
+        i = 0
+        while not stop.is_set():
+            metrics.inc('bot_db_errors_total', (('method', f'm{i}'),))
+            metrics.observe('bot_db_query_seconds', (('method', f'm{i}'),), 0.001)
+            i += 1
+            time.sleep(0.0001)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        deadline = time.monotonic() + 0.5
+        while time.monotonic() < deadline:
+            metrics.render()
+    finally:
+        stop.set()
+        thread.join()
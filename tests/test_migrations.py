@@ -0,0 +1,72 @@
+import sqlite3
+
+from database import Database
+
+# Схема исходного бота, до всех миграций: цех, профессия и опыт - строками
+BASELINE_SCHEMA = [
+    '''CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        full_name TEXT,
+        department TEXT,
+        profession TEXT,
+        experience TEXT,
+        portfolio TEXT,
+        location TEXT
+    )''',
+    '''CREATE TABLE favorites (
+        user_id INTEGER,
+        favorite_user_id INTEGER,
+        PRIMARY KEY (user_id, favorite_user_id),
+        FOREIGN KEY (user_id) REFERENCES users (user_id),
+        FOREIGN KEY (favorite_user_id) REFERENCES users (user_id)
+    )''',
+]
+
+BASELINE_USERS = [
+    (1, 'olya', 'Ольга Светлова', 'Операторский цех', 'Gaffer', '1-3 года', 'https://olya.example', 'Москва'),
+    (2, 'ivan', 'Иван Петров', 'Звуковой цех', 'Звукорежиссеры', '5+ лет', None, 'мск'),
+    # Профессия, которой уже нет в справочнике, и профиль без заполненных полей
+    (3, 'old', 'Петр Старый', 'Операторский цех', 'Механик крана', 'Без опыта', None, 'Казань'),
+    (4, None, 'Новичок', None, None, None, None, None),
+]
+
+
+def create_baseline(path):
+    conn = sqlite3.connect(path)
+    for statement in BASELINE_SCHEMA:
+        conn.execute(statement)
+    conn.executemany('INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?)', BASELINE_USERS)
+    conn.executemany('INSERT INTO favorites VALUES (?, ?)', [(1, 2), (3, 2), (2, 1)])
+    conn.commit()
+    conn.close()
+
+
+def test_baseline_database_is_upgraded_in_place():
+    create_baseline('baseline.db')
+    database = Database('baseline.db')
+    try:
+        database.cursor.execute('PRAGMA user_version')
+        assert database.cursor.fetchone()[0] == 9
+
+        database.cursor.execute('''
+        SELECT user_id, username, full_name, department, profession, experience, portfolio, location
+        FROM users_view ORDER BY user_id''')
+        rows = [tuple(row) for row in database.cursor.fetchall()]
+        # Строки те же, только город приведен к единому написанию
+        expected = [list(user) for user in BASELINE_USERS]
+        expected[1][7] = 'Москва'
+        assert rows == [tuple(user) for user in expected]
+        database.cursor.execute('SELECT department_id, profession_id FROM users WHERE user_id = 3')
+        assert all(code is not None for code in database.cursor.fetchone())
+
+        database.cursor.execute('SELECT rowid FROM users_fts ORDER BY rowid')
+        assert [row[0] for row in database.cursor.fetchall()] == [1, 2, 3, 4]
+        assert [row['user_id'] for row in database.search_text('светлова', limit=5)[0]] == [1]
+        assert [row['user_id'] for row in database.search_text('крана', limit=5)[0]] == [3]
+        assert sorted(row['user_id'] for row in database.search_text('мск', limit=5)[0]) == [1, 2]
+
+        assert database.get_user(2)['favorited'] == 2
+        assert database.count_profiles() == 4
+    finally:
+        database.close()
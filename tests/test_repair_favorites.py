@@ -0,0 +1,38 @@
+from database import Database, ShardedDatabase
+
+
+def sharded(name):
+    return ShardedDatabase([Database(f'{name}.{index}.db') for index in range(2)])
+
+
+def test_repair_restores_lost_copies_between_shards():
+    database = sharded('repair')
+    try:
+        for user_id in range(1, 7):
+            database.add_user(user_id, f'user{user_id}', f'User {user_id}')
+        database.add_favorite(1, 2)
+        database.add_favorite(3, 4)
+        database.add_favorite(2, 4)
+        # Сбой между записями: копия 1 -> 2 не дошла до шарда 2, удаление 3 -> 4 - до шарда 4
+        database.shard(2).remove_favorite(1, 2)
+        database.shard(3).remove_favorite(3, 4)
+        assert not database.get_user(2)['favorited']
+        assert database.get_user(4)['favorited'] == 2
+
+        assert database.repair_favorites() == (1, 1)
+        assert database.get_user(2)['favorited'] == 1
+        assert database.get_user(4)['favorited'] == 1
+        assert database.repair_favorites() == (0, 0)
+    finally:
+        database.close()
+
+
+def test_user_ids_page_is_merged_across_shards():
+    database = sharded('pages')
+    try:
+        for user_id in range(1, 8):
+            database.add_user(user_id, f'user{user_id}', f'User {user_id}')
+        assert database.get_user_ids_page(0, 3) == [1, 2, 3]
+        assert database.get_user_ids_page(3, 10) == [4, 5, 6, 7]
+    finally:
+        database.close()
@@ -0,0 +1,21 @@
+import time
+
+from database import Database, SEARCH_MATCH_RETENTION
+
+
+def test_old_notified_matches_are_pruned():
+    database = Database('matches.db')
+    try:
+        now = int(time.time())
+        database.add_search_matches([
+            (1, 10, 1, now - 10, None),
+            (1, 11, 1, now - SEARCH_MATCH_RETENTION - 100, now - SEARCH_MATCH_RETENTION - 50),
+            (1, 12, 1, now - 100, now - 50),
+            (2, 20, 2, now - SEARCH_MATCH_RETENTION - 100, now - SEARCH_MATCH_RETENTION - 50),
+        ])
+        database.mark_matches_notified([1], now)
+        database.cursor.execute('SELECT user_id, profile_id, notified_at IS NOT NULL FROM search_matches ORDER BY 1, 2')
+        # Свежие отправленные остаются и не дают прислать профиль повторно; чужие подписчики не трогаются
+        assert [tuple(row) for row in database.cursor.fetchall()] == [(1, 10, 1), (1, 12, 1), (2, 20, 1)]
+    finally:
+        database.close()
@@ -0,0 +1,30 @@
+import sqlite3
+
+from database import Database, canonical_city
+
+
+def test_city_facet_leads_to_the_count_it_showed():
+    database = Database('facets.db')
+    for user_id, location in enumerate(['мск', 'москва', 'Москва', 'спб', 'Казань'], 1):
+        database.add_profiles([{'user_id': user_id, 'full_name': f'User {user_id}', 'department': 'Операторский цех',
+                                'profession': 'Gaffer', 'experience': '1-3 года', 'location': location}])
+    database.close()
+    # Строки, записанные до canonical_city: город хранится как его ввели
+    conn = sqlite3.connect('facets.db')
+    for user_id, location in enumerate(['мск', 'москва', 'Москва', 'спб', 'Казань'], 1):
+        conn.execute('UPDATE users SET location = ? WHERE user_id = ?', (location, user_id))
+    conn.execute('PRAGMA user_version = 8')
+    conn.commit()
+    conn.close()
+
+    database = Database('facets.db')
+    try:
+        search = {'department': 'Операторский цех', 'profession': 'Gaffer'}
+        facets = database.facet_counts('location', **search)
+        assert sorted(facets) == [('Казань', 1), ('Москва', 3), ('Санкт-Петербург', 1)]
+        for city, count in facets:
+            # Выбор кнопки: search_location ищет город через canonical_city
+            assert database.count_users(location=canonical_city(city), **search) == count
+        assert [row['user_id'] for row in database.search_text('мск', limit=5)[0]] == [3, 2, 1]
+    finally:
+        database.close()
@@ -0,0 +1,126 @@
+import asyncio
+import time
+
+import pytest
+from aiogram.utils.exceptions import RetryAfter, BotBlocked
+
+import main
+from main import SendQueue, PRIORITY_BULK, PRIORITY_INTERACTIVE
+
+
+class FloodBot:
+    """Bot, который отвечает RetryAfter на заданные вызовы и записывает доставленные"""
+
+    def __init__(self, flood=None, errors=()):
+        # chat_id -> сколько секунд просить подождать при первой отправке
+        self.flood = dict(flood or {})
+        self.errors = set(errors)
+        self.sent = []
+        self.started = time.monotonic()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id in self.errors:
+            raise BotBlocked('Forbidden: bot was blocked by the user')
+        timeout = self.flood.pop(chat_id, None)
+        if timeout:
+            raise RetryAfter(timeout)
+        self.sent.append((time.monotonic() - self.started, chat_id, text))
+        return text
+
+    async def delete_message(self, chat_id, message_id):
+        return await self.send_message(chat_id, f'delete {message_id}')
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_retry_after_delays_only_its_chat():
+    async def scenario():
+        bot = FloodBot(flood={1: 1})
+        sender = SendQueue(bot, global_rate=100, chat_rate=100, chat_burst=10)
+        first = asyncio.create_task(sender.send_message(1, 'a1'))
+        second = asyncio.create_task(sender.send_message(1, 'a2'))
+        await asyncio.sleep(0.05)
+        await sender.send_message(2, 'b-interactive')
+        results = await asyncio.gather(first, second)
+        await sender.stop()
+        return bot, results
+
+    bot, results = run(scenario())
+    assert results == ['a1', 'a2']
+    delivered = {text: (elapsed, chat_id) for elapsed, chat_id, text in bot.sent}
+    assert delivered['b-interactive'][0] < 0.5
+    assert delivered['a1'][0] >= 1 and delivered['a2'][0] >= 1
+    assert [text for _, chat_id, text in bot.sent if chat_id == 1] == ['a1', 'a2']
+
+
+def test_interactive_reply_overtakes_bulk_at_global_limit():
+    async def scenario():
+        bot = FloodBot()
+        sender = SendQueue(bot, global_rate=10, chat_rate=100, chat_burst=10)
+        bulk = [asyncio.create_task(sender.send_message(chat_id, f'bulk{chat_id}', priority=PRIORITY_BULK))
+                for chat_id in range(100, 130)]
+        await asyncio.sleep(0.3)
+        await sender.send_message(1, 'reply', priority=PRIORITY_INTERACTIVE)
+        sent_before_reply = len(bot.sent) - 1
+        for task in bulk:
+            task.cancel()
+        await sender.stop()
+        return sent_before_reply
+
+    # Общий лимит 10 в секунду: без приоритета ответ ждал бы все 30 сообщений рассылки
+    assert run(scenario()) < 20
+
+
+def test_messages_in_one_chat_keep_order():
+    async def scenario():
+        bot = FloodBot()
+        sender = SendQueue(bot, global_rate=100, chat_rate=50, chat_burst=2)
+        await asyncio.gather(*(sender.send_message(1, str(i)) for i in range(10)))
+        await sender.stop()
+        return [text for _, _, text in bot.sent]
+
+    assert run(scenario()) == [str(i) for i in range(10)]
+
+
+def test_chat_rate_limit_is_applied():
+    async def scenario():
+        bot = FloodBot()
+        sender = SendQueue(bot, global_rate=100, chat_rate=10, chat_burst=2)
+        await asyncio.gather(*(sender.send_message(1, str(i)) for i in range(6)))
+        await sender.stop()
+        return bot.sent[-1][0]
+
+    # Два сообщения сразу, остальные четыре - по одному в 0.1 с
+    assert run(scenario()) >= 0.35
+
+
+def test_other_errors_reach_the_caller():
+    async def scenario():
+        bot = FloodBot(errors={1})
+        sender = SendQueue(bot, global_rate=100, chat_rate=100, chat_burst=10)
+        try:
+            with pytest.raises(BotBlocked):
+                await sender.send_message(1, 'lost')
+            return await sender.send_message(2, 'ok')
+        finally:
+            await sender.stop()
+
+    assert run(scenario()) == 'ok'
+
+
+def test_cleanup_retries_deletes_after_retry_after(monkeypatch):
+    async def scenario():
+        bot = FloodBot(flood={1: 1})
+        monkeypatch.setattr(main, 'sender', SendQueue(bot, global_rate=100, chat_rate=100, chat_burst=10))
+        monkeypatch.setattr(main, 'cleanup_stats', {'deleted': 0, 'failed': 0, 'skipped': 0})
+        try:
+            await main.delete_messages(1, [(10, time.time()), (11, time.time())])
+        finally:
+            await main.sender.stop()
+        return bot, main.cleanup_stats
+
+    bot, stats = run(scenario())
+    assert stats == {'deleted': 2, 'failed': 0, 'skipped': 0}
+    assert sorted(text for _, _, text in bot.sent) == ['delete 10', 'delete 11']
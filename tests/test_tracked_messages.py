@@ -0,0 +1,20 @@
+import time
+
+from database import Database
+
+
+def test_tracked_messages_survive_a_restart_without_shutdown():
+    now = int(time.time())
+    database = Database('tracked.db')
+    database.save_tracked_messages([(1, 10, now), (1, 11, now), (2, 20, now - 100)])
+    assert [tuple(row) for row in database.load_tracked_messages(now - 50)] == [(1, 10, now), (1, 11, now)]
+    database.close()
+
+    # Процесс упал после загрузки: следующий запуск снова находит сохраненный снимок
+    database = Database('tracked.db')
+    try:
+        assert len(database.load_tracked_messages(now - 200)) == 3
+        database.save_tracked_messages([(3, 30, now)])
+        assert [tuple(row) for row in database.load_tracked_messages(0)] == [(3, 30, now)]
+    finally:
+        database.close()
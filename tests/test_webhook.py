@@ -0,0 +1,113 @@
+import asyncio
+import time
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiohttp import ClientSession
+from aiohttp.test_utils import TestServer
+
+from main import BOT_TOKEN, METRICS_PATH, WEBHOOK_PATH, WEBHOOK_SECRET_HEADER, create_webhook_app
+
+SECRET = 'test-secret'
+
+
+def message_update(update_id, chat_id, text):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'User'},
+            'text': text,
+        },
+    }
+
+
+def recording_dispatcher(delays):
+    """Dispatcher, который записывает начало и конец обработки каждого текста"""
+    dp = Dispatcher(Bot(token=BOT_TOKEN), storage=MemoryStorage())
+    dp.events = []
+
+    @dp.message_handler()
+    async def record(message: types.Message):
+        dp.events.append(('start', message.chat.id, message.text, time.monotonic()))
+        await asyncio.sleep(delays.get(message.text, 0))
+        dp.events.append(('end', message.chat.id, message.text, time.monotonic()))
+
+    return dp
+
+
+async def serve(dp, updates, headers=None, concurrency=4, paths=None):
+    """Поднимаем webhook на локальном порту и отправляем обновления параллельно"""
+    app = create_webhook_app(dp, concurrency=concurrency, secret=SECRET, on_startup=None, on_shutdown=None)
+    server = TestServer(app)
+    await server.start_server()
+    headers = {WEBHOOK_SECRET_HEADER: SECRET} if headers is None else headers
+    try:
+        async with ClientSession() as session:
+            async def post(update):
+                async with session.post(server.make_url(WEBHOOK_PATH), json=update, headers=headers) as response:
+                    return response.status
+
+            statuses = []
+            for update in updates:
+                # Telegram шлет обновления одного чата по очереди, дожидаясь ответа
+                statuses.append(await post(update))
+            others = {}
+            for path in paths or ():
+                async with session.get(server.make_url(path)) as response:
+                    others[path] = response.status
+        await app['pipeline'].stop()
+        return statuses, others
+    finally:
+        await server.close()
+
+
+def test_requests_without_secret_are_rejected():
+    dp = recording_dispatcher({})
+    statuses, _ = asyncio.run(serve(dp, [message_update(1, 10, '/broadcast hi')], headers={}))
+    assert statuses == [401]
+    dp2 = recording_dispatcher({})
+    statuses, _ = asyncio.run(serve(dp2, [message_update(1, 10, 'x')], headers={WEBHOOK_SECRET_HEADER: 'wrong'}))
+    assert statuses == [401]
+    assert dp.events == [] and dp2.events == []
+
+
+def test_metrics_are_not_served_on_webhook_app():
+    dp = recording_dispatcher({})
+    _, others = asyncio.run(serve(dp, [], paths=[METRICS_PATH]))
+    assert others[METRICS_PATH] == 404
+
+
+def test_updates_of_one_chat_are_processed_in_order():
+    dp = recording_dispatcher({'1': 0.2, '2': 0.05, '3': 0})
+    updates = [message_update(i, 10, str(i)) for i in (1, 2, 3)]
+    statuses, _ = asyncio.run(serve(dp, updates))
+    assert statuses == [200, 200, 200]
+    assert [(event, text) for event, _, text, _ in dp.events] == [
+        ('start', '1'), ('end', '1'), ('start', '2'), ('end', '2'), ('start', '3'), ('end', '3'),
+    ]
+
+
+def test_slow_update_does_not_block_other_chats():
+    # Все чаты с одинаковым остатком от деления: при старом пуле они попали бы к одному обработчику
+    delays = {'slow': 1.0}
+    dp = recording_dispatcher(delays)
+    updates = [message_update(1, 8, 'slow')] + [message_update(i, 8 * i, f'fast{i}') for i in range(2, 12)]
+    asyncio.run(serve(dp, updates, concurrency=4))
+    times = {(event, text): at for event, _, text, at in dp.events}
+    slow_end = times[('end', 'slow')]
+    assert all(times[('end', f'fast{i}')] < slow_end for i in range(2, 12))
+
+
+def test_concurrency_limit():
+    delays = {f'm{i}': 0.1 for i in range(12)}
+    dp = recording_dispatcher(delays)
+    updates = [message_update(i, 100 + i, f'm{i}') for i in range(12)]
+    asyncio.run(serve(dp, updates, concurrency=3))
+    running = peak = 0
+    for event, *_ in sorted(dp.events, key=lambda event: (event[3], event[0] == 'start')):
+        running += 1 if event == 'start' else -1
+        peak = max(peak, running)
+    assert peak == 3